@@ -2,31 +2,90 @@ import pygame, pytmx
 import time as t
 import math as m
 import random as r
-import os, csv, json
-
-pygame.init() # initialize pygame
-
-pygame.display.set_caption("Kastles and Krakens") # sets the window caption to Kastles and Krakens
+import os, sys, csv, json, argparse, tracemalloc, gc, struct, zlib, heapq, threading, multiprocessing, functools, socket, cProfile
+from multiprocessing import shared_memory
+import xml.etree.ElementTree as et
+from simulation import WallGrid, RoomSimulation, unpack_rows, simulation_worker # also imported by SimulationPool's worker processes
 
 class MainGame():
-    def __init__(self):
+    def __init__(self, world_dir=""):
+        self.world_dir = world_dir # directory with maplist.csv and room_bgs, "" = the shipped world
         self.load_variables() # creates and loads all basic variables
         self.load_rooms() # creates and loads all rooms into memory
+        self.freeze_memory() # everything loaded so far stays in memory until the game ends
 
     def load_variables(self):
+        # pygame is initialised here instead of at the top of the file,
+        # SimulationPool's worker processes import this file again and they shouldn't open a window
+        pygame.init() # initialize pygame
+        pygame.display.set_caption("Kastles and Krakens") # sets the window caption to Kastles and Krakens
+
         # basic pygame variables
         self.running = True
         self.game_WIDTH = 1280
         self.game_HEIGHT = 960
         self.main_screen = pygame.display.set_mode((self.game_WIDTH, self.game_HEIGHT))
+        # SDL drops every event get_events doesn't handle (mouse movement, window events, text input, ...) before it reaches the queue,
+        # they can't wake the game up from the idle state either
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([pygame.QUIT, pygame.VIDEOEXPOSE, pygame.KEYDOWN, pygame.KEYUP])
         self.clock = pygame.time.Clock()
+        self.game_sprites = SpriteGroup() # replaced by load_player_sprite in every room, exists before the first room is loaded (CoopHost.join)
         self.prev_time = t.time()
+        self.fps_limit = 60 # 0 = no limit, used by replays
+        self.frame_count = 0
+        self.ticks = 0 # time (in ms) of the current frame, every animation timer uses this instead of pygame.time.get_ticks()
+
+        # random number generators, every subsystem has its own so that recorded sessions can be replayed exactly
+        self.ai_random = r.Random() # overworld enemy AI
+        self.battle_random = r.Random() # QTE combos
+        self.fixed_timestep = False # True = every frame is exactly 1/60 of a second long (recording/replaying)
+        self.input_log = None # InputLog that is being recorded
+        self.replay_log = None # InputLog that is being replayed
+
+        # idle frame variables, used to skip frames where nothing on the screen has changed
+        self.redraw = True # forces the next frame to be drawn
+        self.idle_wake = None # time (in ms) at which an idle game needs to wake up again, None = game isn't idle
+        self.idle_timeout = 1000 # longest time (in ms) the game can sleep for without checking on itself
+        self.wake_event = None # event that woke the game up, handled by get_events
+        self.render_thread = None # RenderThread that draws the frames, None = run_frame draws them itself
+
+        # hot reload variables, see AssetWatcher
+        self.asset_watcher = None # None = assets are only loaded once
+
+        # co-op variables, see CoopHost
+        self.coop_host = None # None = nobody can join the game
+
+        # save file variables, see SaveFile
+        self.save_file = None # None = the game isn't saved
+        self.autosave_interval = 10000 # ms
+        self.last_save = 0
+        # battle/victory variables from the last drawn frame
+        self.drawn_roaming = None
+        self.drawn_battleloop_var = None
+        self.drawn_text_count = None
+        self.drawn_enemy_count = None
+
+        # frame timing variables, F3 toggles the timing overlay
+        self.frame_timer = FrameTimer(self)
+        self.frame_stats_file = None # if set, frame timing statistics are written into this .csv file on exit
+
+        # F5 profiles the next few frames, see FrameProfiler
+        self.frame_profiler = FrameProfiler(self)
+
+        # memory report variables, F4 prints the memory report
+        self.memory_report = MemoryReport(self)
+        self.memory_report_file = None # if set, the memory report is written into this file on exit
+
+        # QTE input latency, see InputLatency
+        self.input_latency = InputLatency(self)
         
         # movement key variables
         self.key_w = False
         self.key_a = False
         self.key_s = False
         self.key_d = False
+        self.load_bindings()
 
         # initial player commit, prevents duplication of player sprite
         self.player = Player(self, "player", 624, 600, 0, 4)
@@ -35,12 +94,15 @@ class MainGame():
         self.font = pygame.font.SysFont("arial", 40)
         self.medium_font = pygame.font.SysFont("arial", 150)
         self.big_font = pygame.font.SysFont("arial", 300)
+        self.victory_texts = self.render_banner(self.medium_font, "Congratulations!", "You win!", (200,200,0))
+        self.game_over_texts = self.render_banner(self.big_font, "GAME", "OVER", (200,0,0))
         self.text_list = []
         self.text_delay = 0
         self.battle_bg_file = pygame.image.load("battle_background.png")
         self.cur_battle_bg = pygame.Surface((1280,960))
         self.cur_battle_bg.blit(self.battle_bg_file,(0,0))
-        self.game_battle_sprites = pygame.sprite.Group()
+        self.cur_battle_bg = prepare_surface(self.cur_battle_bg) # drawn every battle frame
+        self.game_battle_sprites = SpriteGroup()
         
         # other battle variables
         self.battleloop_var = 1
@@ -54,128 +116,453 @@ class MainGame():
         # player's current position in relation to the overworld, X and Y variables
         self.ow_posX = 2
         self.ow_posY = 1
-        self.prev_ow_pos = []
+        self.prev_ow_posX = None # previous room coordinates, separate integers so that change_pos doesn't create a list every frame
+        self.prev_ow_posY = None
+        self.camera = Camera(self.game_WIDTH, self.game_HEIGHT) # follows the player around rooms bigger than the screen
         
+        # world simulation variables, see WorldSimulation
+        self.sim_budget = 200 # enemies in neighbouring rooms that can be updated per frame
+        self.sim_workers = 0 # worker processes that simulate distant rooms, 0 = distant rooms are frozen
+
+        # overworld AI variables, see Enemy.move
+        self.set_ai_rate(10) # decisions per second
+
         # switch between overworld phase and battle phase
         self.roaming = True
     
     def load_rooms(self):
-        # loads every room in the game into the world_data list
-        # world_data is split into lists (rows), which contain Room objects
-        mapdata = self.load_mapfile()
-        self.world_data = []
-        room_dir = os.path.join("room_bgs")
-        self.enemy_count = 0
-        void = Room("void", room_dir)
-
-        for f in mapdata:
-            rowlist = []
-            for r in f:
-                if r == "void":
-                    roomdata = void
-                    rowlist.append(roomdata)
-                else:
-                    roomdata = Room(r, room_dir)
-                    self.enemy_count += len(roomdata.enemy_list)
-                    rowlist.append(roomdata)
-            self.world_data.append(rowlist)
-        
-    def load_mapfile(self):
-        # loads the map file (.csv) that contains the layout of the map
-        with open("maplist.csv") as r:
-            loaded = csv.reader(r)  # reads the file, returns map data
-            mapdata = list(loaded)  # takes this data and turns it into a list (that we can work with)
-        return mapdata
+        # loads the world index, rooms themselves are only loaded once the player walks into them
+        # world is a sparse map of (x, y) -> Room, empty spaces don't take up any memory
+        with tracer.span("load_rooms", "load"):
+            self.load_room_data()
+
+    def load_room_data(self):
+        self.world = WorldMap(self.world_dir)
+        self.simulation = WorldSimulation(self, self.sim_budget)
+        self.simulation.workers = self.sim_workers
+        self.enemy_count = self.world.enemy_count # precomputed by the index, no room has to be loaded for this
 
     def game_loop(self):
         # basic game loop, this function causes the game to run in the first place
         while self.running:
-            self.clock.tick(60) # set an FPS limit (currently 60FPS)
-            self.get_dt() # get delta time, used in various movement functions
-            self.get_events() # check events - key presses, etc.
-            self.change_pos() # check if the player moved to another room
-            if self.roaming == True: # Roaming Phase
-                self.main_screen.blit(self.cur_map_image, (0,0)) # draw the background map using the cur_map_image variable
-                self.victory_banner() # check if the player defeated every enemy
-                self.game_sprites.update() # trigger the update function for every sprite in game_sprites
-                self.game_sprites.draw(self.main_screen) # draw all of the sprites in game_sprites on the screen
-            else: # Battle Phase
-                self.check_for_battle() # check if every enemy has been defeated
+            if self.coop_host == None: # packets from the partner don't wake up pygame.event.wait
+                self.wait_for_changes() # if nothing happened last frame, sleep until the next key press or animation frame
+            self.clock.tick(self.fps_limit) # set an FPS limit (currently 60FPS)
+            self.run_frame()
+
+    def run_frame(self):
+        # runs a single frame: input, room changes, movement/battles and drawing
+        # separate from game_loop so that benchmarks can step through frames without any waiting
+        timer = self.frame_timer # measures how long every part of the game loop takes
+        timer.start_frame()
+        self.get_dt() # get delta time, used in various movement functions
+        self.get_events() # check events - key presses, etc.
+        if self.asset_watcher != None:
+            self.asset_watcher.apply() # rooms and spritesheets that changed on the disk
+        if self.coop_host != None:
+            self.coop_host.receive() # the partner's keys
+        timer.mark("get_events")
+        self.change_pos() # check if the player moved to another room
+        timer.mark("change_pos")
+        if self.roaming == True: # Roaming Phase
+            self.victory_banner() # check if the player defeated every enemy
+            self.game_sprites.wake_sleepers(self.ticks) # enemies that were waiting at home
+            self.game_sprites.update() # trigger the update function for every sprite in game_sprites
+            if self.coop_host != None and self.roaming:
+                self.coop_host.check_for_battle() # the partner runs into an enemy
+            timer.mark("update")
+            self.simulation.update() # enemies in the neighbouring rooms
+            if self.save_file != None and self.ticks - self.last_save >= self.autosave_interval:
+                self.save_game()
+            timer.mark("simulation")
+            if self.camera.update(self.cur_map, self.player.rect): # the camera follows the player in big rooms
+                self.redraw = True
+            changed = self.check_for_changes(self.game_sprites) # only draw the frame if something has changed
+            if changed and self.render_thread != None:
+                self.publish_frame() # the render thread draws the frame while the next one is simulated
+                timer.mark("draw")
+            elif changed:
+                if surface_check.enabled:
+                    surface_check.check_sprites(self.game_sprites, self.main_screen)
+                self.cur_map.draw_view(self.main_screen, self.camera) # draw the part of the background map the camera can see
+                timer.mark("background")
+                self.draw_victory_banner() # draw the congratulatory message if every enemy has been defeated
+                self.game_sprites.draw(self.main_screen, self.camera) # draw all of the sprites in game_sprites on the screen
+                timer.draw_overlay(self.main_screen)
+                timer.mark("draw")
+                pygame.display.flip() # update the screen
+                self.input_latency.shown(self.input_latency.take())
+                timer.mark("flip")
+        else: # Battle Phase
+            self.check_for_battle() # check if every enemy has been defeated
+            self.game_battle_sprites.wake_sleepers(self.ticks)
+            self.game_battle_sprites.update() # trigger the update function for every sprite in game_battle_sprites
+            timer.mark("update")
+            self.battle_loop() # move along the battle loop
+            timer.mark("battle_loop")
+            changed = self.check_for_changes(self.game_battle_sprites) # only draw the frame if something has changed
+            if changed and self.render_thread != None:
+                self.publish_frame()
+                timer.mark("draw")
+            elif changed:
+                if surface_check.enabled:
+                    surface_check.check(self.cur_battle_bg, "the battle background", self.main_screen)
+                    surface_check.check_sprites(self.game_battle_sprites, self.main_screen)
                 self.main_screen.blit(self.cur_battle_bg, (0,0)) # draw the battle background
-                self.game_battle_sprites.update() # trigger the update function for every sprite in game_battle_sprites
+                timer.mark("background")
                 self.game_battle_sprites.draw(self.main_screen) # draw all of the sprites in game_battle_sprites on the screen
-                self.battle_loop() # move along the battle loop
-            pygame.display.flip() # update the screen
+                self.draw_text() # draw everything in self.text_list
+                if self.B_player.state_death:
+                    self.draw_game_over() # draw the game over screen
+                timer.draw_overlay(self.main_screen)
+                timer.mark("draw")
+                pygame.display.flip() # update the screen
+                self.input_latency.shown(self.input_latency.take())
+                timer.mark("flip")
+        if self.coop_host != None:
+            self.coop_host.send() # snapshot of the room, only on network ticks
+        timer.end_frame()
+
+    def start_render_thread(self):
+        # frames are drawn and flipped on a separate thread, see RenderThread
+        if self.render_thread == None:
+            self.render_thread = RenderThread(self)
+
+    def stop_render_thread(self):
+        if self.render_thread != None:
+            self.render_thread.stop()
+            self.render_thread = None
+
+    def publish_frame(self):
+        # hands the frame over to the render thread
+        # images and positions are copied into the snapshot, so the simulation can move the sprites while the frame is being drawn
+        # the room's chunks are looked up (and rendered, if they aren't cached) here, the render thread never touches the TileMap
+        overlay = self.frame_timer.get_overlay()
+        if self.roaming:
+            x = self.camera.x
+            y = self.camera.y
+            background = tuple(self.cur_map.view_blits(self.camera))
+            banner = self.victory_texts if self.enemy_count == 0 else ()
+            sprites = tuple([(sprite.image, (sprite.rect.x - x, sprite.rect.y - y)) for sprite in self.game_sprites.drawn_list])
+            snapshot = DrawSnapshot(background, not self.cur_map.covers(self.camera), banner, sprites, (), (), overlay, self.input_latency.take())
+        else:
+            background = ((self.cur_battle_bg, (0, 0)),)
+            sprites = tuple([(sprite.image, sprite.rect.topleft) for sprite in self.game_battle_sprites.drawn_list])
+            texts = tuple([(i.text, tuple(i.coords)) for i in self.text_list])
+            game_over = self.game_over_texts if self.B_player.state_death else ()
+            snapshot = DrawSnapshot(background, False, (), sprites, texts, game_over, overlay, self.input_latency.take())
+        self.render_thread.publish(snapshot)
+
+    def reload_room(self, roomname):
+        # swaps a changed room file into the world, the current room is rebuilt by change_pos in the same frame
+        cur_key = (self.ow_posX, self.ow_posY)
+        current = self.prev_ow_posX != None and self.world.get_room_name(cur_key[0], cur_key[1]) == roomname
+        if current:
+            # the enemies are stored in the simulation the same way as when the player leaves the room
+            self.game_sprites.wake_all(self.ticks)
+            self.simulation.leave_room(cur_key[0], cur_key[1], self.game_sprites)
+        changed, count_change = self.world.reload_room(roomname)
+        for key, old_ids in changed:
+            self.simulation.reload_room(key, self.world.room_sizes[key], self.world.room_enemies[key], self.world.room_walls[key], old_ids)
+        self.enemy_count += count_change
+        if current or (roomname == "void" and self.cur_room.name == "void"):
+            self.prev_ow_posX = None # change_pos loads the room again
+            self.prev_ow_posY = None
+
+    def reload_spritesheet(self, filename):
+        # swaps a changed spritesheet into every character that uses it, characters created later load it on their own
+        sprite_atlas.sheets.pop(filename, None) # the atlas still has the old version
+        for sprite in list(self.game_sprites) + list(self.game_battle_sprites):
+            sourcefile = getattr(sprite, "sourcefile", None)
+            if sourcefile == filename or (isinstance(sprite, BattleNPC) and sourcefile + "_battle.png" == filename):
+                sprite.reload_frames()
+        if self.coop_host != None:
+            self.coop_host.frame_tables.clear() # the frames are new surfaces
+        self.redraw = True
+
+    def start_hosting(self, address):
+        # lets a second process (--join) control the partner, see CoopHost
+        self.coop_host = CoopHost(self, address)
+        self.redraw = True
+
+    def touches_player(self, rect):
+        # the co-op partner starts battles too, the host's player still does the fighting
+        return rect.colliderect(self.player.rect) or (self.coop_host != None and self.coop_host.touches_partner(rect))
+
+    def start_saving(self, filename):
+        # resumes the game from filename (if it exists), then saves into it every autosave_interval ms and on exit
+        self.save_file = SaveFile(filename)
+        saved = self.save_file.load()
+        if saved != None:
+            self.resume(saved)
+        self.save_file.start()
+        self.last_save = self.ticks
+
+    def resume(self, saved):
+        # only the saved rooms' simulations are created, rooms themselves are still loaded once the player walks into them
+        state, dead, sims = saved
+        self.ow_posX, self.ow_posY, x, y, self.player_health, self.enemy_count = state
+        self.player.position_x = x
+        self.player.position_y = y
+        self.player.rect.x = int(x)
+        self.player.rect.y = int(y)
+        self.prev_ow_posX = None # change_pos loads the saved room
+        self.prev_ow_posY = None
+        for key, ids in dead.items():
+            self.world.dead_enemies[key] = set(ids)
+        # ticks is only updated by get_dt, the simulations have to be placed on the clock the first frame will use
+        if self.fixed_timestep:
+            self.ticks = self.frame_count*1000//60
+        else:
+            self.ticks = pygame.time.get_ticks()
+        for key, [age, enemies] in sims.items():
+            room = self.simulation.get_room(key[0], key[1])
+            room.enemies = enemies
+            room.sim_time = self.ticks - age
+
+    def save_game(self):
+        # only the overworld is saved, a battle in progress is lost (the enemy is still there after resuming)
+        if self.roaming:
+            self.save_file.save(self)
+        self.last_save = self.ticks
+
+    def shutdown(self):
+        # triggered once the game loop ends, writes out any requested statistics
+        self.stop_render_thread() # the last frame is drawn first
+        if self.frame_profiler.profile != None:
+            self.frame_profiler.finish() # the game was closed during a capture, the frames so far are still written
+        if self.asset_watcher != None:
+            self.asset_watcher.stop()
+        if self.coop_host != None:
+            self.coop_host.close()
+        if self.save_file != None:
+            self.save_game()
+            self.save_file.close() # waits until the save is on the disk
+        if self.input_log != None:
+            self.input_log.stop_recording(self.frame_count, self.state_checksum())
+        if self.replay_log != None:
+            if self.replay_log.checksum == self.state_checksum():
+                print("replay finished after %d frames, final state matches the recording" % self.frame_count)
+            else:
+                print("replay finished after %d frames, final state DOESN'T match the recording" % self.frame_count)
+        if self.frame_stats_file:
+            self.frame_timer.write_csv(self.frame_stats_file)
+        if tracer.enabled:
+            tracer.write()
+        if self.frame_timer.count_allocations:
+            print(self.frame_timer.allocation_summary())
+        if self.memory_report_file:
+            self.memory_report.write(self.memory_report_file)
+        self.simulation.close()
+
+    def check_for_changes(self, sprite_group):
+        # checks if anything on the screen has changed since the last drawn frame
+        # if nothing has changed, it also works out when the game needs to wake up again
+        changed = self.redraw or sprite_group.redraw
+        sprite_group.redraw = False
+        now = self.ticks
+        wake = sprite_group.next_wake() # sleeping sprites don't change until they wake up
+        for sprite in sprite_group.awake_list:
+            if sprite.check_for_changes(): # sprite moved or switched to a different animation frame
+                changed = True
+            sprite_wake = sprite.wake_time(now) # time of the sprite's next animation frame, None = sprite is still
+            if sprite_wake is not None and (wake is None or sprite_wake < wake):
+                wake = sprite_wake
+        if len(self.text_list) != 0: # battle text disappears after 1.5 seconds
+            text_wake = self.text_delay + 1501
+            if wake is None or text_wake < wake:
+                wake = text_wake
+
+        # battle phase, battle loop, battle text and victory changes aren't tied to any sprite
+        if (self.roaming != self.drawn_roaming or self.battleloop_var != self.drawn_battleloop_var
+                or len(self.text_list) != self.drawn_text_count or self.enemy_count != self.drawn_enemy_count):
+            self.drawn_roaming = self.roaming
+            self.drawn_battleloop_var = self.battleloop_var
+            self.drawn_text_count = len(self.text_list)
+            self.drawn_enemy_count = self.enemy_count
+            changed = True
+
+        self.redraw = False
+        if changed:
+            self.idle_wake = None # something is happening, keep running at full speed
+        elif wake is None:
+            self.idle_wake = now + self.idle_timeout # nothing is scheduled, check in every once in a while
+        else:
+            self.idle_wake = wake
+        return changed
+
+    def wait_for_changes(self):
+        # sleeps until a new event arrives or until the next scheduled animation frame
+        # uses almost no CPU while the game is idle
+        if self.idle_wake is None or self.fixed_timestep: # last frame wasn't idle, or every frame has to be simulated (recording/replaying)
+            return
+        timeout = min(self.idle_wake - pygame.time.get_ticks(), self.idle_timeout)
+        if timeout <= 1000//60: # next frame is due anyway, clock.tick takes care of the wait
+            return
+        event = pygame.event.wait(int(timeout)) # timeline frame times are in fractional ms
+        if event.type != pygame.NOEVENT:
+            # woken up by an event (most likely a key press), it has to be handled by get_events
+            self.wake_event = event
+            self.input_latency.poll() # the key was pressed just now, not at some point since the last frame
+            # the time spent sleeping isn't counted into delta time, otherwise the player would jump forward
+            self.prev_time = t.time() - 1/60
 
     # Source: CDcodes - Pygame Framerate Independence Tutorial: Delta Time Movement
     # https://www.youtube.com/watch?v=XuyrHE6GIsc
     def get_dt(self):
+        self.frame_count += 1
+        if self.fixed_timestep:
+            # recorded and replayed sessions ignore the real time, otherwise they would never play out the same way
+            self.dt = 1/60
+            self.ticks = self.frame_count*1000//60
+            return
         now = t.time()
         self.dt = now - self.prev_time # tiny difference between both variables, comes up to approx. 1/60 of a second
         self.prev_time = now
+        self.ticks = pygame.time.get_ticks()
+
+    def set_seeds(self, ai_seed, battle_seed):
+        self.ai_random.seed(ai_seed)
+        self.battle_random.seed(battle_seed)
+
+    def set_seed(self, seed):
+        # one seed for both generators (--seed), the battle seed is derived from it so the two streams aren't the same sequence
+        # returns [AI seed, battle seed], both fit into the 64 bits InputLog stores
+        ai_seed = seed & 0xFFFFFFFFFFFFFFFF
+        battle_seed = ai_seed ^ 0x9E3779B97F4A7C15
+        self.set_seeds(ai_seed, battle_seed)
+        return ai_seed, battle_seed
+
+    def start_recording(self, filename, seed=None):
+        # records every input event into filename, the session can be replayed with start_replay
+        if seed == None:
+            seed = r.getrandbits(63)
+        ai_seed, battle_seed = self.set_seed(seed)
+        self.fixed_timestep = True
+        self.input_log = InputLog(filename)
+        self.input_log.start_recording(ai_seed, battle_seed)
+
+    def start_replay(self, filename):
+        # plays back a recorded session as fast as possible
+        self.replay_log = InputLog(filename)
+        self.replay_log.load()
+        self.set_seeds(self.replay_log.ai_seed, self.replay_log.battle_seed)
+        self.fixed_timestep = True
+        self.fps_limit = 0
+
+    def state_checksum(self):
+        # short summary of the game state, used to check whether a replay ended up in the same place as the recording
+        state = (self.ow_posX, self.ow_posY, self.player_health, self.enemy_health, self.enemy_count, self.roaming,
+                 int(self.player.position_x), int(self.player.position_y))
+        return zlib.crc32(repr(state).encode())
 
     def get_events(self):
         # basic pygame function, records unique events such as key/button presses, etc.
-        for event in pygame.event.get():
+        if self.replay_log != None:
+            events = self.get_replay_events()
+        else:
+            events = pygame.event.get()
+        if self.wake_event != None: # event that woke the game up from the idle state
+            events.insert(0, self.wake_event)
+            self.wake_event = None
+        self.input_latency.poll()
+        for event in events:
+            if self.input_log != None and event.type in InputLog.event_kinds:
+                self.input_log.record(self.frame_count, event)
             if event.type == pygame.QUIT: # X button in the top right corner of the window
                 self.running = False # stops the program from running
-            elif event.type == pygame.KEYDOWN: # keystroke, key has been pressed down
-                if event.key == pygame.K_w:
-                    self.key_w = True
-                    self.attack(0) # only relevant when in battle phase
-                elif event.key == pygame.K_a:
-                    self.key_a = True
-                    self.attack(1) # only relevant when in battle phase
-                elif event.key == pygame.K_s:
-                    self.key_s = True
-                    self.attack(2) # only relevant when in battle phase
-                elif event.key == pygame.K_d:
-                    self.key_d = True
-                    self.attack(3) # only relevant when in battle phase
-                elif event.key == pygame.K_j:
-                    self.attack(4) # only relevant when in battle phase
-                    self.select_action_from_menu() # only relevant when in battle phase
-                elif event.key == pygame.K_k:
-                    self.attack(5) # only relevant when in battle phase
-            elif event.type == pygame.KEYUP: # keystroke, key has been lifted
-                if event.key == pygame.K_w:
-                    self.key_w = False
-                elif event.key == pygame.K_a:
-                    self.key_a = False
-                elif event.key == pygame.K_s:
-                    self.key_s = False
-                elif event.key == pygame.K_d:
-                    self.key_d = False
+            elif event.type == pygame.VIDEOEXPOSE: # window has to be redrawn
+                self.redraw = True
+            elif event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
+                self.redraw = True # menu selection/QTE keys might have changed
+                handler = self.bindings[self.roaming].get((event.type, event.key)) # the phase can change between two events
+                if handler != None:
+                    handler()
+
+    def load_bindings(self):
+        # key bindings: (event type, key) -> function, one table for the roaming phase and one for the battle phase
+        # get_events only looks the key up in the table of the current phase, keys without a binding are ignored
+        movement = {pygame.K_w: "key_w", pygame.K_a: "key_a", pygame.K_s: "key_s", pygame.K_d: "key_d"}
+        common = {
+            (pygame.KEYDOWN, pygame.K_F3): self.frame_timer.toggle_overlay, # shows/hides the frame timing overlay
+            (pygame.KEYDOWN, pygame.K_F4): self.print_memory_report,
+            (pygame.KEYDOWN, pygame.K_F5): self.frame_profiler.arm, # profiles the next few frames with cProfile
+        }
+        for key, name in movement.items():
+            common[(pygame.KEYDOWN, key)] = functools.partial(setattr, self, name, True)
+            common[(pygame.KEYUP, key)] = functools.partial(setattr, self, name, False)
+        roaming = dict(common)
+        battle = dict(common)
+        # W=0, A=1, S=2, D=3, J=4, K=5, same as BattleMenu
+        for input_var, key in enumerate([pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d, pygame.K_j, pygame.K_k]):
+            battle[(pygame.KEYDOWN, key)] = functools.partial(self.press_battle_key, movement.get(key), input_var)
+        self.bindings = {True: roaming, False: battle} # self.roaming -> table
+
+    def press_battle_key(self, movement_key, input_var):
+        if movement_key != None:
+            setattr(self, movement_key, True) # the key might still be held down once the battle is over
+        self.attack(input_var)
+        if input_var == 4: # J also confirms the menu selection
+            self.select_action_from_menu()
+
+    def print_memory_report(self):
+        print(self.memory_report.create_report()) # prints out how much memory every asset uses
+
+    def get_replay_events(self):
+        # replaces the real events with the recorded ones, only the X button still works
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.running = False
+        if self.frame_count >= self.replay_log.last_frame:
+            self.running = False # the recording is over
+        return self.replay_log.get_events(self.frame_count)
 
     def change_pos(self):
         # checks if the player has gone into a different room
-        cur_ow_pos = [self.ow_posX, self.ow_posY]
-        if cur_ow_pos == self.prev_ow_pos:
+        if self.ow_posX == self.prev_ow_posX and self.ow_posY == self.prev_ow_posY:
             # prevents the program from loading the same room over and over again
             return
         # if the player has moved between rooms, the function loads a new room from scratch
-        self.cur_room = self.world_data[self.ow_posY][self.ow_posX]
-        self.cur_map_image = self.cur_room.map.load_map()
-        self.cur_wall_list = self.cur_room.wall_list
+        if self.prev_ow_posX != None:
+            self.game_sprites.wake_all(self.ticks) # sleeping enemies catch up on their timers before they're stored
+            self.simulation.leave_room(self.prev_ow_posX, self.prev_ow_posY, self.game_sprites) # the old room keeps living at a lower level of detail
+        self.cur_room = self.world.get_room(self.ow_posX, self.ow_posY)
+        self.cur_simulation = self.simulation.enter_room(self.ow_posX, self.ow_posY)
+        self.cur_map = self.cur_room.map # the background is drawn in chunks by draw_view, see TileMap
         self.load_player_sprite()
         self.load_enemies(self.cur_room.enemy_list)
-        self.prev_ow_pos = cur_ow_pos
+        self.prev_ow_posX = self.ow_posX
+        self.prev_ow_posY = self.ow_posY
+        self.redraw = True # new room, new background
 
     def load_player_sprite(self):
         # creates new sprite group and adds the player sprite
-        self.game_sprites = pygame.sprite.Group()
+        self.game_sprites = SpriteGroup()
         self.game_sprites.add(self.player)
+        if self.coop_host != None:
+            self.coop_host.enter_room() # the partner follows the host into every room
+
+    def set_ai_rate(self, rate):
+        # overworld enemies make decisions rate times per second, their movement is still updated every frame
+        # enemies are split into ai_period groups and every frame only one group makes decisions
+        self.ai_rate = rate
+        self.ai_period = max(1, round(60/rate)) if rate > 0 else 1 # frames between two decisions of the same enemy
 
     def load_enemies(self, enemy_list):
         # loads all the enemies in a room
         # enemy_data = [object.x, object.y, object.properties["enemy_sprite"], object.properties["enemy_type"], object.properties["movement_range"], object.properties["movement_speed"], object.id]
-        for enemy in enemy_list:
-            if enemy[3] == "walker":
-                enemy = Walker(self, enemy[2], enemy[0], enemy[1], enemy[4], 4, enemy[5], enemy[6])
-            elif enemy[3] == "charger":
-                enemy = Charger(self, enemy[2], enemy[0], enemy[1], enemy[4], 8, enemy[5], enemy[6])
+        for slot, enemy in enumerate(enemy_list):
+            enemy = self.create_enemy(enemy)
+            enemy.ai_slot = slot % self.ai_period # staggers the decisions
+            self.cur_simulation.place_enemy(enemy) # the enemy continues from where the simulation left it
             self.game_sprites.add(enemy)
 
+    def create_enemy(self, enemy):
+        if enemy[3] == "walker":
+            return Walker(self, enemy[2], enemy[0], enemy[1], enemy[4], 4, enemy[5], enemy[6])
+        elif enemy[3] == "charger":
+            return Charger(self, enemy[2], enemy[0], enemy[1], enemy[4], 8, enemy[5], enemy[6])
+
     def victory_banner(self):
         if self.enemy_count != 0: # checks if all enemies have been defeated
             return
@@ -184,16 +571,19 @@ class MainGame():
         pygame.display.set_caption("Congratulations!") # changes the window caption
 
         self.player_health += 10 # heals the player up a little bit
-        
-        # renders the congratulatory text
-        text1 = self.medium_font.render("Congratulations!", True, (200,200,0))
-        text1_width = text1.get_width()
-        text2 = self.medium_font.render("You win!", True, (200,200,0))
-        text2_width = text2.get_width()
 
-        # draws the text on the screen
-        self.main_screen.blit(text1, (self.game_WIDTH//2-text1_width//2, 150))
-        self.main_screen.blit(text2, (self.game_WIDTH//2-text2_width//2, 450))
+    def draw_victory_banner(self):
+        if self.enemy_count != 0: # checks if all enemies have been defeated
+            return
+        # draws the congratulatory text, rendered once by load_variables
+        self.main_screen.blits(self.victory_texts, doreturn=False)
+
+    def render_banner(self, font, line1, line2, colour):
+        # renders two centered lines of text, returns them as (surface, position) tuples
+        # used for the victory banner and the game over screen, the render thread gets the same tuples in its snapshots
+        text1 = font.render(line1, True, colour)
+        text2 = font.render(line2, True, colour)
+        return ((text1, (self.game_WIDTH//2-text1.get_width()//2, 150)), (text2, (self.game_WIDTH//2-text2.get_width()//2, 450)))
 
     def attack(self, input_var):
         if self.roaming:
@@ -229,6 +619,15 @@ class MainGame():
         if self.B_enemy not in self.game_battle_sprites and len(self.text_list) == 0:
             self.game_battle_sprites.empty()
             self.roaming = True
+            # the battle is over, the garbage collector cleans up the battle sprites in one go
+            gc.collect()
+            gc.enable()
+
+    def freeze_memory(self):
+        # moves every object loaded so far into the permanent generation
+        # the garbage collector won't scan these objects again, which makes every collection a lot shorter
+        gc.collect()
+        gc.freeze()
 
     def battle_loop(self):
         ## Battle phase has 5 different parts that cycle endlessly until one character dies
@@ -252,7 +651,7 @@ class MainGame():
             self.B_player.state_lightattack = False # reset attack animation
             self.B_player.state_heavyattack = False # reset attack animation
             self.menu.active_attack = False # menu attack reset
-            self.draw_text() # draw everything in self.text_list
+            self.update_text() # remove the text from the screen once it's been there long enough
         # 4) Defend phase: enemy attacks the player, player plays a quick-time event to defend against the attack 
         elif self.battleloop_var == 4:
             self.B_player.state_idle = False # player idle animation reset
@@ -266,7 +665,7 @@ class MainGame():
             self.B_enemy.state_idle = True # enemy idle animation trigger
             self.B_enemy.state_attackA = False # enemy attack animation reset
             self.menu.active_attack = False # menu attack reset
-            self.draw_text() # draw everything in self.text_list
+            self.update_text() # remove the text from the screen once it's been there long enough
         else:
             ## At the end of Tally phase 2, battle_loop loops back to the start
             self.battleloop_var = 1
@@ -276,18 +675,12 @@ class MainGame():
         # the only way to get out of this screen is to reset the program
         pygame.display.set_caption("GAME OVER") # changes the window caption
 
-        # renders the game over text
-        text1 = self.big_font.render("GAME", True, (200,0,0))
-        text1_width = text1.get_width()
-        text2 = self.big_font.render("OVER", True, (200,0,0))
-        text2_width = text2.get_width()
-        
-        # draws the text on the screen
-        self.main_screen.blit(text1, (self.game_WIDTH//2-text1_width//2, 150))
-        self.main_screen.blit(text2, (self.game_WIDTH//2-text2_width//2, 450))
+    def draw_game_over(self):
+        # draws the game over text, rendered once by load_variables
+        self.main_screen.blits(self.game_over_texts, doreturn=False)
 
-    def draw_text(self):
-        now = pygame.time.get_ticks()
+    def update_text(self):
+        now = self.ticks
         if self.B_player.state_idle and now - self.text_delay > 1500: # check if the player is idle, and if the text has been on the screen for more than 1.5 seconds
             self.text_list.clear() # clear the text list
             self.battleloop_var += 1 # move to the next phase in battle loop
@@ -300,18 +693,27 @@ class MainGame():
                 self.menu.defend()
                 self.B_player.cur_frame = 0
                 self.B_enemy.cur_frame = 0
+
+    def draw_text(self):
         for i in self.text_list: # draw every text object in text list
-            self.main_screen.blit(i.text, (i.coords[0],i.coords[1]))
+            self.main_screen.blit(i.text, i.coords)
 
     def trigger_battle_phase(self, enemy):
         # triggered when overworld enemy objects touch the player
         self.enemy = enemy # loads the enemy object into memory
         self.roaming = False # switches to battle phase
         self.load_battle_sprites()
+        # no garbage collection during battles, collections cause dropped frames during QTEs
+        # the garbage is collected once the battle ends (check_for_battle)
+        gc.disable()
 
     def load_battle_sprites(self):
         # loads battle sprites to the battle_sprites sprite group
         # done at the start of every battle in order to prevent duplication
+        with tracer.span("load_battle_sprites", "load", {"enemy": self.enemy.sourcefile}):
+            self.create_battle_sprites()
+
+    def create_battle_sprites(self):
         self.B_player = BattlePlayer(self, 100, 800)
         self.game_battle_sprites.add(self.B_player)
         self.menu = BattleMenu(self, self.player_health)
@@ -332,6 +734,14 @@ class MainGame():
 
     
 
+    def fast_forward_battle(self):
+        # skips the attack animations and the battle text, used by headless battle simulations
+        # the outcome is the same, the damage is dealt by the timeline callbacks
+        self.B_player.fast_forward()
+        self.B_enemy.fast_forward()
+        if len(self.text_list) != 0:
+            self.text_delay = self.ticks - 1501
+
     def tally(self, maxdmg_enemy, maxdmg_player, target):
         # triggered by BattlePlayer/BattleEnemy classes after their animations end
         if not self.drinking_potion: # check if the player is NOT drinking a potion
@@ -379,7 +789,7 @@ class MainGame():
 
     def animate_text(self, damage, text_type):
         # adds text objects into text list
-        self.text_delay = pygame.time.get_ticks()
+        self.text_delay = self.ticks
         colour = (200,0,0) # red text
 
         # text types: 0-player damaged, 1-enemy damaged, 2-critical hit player, 3-critical hit enemy, 4-potion, 5-victory text
@@ -413,10 +823,1304 @@ class Text():
         self.size = size
         self.coords = coords
 
+class InputLog():
+    # binary log of a play session, used for recording and replaying
+    # header: magic, version, AI seed, battle seed
+    # records: frame, event kind (0 = key down, 1 = key up, 2 = quit, 3 = end of session), key (end of session: state checksum)
+    header_format = struct.Struct("<5sBQQ")
+    record_format = struct.Struct("<IBI")
+    event_kinds = [pygame.KEYDOWN, pygame.KEYUP, pygame.QUIT]
+    END = 3
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.ai_seed = 0
+        self.battle_seed = 0
+        self.events = {} # frame -> list of events, only used when replaying
+        self.no_events = []
+        self.last_frame = 0
+        self.checksum = None
+
+    def start_recording(self, ai_seed, battle_seed):
+        self.file = open(self.filename, "wb")
+        self.file.write(self.header_format.pack(b"KKLOG", 1, ai_seed, battle_seed))
+
+    def record(self, frame, event):
+        key = getattr(event, "key", 0) # quit events don't have a key
+        self.file.write(self.record_format.pack(frame, self.event_kinds.index(event.type), key))
+
+    def stop_recording(self, frame, checksum):
+        self.file.write(self.record_format.pack(frame, self.END, checksum))
+        self.file.close()
+
+    def load(self):
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        magic, version, self.ai_seed, self.battle_seed = self.header_format.unpack_from(data, 0)
+        if magic != b"KKLOG" or version != 1:
+            raise ValueError(self.filename + " isn't a Kastles and Krakens input log")
+        for frame, kind, key in self.record_format.iter_unpack(data[self.header_format.size:]):
+            self.last_frame = max(self.last_frame, frame)
+            if kind == self.END:
+                self.checksum = key
+            else:
+                event = pygame.event.Event(self.event_kinds[kind], key=key, mod=0, unicode="", scancode=0)
+                self.events.setdefault(frame, []).append(event)
+
+    def get_events(self, frame):
+        # returns a new list, get_events might add the wake-up event to it
+        return list(self.events.get(frame, self.no_events))
+
+class SaveFile():
+    # binary save file (--save), written incrementally on a background thread so saving never holds up a frame
+    # the file is a log: every save appends the rooms that changed since the last save and ends with a state record,
+    # when the file is read back, newer records of a room replace the older ones
+    # every state record contains a checksum of its save, a save that was cut off halfway (crash, power loss) is ignored
+    # once the file is compact_ratio times bigger than the saved data, it's rewritten with only the newest records
+    # header: magic, version
+    # records: dead enemies of a visited room, simulated enemies of a room, game state
+    header_format = struct.Struct("<5sB")
+    dead_format = struct.Struct("<BiiI") # kind, room x, room y, number of dead enemies (followed by their ids)
+    id_format = struct.Struct("<i")
+    sim_format = struct.Struct("<BiiIi") # kind, room x, room y, number of enemies, ms since the room was simulated (followed by enemy rows)
+    row_format = struct.Struct("<i10d") # enemy id + RoomSimulation enemy
+    state_format = struct.Struct("<BiiddiiI") # kind, room x, room y, player x, player y, player health, enemy count, crc32 of the save
+    DEAD = 0
+    SIM = 1
+    STATE = 2
+    compact_ratio = 4
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.saved = {} # (kind, x, y) -> what the record looked like last time, only changed rooms are saved again
+        self.records = {} # (kind, x, y) -> newest record, only used by the writer thread once it's running
+        self.state_record = None
+        self.file_size = 0
+        self.queue = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.error = None # exception raised on the writer thread, re-raised by save
+
+    def load(self):
+        # returns [state, dead enemies, simulated rooms] from the last complete save, None = nothing has been saved yet
+        # state = [room x, room y, player x, player y, player health, enemy count]
+        # dead enemies = {(x, y): [enemy ids]}, simulated rooms = {(x, y): [ms since the room was simulated, {enemy id: enemy}]}
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        if len(data) < self.header_format.size:
+            return None # the game stopped before the header was written, the writer starts the file again
+        magic, version = self.header_format.unpack_from(data, 0)
+        if magic != b"KKSAV" or version != 1:
+            raise ValueError(self.filename + " isn't a Kastles and Krakens save file")
+        state = None
+        pos = self.header_format.size
+        batch_start = pos
+        batch = {} # records of the save that is being read
+        while pos < len(data):
+            kind = data[pos]
+            start = pos
+            try:
+                if kind == self.DEAD:
+                    kind, x, y, count = self.dead_format.unpack_from(data, pos)
+                    pos += self.dead_format.size + count*self.id_format.size
+                elif kind == self.SIM:
+                    kind, x, y, count, age = self.sim_format.unpack_from(data, pos)
+                    pos += self.sim_format.size + count*self.row_format.size
+                elif kind == self.STATE:
+                    kind, x, y, player_x, player_y, health, enemy_count, crc = self.state_format.unpack_from(data, pos)
+                    pos += self.state_format.size
+                else:
+                    break # garbage at the end of the file
+            except struct.error:
+                break # the last record was cut off
+            if pos > len(data):
+                break
+            if kind != self.STATE:
+                batch[(kind, x, y)] = data[start:pos]
+                continue
+            if zlib.crc32(data[batch_start:start]) != crc:
+                break
+            self.records.update(batch)
+            self.state_record = data[start:pos]
+            state = [x, y, player_x, player_y, health, enemy_count]
+            batch = {}
+            batch_start = pos
+        self.file_size = batch_start # anything after the last complete save is cut off when the writer starts
+        if state == None:
+            return None
+
+        dead = {}
+        sims = {}
+        for (kind, x, y), record in self.records.items():
+            if kind == self.DEAD:
+                dead[(x, y)] = [i[0] for i in self.id_format.iter_unpack(record[self.dead_format.size:])]
+            else:
+                age = self.sim_format.unpack_from(record, 0)[4]
+                enemies = {}
+                for row in self.row_format.iter_unpack(record[self.sim_format.size:]):
+                    enemies[row[0]] = list(row[1:])
+                sims[(x, y)] = [age, enemies]
+            self.saved[(kind, x, y)] = None # unknown, saved again the first time
+        return [state, dead, sims]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="save", daemon=True)
+        self.thread.start()
+
+    def save(self, game):
+        # packs everything that changed since the last save and hands it over to the writer thread
+        # only works while roaming, battles are saved once they're over
+        if self.error != None:
+            raise self.error
+        now = game.ticks
+        world = game.world
+        records = []
+        for key, room in world.rooms.items():
+            if self.saved.get((self.DEAD,) + key, len(world.get_enemy_list(key[0], key[1]))) == len(room.enemy_list):
+                continue # nobody died since the last save
+            self.saved[(self.DEAD,) + key] = len(room.enemy_list)
+            alive = set(i[6] for i in room.enemy_list)
+            dead = [i[6] for i in world.get_enemy_list(key[0], key[1]) if i[6] not in alive]
+            records.append([(self.DEAD,) + key, self.dead_format.pack(self.DEAD, key[0], key[1], len(dead)) + b"".join(self.id_format.pack(i) for i in dead)])
+        cur_key = (game.prev_ow_posX, game.prev_ow_posY) # room whose enemies are sprites, (None, None) before the first frame
+        for key, room in game.simulation.rooms.items():
+            if key == cur_key:
+                enemies = self.get_sprite_rows(game, room)
+                age = 0
+            elif self.saved.get((self.SIM,) + key) == room.sim_time:
+                continue
+            else:
+                enemies = room.enemies
+                age = now - room.sim_time
+                self.saved[(self.SIM,) + key] = room.sim_time
+            records.append(self.sim_record(key, enemies, age))
+        pool = game.simulation.pool
+        if pool != None:
+            # rooms the worker processes are simulating (--sim-workers), their rows are read from the shared memory array
+            pool.wait()
+            for key in pool.rooms:
+                if key in game.simulation.rooms:
+                    continue # the main process has its own copy, saved above
+                enemies, sim_time = pool.get_enemies(key)
+                if self.saved.get((self.SIM,) + key) == sim_time:
+                    continue
+                self.saved[(self.SIM,) + key] = sim_time
+                records.append(self.sim_record(key, enemies, now - sim_time))
+        batch = b"".join(i[1] for i in records)
+        player = game.player
+        state = self.state_format.pack(self.STATE, game.ow_posX, game.ow_posY, player.position_x, player.position_y, game.player_health, game.enemy_count, zlib.crc32(batch))
+        with self.condition:
+            self.queue.append([records, state])
+            self.condition.notify()
+
+    def sim_record(self, key, enemies, age):
+        rows = b"".join(self.row_format.pack(id, *enemy) for id, enemy in enemies.items())
+        return [(self.SIM,) + key, self.sim_format.pack(self.SIM, key[0], key[1], len(enemies), age) + rows]
+
+    def get_sprite_rows(self, game, room):
+        # the enemies of the current room are Enemy sprites, sleeping enemies haven't counted their sleep into wander_time yet
+        enemies = {}
+        for sprite in game.game_sprites:
+            if not isinstance(sprite, Enemy) or not sprite.alive or sprite.id not in room.enemies:
+                continue
+            wander_time = sprite.wander_time
+            if sprite in game.game_sprites.sleeping:
+                wander_time += (game.ticks - sprite.sleep_start)/1000
+            enemies[sprite.id] = room.sprite_row(sprite, wander_time)
+        return enemies
+
+    def close(self):
+        # waits until every queued save is written
+        if self.thread == None:
+            return
+        with self.condition:
+            self.queue.append(None)
+            self.condition.notify()
+        self.thread.join()
+        self.thread = None
+        if self.error != None:
+            raise self.error
+
+    def run(self):
+        try:
+            if self.file_size == 0:
+                with open(self.filename, "wb") as f:
+                    f.write(self.header_format.pack(b"KKSAV", 1))
+                self.file_size = self.header_format.size
+            file = open(self.filename, "r+b")
+            file.truncate(self.file_size)
+            file.seek(self.file_size)
+            while True:
+                with self.condition:
+                    while not self.queue:
+                        self.condition.wait()
+                    item = self.queue.pop(0)
+                if item == None:
+                    break
+                records, state = item
+                for key, record in records:
+                    file.write(record)
+                    self.file_size += len(record)
+                    self.records[key] = record
+                file.write(state)
+                self.file_size += len(state)
+                self.state_record = state
+                file.flush()
+                os.fsync(file.fileno()) # the save is only complete once it's on the disk
+                if self.file_size > self.compact_ratio*(sum(len(i) for i in self.records.values()) + len(state)):
+                    file.close()
+                    self.compact()
+                    file = open(self.filename, "r+b")
+                    file.seek(self.file_size)
+            file.close()
+        except Exception as error:
+            self.error = error
+
+    def compact(self):
+        # rewrites the file with the newest record of every room, as a single save
+        batch = b"".join(self.records.values())
+        state = list(self.state_format.unpack(self.state_record))
+        state[-1] = zlib.crc32(batch)
+        state_record = self.state_format.pack(*state)
+        temp = self.filename + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(self.header_format.pack(b"KKSAV", 1))
+            f.write(batch)
+            f.write(state_record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.filename) # the old file stays until the new one is complete
+        self.state_record = state_record
+        self.file_size = self.header_format.size + len(batch) + len(state_record)
+
+class CoopHost():
+    # two-player co-op (--host ADDRESS:PORT): this process runs the world, the enemy AI and the battles, a second process (--join) controls the partner
+    # the client sends its keys every frame, the host sends a snapshot of the current room over UDP tick_rate times per second
+    # snapshots are deltas: only the fields (x, y, frame) that changed since the last snapshot the client acknowledged are sent,
+    # so enemies standing at home cost nothing, no matter how many of them are in the room
+    # every input packet acknowledges the newest snapshot the client has, a lost snapshot is simply covered by the next delta
+    tick_rate = 20 # snapshots per second
+    history_size = 32 # snapshots the host and the client keep as possible bases for a delta
+    input_format = struct.Struct("<4sIB") # magic, acknowledged tick, keys (bits: W, A, S, D, 16 = the client is leaving)
+    header_format = struct.Struct("<4sIIiiBHHH") # magic, tick, base tick (0 = full snapshot), room x, room y, roaming, enemies left, changed, removed
+    entity_format = struct.Struct("<iB") # id, changed fields (bits: x, y, frame, 8 = x and y are small steps from the base)
+    field_formats = [struct.Struct("<i"), struct.Struct("<i"), struct.Struct("<B")]
+    step_format = struct.Struct("<b") # x/y minus the base's x/y, walking enemies move a few pixels per tick
+    removed_format = struct.Struct("<i")
+    HOST = -1 # entity ids of both players, enemies use their id from the room file
+    PARTNER = -2
+
+    def __init__(self, game, address):
+        self.game = game
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.socket.setblocking(False)
+        self.client = None # address of the client, only one partner can join
+        self.partner = None # RemotePlayer
+        self.last_input = 0 # ticks
+        self.tick = 0
+        self.last_send = 0 # ticks
+        self.ack = 0 # newest tick the client has
+        self.history = {} # tick -> [room, {id: (x, y, frame)}]
+        self.frame_tables = {} # sprite -> {frame: position in the sprite's frame lists}, the client has the same frame lists
+        self.bytes_sent = 0
+        self.snapshots_sent = 0
+
+    def receive(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(64)
+            except BlockingIOError:
+                break
+            except ConnectionError: # the client is gone, some systems report it here
+                continue
+            if len(data) != self.input_format.size:
+                continue
+            magic, ack, keys = self.input_format.unpack(data)
+            if magic != b"KKCI" or (self.client != None and address != self.client):
+                continue
+            if keys & 16:
+                self.leave()
+                continue
+            if self.client == None:
+                self.join(address)
+            self.last_input = self.game.ticks
+            self.ack = max(self.ack, ack)
+            self.partner.keys = (bool(keys & 1), bool(keys & 2), bool(keys & 4), bool(keys & 8))
+        if self.client != None and self.game.ticks - self.last_input > 2000:
+            print("co-op partner timed out")
+            self.leave() # no input for a while, the client crashed or lost the connection, a restarted client can join again
+
+    def join(self, address):
+        print("co-op partner joined from %s:%d" % address)
+        self.client = address
+        self.ack = 0
+        self.partner = RemotePlayer(self.game, "player", self.game.player.position_x, self.game.player.position_y, 0, 4)
+        self.game.game_sprites.add(self.partner)
+        self.game.redraw = True
+
+    def leave(self):
+        if self.client == None:
+            return
+        print("co-op partner left")
+        self.partner.kill()
+        self.partner = None
+        self.client = None
+        self.game.redraw = True
+
+    def enter_room(self):
+        # the partner starts where the host entered the room
+        if self.partner == None:
+            return
+        self.partner.position_x = self.game.player.position_x
+        self.partner.position_y = self.game.player.position_y
+        self.partner.rect.topleft = (int(self.partner.position_x), int(self.partner.position_y))
+        self.game.game_sprites.add(self.partner)
+        self.frame_tables.clear() # the enemies of the old room are gone
+
+    def touches_partner(self, rect):
+        return self.partner != None and rect.colliderect(self.partner.rect)
+
+    def check_for_battle(self):
+        # the partner starts a battle with any enemy it touches, the host's player still does the fighting
+        # Enemy.check_for_collision only runs for enemies that are chasing the host, so every enemy in the room is checked here
+        if self.partner == None:
+            return
+        rect = self.partner.rect
+        for sprite in self.game.game_sprites:
+            if isinstance(sprite, Enemy) and sprite.alive and rect.colliderect(sprite.rect):
+                self.game.trigger_battle_phase(sprite)
+                return
+
+    def frame_index(self, sprite):
+        table = self.frame_tables.get(sprite)
+        if table == None:
+            table = {}
+            frames = [frame for framelist in sprite.frame_lists for frame in framelist]
+            for pos, frame in enumerate(frames):
+                table.setdefault(frame, pos) # the atlas can share a frame between lists, the image is the same either way
+            self.frame_tables[sprite] = table
+        return table.get(getattr(sprite, "base_sprite", None), 0) # enemies that haven't been updated yet show their first frame
+
+    def get_state(self):
+        state = {}
+        for sprite in self.game.game_sprites.drawn_list: # hidden enemies are removed on the client
+            if sprite is self.game.player:
+                id = self.HOST
+            elif sprite is self.partner:
+                id = self.PARTNER
+            else:
+                id = sprite.id
+            state[id] = (sprite.rect.x, sprite.rect.y, self.frame_index(sprite))
+        return state
+
+    def send(self):
+        interval = 1000/self.tick_rate
+        if self.client == None or self.game.ticks - self.last_send < interval:
+            return
+        # snapshots are sent every interval ms on average, setting last_send to the current time would add up to a frame to every tick
+        self.last_send += interval
+        if self.game.ticks - self.last_send >= interval:
+            self.last_send = self.game.ticks # more than a tick behind (a long frame, the first snapshot), no burst of snapshots
+        self.tick += 1
+        room = (self.game.ow_posX, self.game.ow_posY)
+        state = self.get_state()
+        base = self.history.get(self.ack)
+        if base == None or base[0] != room: # the client has nothing to compare against
+            base_tick = 0
+            base_state = {}
+        else:
+            base_tick = self.ack
+            base_state = base[1]
+        self.history[self.tick] = [room, state]
+        self.history.pop(self.tick - self.history_size, None)
+
+        records = bytearray()
+        changed = 0
+        for id, fields in state.items():
+            old = base_state.get(id)
+            mask = 0
+            for pos in range(3):
+                if old == None or old[pos] != fields[pos]:
+                    mask |= 1 << pos
+            if mask:
+                changed += 1
+                if old != None and -128 <= fields[0] - old[0] < 128 and -128 <= fields[1] - old[1] < 128:
+                    mask |= 8
+                records += self.entity_format.pack(id, mask)
+                for pos in range(3):
+                    if not mask & (1 << pos):
+                        continue
+                    if pos < 2 and mask & 8:
+                        records += self.step_format.pack(fields[pos] - old[pos])
+                    else:
+                        records += self.field_formats[pos].pack(fields[pos])
+        removed = [id for id in base_state if id not in state]
+        for id in removed:
+            records += self.removed_format.pack(id)
+        header = self.header_format.pack(b"KKCS", self.tick, base_tick, room[0], room[1], self.game.roaming, self.game.enemy_count, changed, len(removed))
+        try:
+            self.bytes_sent += self.socket.sendto(header + records, self.client)
+            self.snapshots_sent += 1
+        except OSError: # the client's socket is closed, it stops acknowledging and gets a full snapshot once it's back
+            pass
+
+    def close(self):
+        if self.snapshots_sent:
+            print("co-op: %d snapshots, %.1f bytes per snapshot, %.2f KB/s" % (self.snapshots_sent, self.bytes_sent/self.snapshots_sent,
+                                                                            self.bytes_sent/self.snapshots_sent*self.tick_rate/1024))
+        self.socket.close()
+
+class CoopClient():
+    # the partner's side of co-op (--join ADDRESS:PORT), replaces the game loop
+    # nothing is simulated here: the client sends its keys, rebuilds the room from the host's snapshots and draws it
+    # positions are interpolated between the last two snapshots, the partner moves smoothly even though snapshots only arrive tick_rate times per second
+    def __init__(self, game, address):
+        self.game = game
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect(address)
+        self.socket.setblocking(False)
+        self.history = {} # tick -> [room, {id: (x, y, frame)}], same as CoopHost.history
+        self.latest = 0 # newest tick
+        self.room = None
+        self.roaming = True
+        self.state = {} # newest snapshot
+        self.prev_state = {} # snapshot before it, positions are interpolated from here
+        self.arrival = 0 # ticks, when the newest snapshot arrived
+        self.sprites = {} # id -> sprite, only used for its frames
+        self.frame_lists = {} # sprite -> every frame in the same order CoopHost.frame_index uses
+        self.host_player = Player(game, "player", 0, 0, 0, 4)
+        self.battle_text = game.medium_font.render("Battle!", True, (200,200,0))
+        for bindings in game.bindings.values():
+            bindings.pop((pygame.KEYDOWN, pygame.K_F5), None) # run never calls run_frame, a capture would never record anything
+        pygame.display.set_caption("Kastles and Krakens (co-op)")
+
+    def run(self):
+        game = self.game
+        timer = game.frame_timer
+        while game.running:
+            game.clock.tick(game.fps_limit)
+            timer.start_frame()
+            game.get_dt()
+            game.get_events() # only the roaming bindings are ever used, battles happen on the host
+            self.send_input(False)
+            self.receive()
+            timer.mark("get_events")
+            self.draw()
+            timer.mark("draw")
+            pygame.display.flip()
+            timer.mark("flip")
+            timer.end_frame()
+        self.send_input(True)
+        self.socket.close()
+
+    def send_input(self, leaving):
+        game = self.game
+        keys = game.key_w | game.key_a << 1 | game.key_s << 2 | game.key_d << 3 | leaving << 4
+        try:
+            self.socket.send(CoopHost.input_format.pack(b"KKCI", self.latest, keys))
+        except OSError: # the host isn't running (yet), keep trying
+            pass
+
+    def receive(self):
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except BlockingIOError:
+                break
+            except ConnectionError:
+                continue
+            self.read_snapshot(data)
+
+    def read_snapshot(self, data):
+        header = CoopHost.header_format
+        magic, tick, base_tick, room_x, room_y, roaming, enemy_count, changed, removed = header.unpack_from(data, 0)
+        if magic != b"KKCS" or tick <= self.latest: # UDP packets can arrive late or twice
+            return
+        if base_tick == 0:
+            state = {}
+        elif base_tick in self.history:
+            state = dict(self.history[base_tick][1])
+        else:
+            return # the base is too old, the host sends a full snapshot once it sees the acknowledgement isn't moving
+        pos = header.size
+        for i in range(changed):
+            id, mask = CoopHost.entity_format.unpack_from(data, pos)
+            pos += CoopHost.entity_format.size
+            fields = list(state.get(id, (0, 0, 0)))
+            for field, field_format in enumerate(CoopHost.field_formats):
+                if not mask & (1 << field):
+                    continue
+                if field < 2 and mask & 8:
+                    fields[field] += CoopHost.step_format.unpack_from(data, pos)[0]
+                    pos += CoopHost.step_format.size
+                else:
+                    fields[field] = field_format.unpack_from(data, pos)[0]
+                    pos += field_format.size
+            state[id] = tuple(fields)
+        for i in range(removed):
+            state.pop(CoopHost.removed_format.unpack_from(data, pos)[0], None)
+            pos += CoopHost.removed_format.size
+        room = (room_x, room_y)
+        self.history[tick] = [room, state]
+        self.history.pop(tick - CoopHost.history_size, None)
+        self.latest = tick
+        if room != self.room:
+            self.enter_room(room)
+            self.prev_state = state # no interpolation between two rooms
+        else:
+            self.prev_state = self.state
+        self.state = state
+        self.arrival = self.game.ticks
+        self.roaming = roaming
+        self.game.enemy_count = enemy_count
+
+    def enter_room(self, room):
+        game = self.game
+        self.room = room
+        game.ow_posX, game.ow_posY = room
+        game.cur_room = game.world.get_room(room[0], room[1])
+        game.cur_map = game.cur_room.map
+        self.sprites = {CoopHost.HOST: self.host_player, CoopHost.PARTNER: game.player}
+        for enemy in game.cur_room.enemy_list: # the client has the same room files, only the enemies' frames are needed
+            self.sprites[enemy[6]] = game.create_enemy(enemy)
+        self.frame_lists = {}
+
+    def get_frames(self, sprite):
+        frames = self.frame_lists.get(sprite)
+        if frames == None:
+            frames = [frame for framelist in sprite.frame_lists for frame in framelist]
+            self.frame_lists[sprite] = frames
+        return frames
+
+    def draw(self):
+        game = self.game
+        screen = game.main_screen
+        if self.room == None: # nothing from the host yet
+            screen.fill((0,0,0))
+            return
+        alpha = min((game.ticks - self.arrival)/(1000/CoopHost.tick_rate), 1)
+        drawn = []
+        for id, (x, y, frame) in self.state.items():
+            sprite = self.sprites.get(id)
+            if sprite == None:
+                continue
+            prev = self.prev_state.get(id)
+            if prev != None:
+                x = prev[0] + (x - prev[0])*alpha
+                y = prev[1] + (y - prev[1])*alpha
+            sprite.rect.x = int(x)
+            sprite.rect.y = int(y)
+            frames = self.get_frames(sprite)
+            sprite.image = sprite.scale_frame(frames[min(frame, len(frames)-1)])
+            drawn.append(sprite)
+        game.camera.update(game.cur_map, game.player.rect) # the camera follows the partner
+        game.cur_map.draw_view(screen, game.camera)
+        game.draw_victory_banner()
+        drawn.sort(key=lambda sprite: isinstance(sprite, Player)) # players on top of the enemies
+        screen.blits([(sprite.image, (sprite.rect.x - game.camera.x, sprite.rect.y - game.camera.y)) for sprite in drawn], doreturn=False)
+        if not self.roaming: # the host is fighting
+            screen.blit(self.battle_text, (game.game_WIDTH//2 - self.battle_text.get_width()//2, 150))
+        game.frame_timer.draw_overlay(screen)
+
+class SpriteGroup(pygame.sprite.Group):
+    # pygame's Group creates a new list of sprites every time it's updated, drawn or iterated over
+    # this group keeps its lists and only rebuilds them when a sprite is added, removed, put to sleep or woken up
+    # sleeping sprites stay in the group, but they aren't updated (and hidden sleeping sprites aren't drawn either),
+    # they're woken up by a timer or explicitly by whatever needs them (see sleep and wake)
+    def __init__(self, *sprites):
+        self.sprite_list = [] # every sprite
+        self.awake_list = [] # sprites that are updated every frame
+        self.drawn_list = [] # sprites that are drawn, sleeping sprites are still drawn unless they're hidden
+        self.sleeping = {} # sprite -> True if it's still drawn while it sleeps
+        self.sleep_until = {} # sprite -> time (ticks) it wakes up at, sprites without a timer sleep until they're woken up
+        self.wake_queue = [] # heap of [time, order, sprite], entries of sprites that were woken up early are skipped
+        self.wake_order = 0
+        self.redraw = False # a hidden sprite fell asleep or woke up, the screen has to be drawn again
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.update_lists()
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.sleeping.pop(sprite, None)
+        self.sleep_until.pop(sprite, None)
+        self.update_lists() # new lists, so that sprites can kill themselves during update()
+
+    def update_lists(self):
+        self.sprite_list = list(self.spritedict)
+        if not self.sleeping:
+            self.awake_list = self.sprite_list
+            self.drawn_list = self.sprite_list
+            return
+        self.awake_list = [i for i in self.sprite_list if i not in self.sleeping]
+        self.drawn_list = [i for i in self.sprite_list if self.sleeping.get(i, True)]
+
+    def __iter__(self):
+        return iter(self.sprite_list)
+
+    def sleep(self, sprite, until=None, visible=True):
+        # the sprite stops being updated until the time until (ticks) or until wake is called
+        # visible=False also stops drawing it, for sprites that are off the screen anyway
+        self.sleeping[sprite] = visible
+        if not visible:
+            self.redraw = True
+        if until != None:
+            self.sleep_until[sprite] = until
+            heapq.heappush(self.wake_queue, [until, self.wake_order, sprite])
+            self.wake_order += 1
+        self.update_lists()
+
+    def wake(self, sprite, now):
+        if sprite not in self.sleeping:
+            return
+        if not self.sleeping.pop(sprite):
+            self.redraw = True
+        self.sleep_until.pop(sprite, None)
+        self.update_lists()
+        sprite.wake_up(now)
+
+    def wake_sleepers(self, now):
+        # wakes up every sprite whose timer ran out, only looks at the sprites that are due
+        queue = self.wake_queue
+        while queue and queue[0][0] <= now:
+            until, order, sprite = heapq.heappop(queue)
+            if self.sleep_until.get(sprite) == until: # the sprite wasn't woken up early or put back to sleep with a different timer
+                self.wake(sprite, now)
+
+    def wake_all(self, now):
+        for sprite in list(self.sleeping):
+            self.wake(sprite, now)
+
+    def next_wake(self):
+        # time of the next timer, None = no sprite is waiting for one
+        while self.wake_queue and self.sleep_until.get(self.wake_queue[0][2]) != self.wake_queue[0][0]:
+            heapq.heappop(self.wake_queue) # stale entry
+        if self.wake_queue:
+            return self.wake_queue[0][0]
+        return None
+
+    def sleepers(self):
+        return list(self.sleeping)
+
+    def update(self):
+        for sprite in self.awake_list:
+            sprite.update()
+
+    def draw(self, surface, camera=None):
+        # sprites are positioned in room coordinates, the camera moves them into screen coordinates
+        if camera == None or (camera.x == 0 and camera.y == 0):
+            for sprite in self.drawn_list:
+                surface.blit(sprite.image, sprite.rect)
+        else:
+            x = -camera.x
+            y = -camera.y
+            for sprite in self.drawn_list:
+                surface.blit(sprite.image, sprite.rect.move(x, y))
+
+class DrawSnapshot():
+    # everything the render thread needs to draw one frame, created by MainGame.publish_frame and never changed afterwards
+    # background, banner, sprites, texts and game_over are tuples of (surface, screen position), drawn in that order
+    # background = the visible chunks of the room or the battle background, clear = the room doesn't cover the whole screen
+    # banner = the victory banner (if every enemy is dead), game_over = the game over screen (if the player is dead)
+    # overlay = the frame timing overlay (F3) or None, presses are the QTE key presses whose feedback is first shown in this frame, see InputLatency
+    def __init__(self, background, clear, banner, sprites, texts, game_over, overlay, presses):
+        self.background = background
+        self.clear = clear
+        self.banner = banner
+        self.sprites = sprites
+        self.texts = texts
+        self.game_over = game_over
+        self.overlay = overlay
+        self.presses = presses
+
+class RenderThread():
+    # draws and flips frames on its own thread, the simulation only publishes a snapshot of what should be drawn (--render-thread)
+    # only the latest snapshot is kept, if the simulation publishes faster than the screen can flip, older frames are dropped
+    # (drop_frames = False makes publish wait for the previous frame instead, every frame is drawn, used by the benchmarks)
+    # pygame releases the GIL while it blits and flips, so drawing one frame overlaps with simulating the next one
+    # the thread only blits the surfaces in the snapshot, it never reads the game state or touches a TileMap
+    # events are still handled on the main thread, SDL only lets the thread that created the window read them
+    # flipping the window from another thread only works on some SDL backends (Windows, X11, the dummy driver),
+    # macOS doesn't allow any window updates outside the main thread, --render-thread doesn't work there
+    def __init__(self, game):
+        self.game = game
+        self.snapshot = None # latest snapshot that hasn't been drawn yet
+        self.condition = threading.Condition()
+        self.running = True
+        self.error = None # exception raised on the render thread, re-raised on the main thread by publish
+        self.frames_drawn = 0
+        self.frames_dropped = 0
+        self.drop_frames = True
+        self.thread = threading.Thread(target=self.run, name="render", daemon=True)
+        self.thread.start()
+
+    def publish(self, snapshot):
+        if self.error != None:
+            raise self.error
+        with self.condition:
+            while self.snapshot != None and not self.drop_frames and self.error == None:
+                self.condition.wait() # the render thread hasn't picked up the previous frame yet
+            if self.snapshot != None:
+                self.frames_dropped += 1
+            self.snapshot = snapshot
+            self.condition.notify_all()
+
+    def stop(self):
+        # waits until the last published frame is drawn
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        if self.error != None:
+            raise self.error
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.snapshot == None and self.running:
+                        self.condition.wait()
+                    snapshot = self.snapshot
+                    self.snapshot = None
+                    self.condition.notify_all() # publish might be waiting for the snapshot to be picked up
+                if snapshot == None: # stopped and every frame is drawn
+                    return
+                self.draw(snapshot)
+                self.frames_drawn += 1
+        except Exception as error:
+            with self.condition:
+                self.error = error
+                self.condition.notify_all()
+
+    def draw(self, snapshot):
+        # same order as run_frame: background, banner, sprites, battle text, game over screen, timing overlay
+        screen = self.game.main_screen
+        if snapshot.clear:
+            screen.fill((0,0,0))
+        screen.blits(snapshot.background, doreturn=False)
+        screen.blits(snapshot.banner, doreturn=False)
+        screen.blits(snapshot.sprites, doreturn=False)
+        screen.blits(snapshot.texts, doreturn=False)
+        screen.blits(snapshot.game_over, doreturn=False)
+        if snapshot.overlay != None:
+            screen.blit(snapshot.overlay, (10,10))
+        pygame.display.flip()
+        self.game.input_latency.shown(snapshot.presses)
+
+class FrameTimer():
+    # measures how long every phase of the game loop takes using perf_counter_ns
+    # the last few hundred frames are kept in a ring buffer (fixed size lists + a moving index)
+    def __init__(self, game, buffer_size=600):
+        self.game = game
+        self.phases = ["get_events", "change_pos", "update", "simulation", "battle_loop", "background", "draw", "flip"]
+        self.phase_pos = {}
+        for pos, phase in enumerate(self.phases):
+            self.phase_pos[phase] = pos
+        self.buffer_size = buffer_size
+        self.phase_samples = [[0]*buffer_size for phase in self.phases] # nanoseconds
+        self.frame_samples = [0]*buffer_size # nanoseconds, sum of every phase
+        self.cur_samples = [0]*len(self.phases) # phase times of the frame that is currently running
+        self.buffer_pos = 0 # position of the next sample in the ring buffer
+        self.sample_count = 0 # amount of valid samples in the ring buffer
+
+        # a hitch is a frame that took longer than the 60FPS budget
+        self.hitch_limit = 1000000000//60
+        self.hitches_total = 0
+        self.frame_start = 0
+        self.last_mark = 0
+
+        # allocation counter, only runs with --count-allocations (sys.getallocatedblocks isn't free)
+        # blocks = change in allocated Python memory blocks, objects = change in objects tracked by the garbage collector
+        # a steady-state frame should show 0 objects, otherwise the garbage collector eventually kicks in
+        self.count_allocations = False
+        self.blocks_start = 0
+        self.objects_start = 0
+        self.alloc_frames = 0
+        self.alloc_blocks = [0, 0] # [sum, max]
+        self.alloc_objects = [0, 0]
+        self.gc_runs = 0 # collections that happened while the game loop was running
+
+        # overlay variables
+        self.visible = False
+        self.font = pygame.font.SysFont("consolas,couriernew,monospace", 16) # monospace font keeps the columns aligned
+        self.overlay = None
+        self.overlay_time = 0 # time (in ms) of the last overlay update
+
+    def start_frame(self):
+        if self.count_allocations:
+            self.blocks_start = sys.getallocatedblocks()
+            self.objects_start = gc.get_count()[0]
+        self.frame_start = t.perf_counter_ns()
+        self.last_mark = self.frame_start
+
+    def enable_allocation_counter(self):
+        self.count_allocations = True
+        gc.callbacks.append(self.count_gc_run)
+
+    def count_gc_run(self, phase, info):
+        if phase == "start":
+            self.gc_runs += 1
+
+    def count_frame_allocations(self):
+        blocks = sys.getallocatedblocks() - self.blocks_start
+        objects = gc.get_count()[0] - self.objects_start
+        if objects < 0: # a collection happened during the frame, the counter was reset
+            objects = 0
+        self.alloc_frames += 1
+        for totals, value in ((self.alloc_blocks, blocks), (self.alloc_objects, objects)):
+            totals[0] += value
+            if value > totals[1]:
+                totals[1] = value
+
+    def allocation_summary(self):
+        frames = max(self.alloc_frames, 1)
+        return "allocations/frame: %.2f blocks (max %d), %.2f gc objects (max %d), gc runs: %d" % (
+            self.alloc_blocks[0]/frames, self.alloc_blocks[1], self.alloc_objects[0]/frames, self.alloc_objects[1], self.gc_runs)
+
+    def mark(self, phase):
+        # adds the time since the last mark to the given phase
+        now = t.perf_counter_ns()
+        self.cur_samples[self.phase_pos[phase]] += now - self.last_mark
+        if tracer.enabled:
+            tracer.add_span(phase, "frame", self.last_mark, now)
+        self.last_mark = now
+
+    def end_frame(self):
+        # moves the current frame into the ring buffer
+        frame_time = self.last_mark - self.frame_start
+        if self.count_allocations:
+            self.count_frame_allocations()
+        if tracer.enabled:
+            tracer.add_span("game_loop", "frame", self.frame_start, self.last_mark)
+        pos = self.buffer_pos
+        for phase_pos in range(len(self.phases)):
+            self.phase_samples[phase_pos][pos] = self.cur_samples[phase_pos]
+            self.cur_samples[phase_pos] = 0
+        self.frame_samples[pos] = frame_time
+        if frame_time > self.hitch_limit:
+            self.hitches_total += 1
+        self.buffer_pos = (pos + 1) % self.buffer_size
+        if self.sample_count < self.buffer_size:
+            self.sample_count += 1
+
+        if self.visible:
+            now = pygame.time.get_ticks()
+            if now - self.overlay_time > 500: # text is rendered twice a second, rendering it every frame would skew the results
+                self.overlay_time = now
+                self.render_overlay()
+                self.game.redraw = True # the new numbers have to be drawn, even if the game is idle
+
+    def percentiles(self, samples, count=None):
+        # returns p50/p95/p99/max of the first count samples, by default the valid samples in the ring buffer (nearest-rank method)
+        if count == None:
+            count = self.sample_count
+        valid = sorted(samples[:count])
+        if len(valid) == 0:
+            return [0, 0, 0, 0]
+        result = []
+        for p in (50, 95, 99):
+            rank = max(m.ceil(p/100*len(valid)) - 1, 0)
+            result.append(valid[rank])
+        result.append(valid[-1])
+        return result
+
+    def count_hitches(self):
+        # hitches in the ring buffer, hitches_total counts every hitch since the game started
+        hitches = 0
+        for frame_time in self.frame_samples[:self.sample_count]:
+            if frame_time > self.hitch_limit:
+                hitches += 1
+        return hitches
+
+    def get_stats(self):
+        # returns a list of rows: name, p50, p95, p99, max (all in milliseconds)
+        rows = []
+        stats = self.percentiles(self.frame_samples)
+        rows.append(["frame"] + [i/1000000 for i in stats])
+        for phase_pos, phase in enumerate(self.phases):
+            stats = self.percentiles(self.phase_samples[phase_pos])
+            rows.append([phase] + [i/1000000 for i in stats])
+        return rows + self.game.input_latency.get_stats()
+
+    def toggle_overlay(self):
+        self.visible = not self.visible
+        self.overlay_time = 0 # forces the overlay to render on the next frame
+        self.game.redraw = True
+
+    def render_overlay(self):
+        lines = ["%-11s %6s %6s %6s %6s" % ("ms", "p50", "p95", "p99", "max")]
+        for row in self.get_stats():
+            lines.append("%-11s %6.2f %6.2f %6.2f %6.2f" % tuple(row))
+        lines.append("hitches: %d (last %d frames), %d total" % (self.count_hitches(), self.sample_count, self.hitches_total))
+        if self.count_allocations:
+            lines.append(self.allocation_summary())
+        line_height = self.font.get_linesize()
+        self.overlay = pygame.Surface((720 if self.count_allocations else 360, line_height*len(lines) + 10))
+        self.overlay.set_alpha(200) # slightly see-through background
+        for pos, line in enumerate(lines):
+            text = self.font.render(line, True, (255,255,255))
+            self.overlay.blit(text, (5, 5 + pos*line_height))
+
+    def get_overlay(self):
+        # the overlay surface if it's shown, None otherwise
+        # render_overlay always creates a new surface, so an old one can still be drawn by the render thread
+        if self.visible:
+            return self.overlay
+        return None
+
+    def draw_overlay(self, surface):
+        if self.visible and self.overlay != None:
+            surface.blit(self.overlay, (10,10))
+
+    def write_csv(self, filename):
+        # dumps the statistics into a .csv file
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["phase", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+            for row in self.get_stats():
+                writer.writerow([row[0]] + ["%.3f" % i for i in row[1:]])
+            writer.writerow([])
+            writer.writerow(["frames", self.sample_count])
+            writer.writerow(["hitches", self.count_hitches()])
+            writer.writerow(["hitches_total", self.hitches_total])
+            if self.count_allocations:
+                frames = max(self.alloc_frames, 1)
+                writer.writerow(["alloc_blocks_per_frame", "%.3f" % (self.alloc_blocks[0]/frames), "max", self.alloc_blocks[1]])
+                writer.writerow(["alloc_gc_objects_per_frame", "%.3f" % (self.alloc_objects[0]/frames), "max", self.alloc_objects[1]])
+                writer.writerow(["gc_runs", self.gc_runs])
+
+class InputLatency():
+    # measures the time from a QTE key press until its feedback (green/red key, see BattleMenu.combo_feedback) is flipped onto the screen
+    # SDL events don't say when the key was pressed, the game only sees the key once get_events polls the queue, so every press gets two numbers:
+    # flip = poll -> flip (measured exactly), worst = previous poll -> flip (the key could have been pressed right after the previous poll)
+    # QTEs are only fair if both stay well below the time the player has between two keys
+    def __init__(self, game, buffer_size=200):
+        self.game = game
+        self.buffer_size = buffer_size
+        self.flip_samples = [0]*buffer_size # nanoseconds, ring buffer like FrameTimer
+        self.worst_samples = [0]*buffer_size
+        self.buffer_pos = 0
+        self.sample_count = 0
+        self.poll_time = 0 # perf_counter_ns of the last poll
+        self.prev_poll_time = 0
+        self.pending = [] # [poll time, previous poll time] of presses that aren't on the screen yet
+        self.lock = threading.Lock() # presses drawn by the render thread are added from that thread
+
+    def poll(self):
+        # called whenever the game reads events, including the event that wakes it up from the idle state
+        self.prev_poll_time = self.poll_time
+        self.poll_time = t.perf_counter_ns()
+
+    def press(self):
+        self.pending.append([self.poll_time, self.prev_poll_time or self.poll_time])
+
+    def take(self):
+        # hands the pending presses over to the frame that is about to be drawn
+        if not self.pending:
+            return ()
+        pending = self.pending
+        self.pending = []
+        return pending
+
+    def shown(self, presses):
+        if not presses:
+            return
+        now = t.perf_counter_ns()
+        with self.lock:
+            for poll_time, prev_poll_time in presses:
+                pos = self.buffer_pos
+                self.flip_samples[pos] = now - poll_time
+                self.worst_samples[pos] = now - prev_poll_time
+                self.buffer_pos = (pos + 1) % self.buffer_size
+                if self.sample_count < self.buffer_size:
+                    self.sample_count += 1
+
+    def get_stats(self):
+        # same rows as FrameTimer.get_stats, nothing until the first QTE key is pressed
+        if self.sample_count == 0:
+            return []
+        timer = self.game.frame_timer
+        with self.lock:
+            flip = timer.percentiles(self.flip_samples, self.sample_count)
+            worst = timer.percentiles(self.worst_samples, self.sample_count)
+        return [["qte_flip"] + [i/1000000 for i in flip], ["qte_worst"] + [i/1000000 for i in worst]]
+
+class FrameProfiler():
+    # F5 profiles the next few frames of the game loop with cProfile and writes them into a .pstats file (python -m pstats FILE, snakeviz, ...)
+    # the file name says where the frames came from: room, phase (roaming/battle) and how many sprites and enemies there were
+    # arming swaps run_frame for a profiled version until the capture is over, frames outside of a capture don't check anything
+    # only the main thread is profiled, frames drawn by the render thread (--render-thread) only show up as publish_frame
+    def __init__(self, game, frames=300, directory="profiles"):
+        self.game = game
+        self.frames = frames # frames per capture
+        self.directory = directory
+        self.profile = None # cProfile.Profile of the capture that is running
+        self.frames_left = 0
+        self.tags = ""
+
+    def arm(self):
+        if self.profile != None: # already capturing
+            return
+        game = self.game
+        if game.roaming:
+            self.tags = "frame%d_room%d_%d_roaming_%dsprites_%denemies" % (game.frame_count, game.ow_posX, game.ow_posY, len(game.game_sprites), game.enemy_count)
+        else:
+            self.tags = "frame%d_room%d_%d_battle_%dsprites_%denemies" % (game.frame_count, game.ow_posX, game.ow_posY, len(game.game_battle_sprites), game.enemy_count)
+        self.profile = cProfile.Profile()
+        self.frames_left = self.frames
+        game.run_frame = self.run_frame # instance attribute, hides MainGame.run_frame until the capture is over
+        print("profiling the next %d frames" % self.frames)
+
+    def run_frame(self):
+        self.profile.enable()
+        MainGame.run_frame(self.game)
+        self.profile.disable()
+        self.frames_left -= 1
+        if self.frames_left <= 0:
+            self.finish()
+
+    def finish(self):
+        del self.game.run_frame
+        os.makedirs(self.directory, exist_ok=True)
+        filename = os.path.join(self.directory, "%s_%s.pstats" % (t.strftime("%Y%m%d-%H%M%S"), self.tags)) # tags include the frame, two captures never share a name
+        self.profile.dump_stats(filename)
+        self.profile = None
+        print("profile of %d frames written into %s" % (self.frames - self.frames_left, filename))
+
+class Tracer():
+    # records spans (named blocks of time) and writes them in the Chrome trace-event format
+    # the resulting .json file can be opened in Perfetto (ui.perfetto.dev) or chrome://tracing
+    # disabled by default, every traced block checks self.enabled first so a disabled tracer costs next to nothing
+    # only the last max_events spans are kept (ring buffer), a long session would otherwise fill up the memory (about 8 spans per frame)
+    def __init__(self, filename=None, max_events=500000):
+        self.enabled = False
+        self.filename = None
+        self.events = [] # [name, category, start (ns), end (ns), args]
+        self.max_events = max_events
+        self.event_pos = 0 # position of the next span once the buffer is full
+        self.dropped = 0 # spans that were overwritten
+        self.start_time = t.perf_counter_ns()
+        self.null_span = NullSpan()
+        if filename:
+            self.start(filename)
+
+    def start(self, filename):
+        self.filename = filename
+        self.enabled = True
+
+    def add_span(self, name, category, start, end, args=None):
+        if len(self.events) < self.max_events:
+            self.events.append([name, category, start, end, args])
+            return
+        if self.dropped == 0:
+            print("trace: more than %d spans, only the newest ones are kept" % self.max_events)
+        self.events[self.event_pos] = [name, category, start, end, args]
+        self.event_pos = (self.event_pos + 1) % self.max_events
+        self.dropped += 1
+
+    def span(self, name, category, args=None):
+        # used with the "with" statement, times everything inside the block
+        if not self.enabled:
+            return self.null_span
+        return TraceSpan(self, name, category, args)
+
+    def write(self):
+        trace_events = []
+        pid = os.getpid()
+        events = self.events[self.event_pos:] + self.events[:self.event_pos] # oldest span first
+        for name, category, start, end, args in events:
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X", # complete event, contains both the start and the duration
+                "ts": (start - self.start_time)/1000, # microseconds
+                "dur": (end - start)/1000,
+                "pid": pid,
+                "tid": 1,
+            }
+            if args:
+                event["args"] = args
+            trace_events.append(event)
+        with open(self.filename, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+        if self.dropped:
+            print("trace: %d older spans were dropped" % self.dropped)
+
+class TraceSpan():
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = t.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.add_span(self.name, self.category, self.start, t.perf_counter_ns(), self.args)
+
+class NullSpan():
+    # stand-in for TraceSpan when tracing is disabled, does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+tracer = Tracer(os.environ.get("KK_TRACE")) # KK_TRACE=trace.json enables tracing without the --trace flag
+
+def python_memory():
+    # returns the amount of memory (in bytes) currently allocated by Python, 0 if tracemalloc isn't running
+    # assets compare the value before and after loading to find out how much Python memory they use
+    if not tracemalloc.is_tracing():
+        return 0
+    return tracemalloc.get_traced_memory()[0]
+
+def prepare_surface(surface):
+    # converts the surface into the pixel format of the screen, so blitting it doesn't have to convert every pixel again
+    # colorkeyed surfaces are run-length encoded (RLEACCEL), SDL then skips whole runs of transparent pixels instead of checking every pixel
+    # surfaces with per-pixel alpha keep it, they're only converted
+    if pygame.display.get_surface() == None:
+        return surface # nothing to convert to yet
+    if surface.get_flags() & pygame.SRCALPHA:
+        return surface.convert_alpha()
+    colorkey = surface.get_colorkey()
+    surface = surface.convert()
+    if colorkey != None:
+        surface.set_colorkey(colorkey, pygame.RLEACCEL)
+    return surface
+
+class SurfaceCheck():
+    # debug check for surfaces that are blitted every frame: every surface has to be in the pixel format of the screen,
+    # colorkeyed surfaces have to be run-length encoded and per-pixel alpha is flagged as well (see prepare_surface)
+    # every surface is only reported once
+    def __init__(self):
+        self.enabled = False
+        self.reported = set()
+        self.problems = 0
+
+    def find_problem(self, surface, screen):
+        if surface.get_bitsize() != screen.get_bitsize() or surface.get_masks()[:3] != screen.get_masks()[:3]:
+            return "%d-bit %s instead of the %d-bit screen format" % (surface.get_bitsize(), surface.get_masks(), screen.get_bitsize())
+        if surface.get_flags() & pygame.SRCALPHA:
+            return "per-pixel alpha"
+        if surface.get_colorkey() != None and not surface.get_flags() & (pygame.RLEACCEL | pygame.RLEACCELOK): # RLEACCELOK = encoded on the first blit
+            return "colorkey without RLEACCEL"
+        return None
+
+    def check(self, surface, owner, screen):
+        if id(surface) in self.reported:
+            return
+        problem = self.find_problem(surface, screen)
+        if problem:
+            self.reported.add(id(surface))
+            self.problems += 1
+            print("surface check: %dx%d surface of %s: %s" % (surface.get_width(), surface.get_height(), owner, problem))
+
+    def check_sprites(self, group, screen):
+        for sprite in group:
+            self.check(sprite.image, type(sprite).__name__, screen)
+
+surface_check = SurfaceCheck()
+
+class MemoryReport():
+    # attributes memory to every asset currently loaded in the game
+    # surface memory = pixel data of every Surface, python memory = objects allocated while loading (needs tracemalloc)
+    def __init__(self, game):
+        self.game = game
+
+    def surface_bytes(self, surfaces, counted):
+        # counts the pixel data of every surface, surfaces in the counted set are skipped so nothing is counted twice
+        total = 0
+        for surface in surfaces:
+            if surface is None or id(surface) in counted:
+                continue
+            counted.add(id(surface))
+            if surface.get_parent() is None: # subsurfaces share pixels with their parent surface
+                total += surface.get_pitch() * surface.get_height()
+        return total
+
+    def collect(self):
+        # returns a list of rows: [kind, asset, owner, instances, surfaces, surface bytes, python bytes]
+        game = self.game
+        rows = {}
+        counted = set()
+
+        def add(kind, asset, owner, surfaces, python_bytes):
+            key = (kind, asset, owner)
+            if key not in rows:
+                rows[key] = [kind, asset, owner, 0, 0, 0, 0]
+            row = rows[key]
+            row[3] += 1
+            row[4] += len(surfaces)
+            row[5] += self.surface_bytes(surfaces, counted)
+            row[6] += python_bytes
+
+        # rooms, every room keeps its own copy of the tileset
+        # only rooms the player has visited are loaded
+        for room in game.world.loaded_rooms():
+            add("room tiles", room.name, room.name, room.map.get_surfaces(), room.python_bytes)
+        if hasattr(game, "cur_room"):
+            add("room background", game.cur_room.name, game.cur_room.name, game.cur_room.map.get_chunk_surfaces(), 0)
+
+        # overworld characters, enemies only exist in the current room
+        for sprite in game.game_sprites:
+            owner = "global" if sprite is game.player else game.cur_room.name
+            add("frames", sprite.sourcefile, owner, sprite.get_surfaces(), sprite.python_bytes)
+        if game.player not in game.game_sprites:
+            add("frames", game.player.sourcefile, "global", game.player.get_surfaces(), game.player.python_bytes)
+
+        # battle characters and the battle menu
+        for sprite in game.game_battle_sprites:
+            add("battle frames", sprite.sourcefile, "battle", sprite.get_surfaces(), sprite.python_bytes)
+        add("battle background", "battle_background.png", "global", [game.battle_bg_file, game.cur_battle_bg], 0)
+        if sprite_atlas.pages:
+            add("sprite atlas", "atlas.json", "global", sprite_atlas.get_surfaces(), 0)
+        return sorted(rows.values(), key=lambda row: row[5] + row[6], reverse=True)
+
+    def create_report(self):
+        rows = self.collect()
+        lines = ["%-18s %-28s %-26s %5s %8s %12s %12s" % ("kind", "asset", "owner", "inst", "surfaces", "surface KB", "python KB")]
+        total_surface = 0
+        total_python = 0
+        for kind, asset, owner, instances, surfaces, surface_bytes, python_bytes in rows:
+            lines.append("%-18s %-28s %-26s %5d %8d %12.1f %12.1f" % (kind, asset, owner, instances, surfaces, surface_bytes/1024, python_bytes/1024))
+            total_surface += surface_bytes
+            total_python += python_bytes
+        lines.append("total surface memory: %.1f MB, total attributed python memory: %.1f MB" % (total_surface/1048576, total_python/1048576))
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append("tracemalloc: %.1f MB current, %.1f MB peak" % (current/1048576, peak/1048576))
+        else:
+            lines.append("tracemalloc isn't running, start the game with --memory-report to measure python memory")
+        return "\n".join(lines)
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            f.write(self.create_report() + "\n")
+
 # Source: CDcodes - Pygame Sprite Sheet Tutorial: How to Load, Parse, and Use Sprite Sheets
 # https://www.youtube.com/watch?v=ePiMYe7JpJo
 class Spritesheet():
     def __init__(self, filename):
+        with tracer.span("Spritesheet", "load", {"file": filename}):
+            if not sprite_atlas.loaded:
+                sprite_atlas.load()
+            if filename in sprite_atlas.sheets:
+                # frames are cut out of the atlas page instead of the sheet's own file
+                self.data = sprite_atlas.sheets[filename]
+                self.sprite_sheet = None
+            else:
+                self.load_sheet(filename)
+
+    def load_sheet(self, filename):
         jsonfilename = filename.replace("png","json")
         sprite_dir = os.path.join("spritesheets")
         self.sprite_sheet = pygame.image.load(os.path.join(sprite_dir, filename)).convert()
@@ -440,15 +2144,636 @@ class Spritesheet():
         y = sprite["y"]
         width = sprite["w"]
         height = sprite["h"]
+        if self.sprite_sheet == None:
+            return sprite_atlas.get_sprite(self.data["frames"][name]["page"], x, y, width, height)
         image = self.get_sprite(x, y, width, height)
         return image
 
+class SpriteAtlas():
+    # every spritesheet packed into a few atlas pages by tools/build_atlas.py
+    # frames are subsurfaces of the pages, they share pixels with the page instead of being copied into their own Surface,
+    # and the same frame is only cut out once no matter how many characters use it
+    # sheets that changed after the atlas was built (or every sheet, if there's no atlas) are loaded from their own files
+    def __init__(self, filename):
+        self.filename = filename
+        self.loaded = False # the pages can only be converted once the screen exists, so they're loaded by the first Spritesheet
+        self.pages = []
+        self.sheets = {} # sheet filename -> same data as the sheet's .json, but with atlas coordinates and the page
+        self.frames = {} # (page, x, y, width, height) -> subsurface
+
+    def load(self):
+        self.loaded = True
+        if not os.path.exists(self.filename):
+            return
+        with tracer.span("SpriteAtlas", "load", {"file": self.filename}):
+            sprite_dir = os.path.dirname(self.filename)
+            with open(self.filename) as f:
+                data = json.load(f)
+            for sheet, sheet_data in data["sheets"].items():
+                if self.get_source_time(sprite_dir, sheet) == sheet_data["source_time"]:
+                    self.sheets[sheet] = sheet_data
+            if not self.sheets:
+                return # every sheet changed, the pages aren't needed
+            for filename in data["pages"]:
+                page = pygame.image.load(os.path.join(sprite_dir, filename)).convert()
+                page.set_colorkey((0,0,0)) # subsurfaces inherit the colorkey, same as Spritesheet.get_sprite
+                self.pages.append(page)
+
+    def get_source_time(self, sprite_dir, sheet):
+        # newest modification time of the sheet's image and .json, the same thing tools/build_atlas.py stores
+        sources = [os.path.join(sprite_dir, sheet), os.path.join(sprite_dir, sheet.replace(".png", ".json"))]
+        if not all(os.path.exists(i) for i in sources):
+            return None
+        return max(os.path.getmtime(i) for i in sources)
+
+    def get_sprite(self, page, x, y, width, height):
+        key = (page, x, y, width, height)
+        if key not in self.frames:
+            self.frames[key] = self.pages[page].subsurface((x, y, width, height))
+        return self.frames[key]
+
+    def get_surfaces(self):
+        # returns every page, used by MemoryReport
+        return self.pages
+
+sprite_atlas = SpriteAtlas(os.path.join("spritesheets", "atlas.json"))
+
+class AssetBuild():
+    # outputs of tools/build_assets.py: pre-rendered room backgrounds, room objects and the frame names of every spritesheet animation
+    # build/manifest.json lists the inputs of every output with their modification times, an output is only used while they still match,
+    # assets that changed after the build (or every asset, if nothing was built) are loaded from their own files
+    version = 1 # same as BUILD_VERSION in tools/build_assets.py
+
+    def __init__(self, build_dir):
+        self.build_dir = build_dir
+        self.root = os.path.dirname(build_dir) # paths in the manifest are relative to the world (or the game) directory
+        self.loaded = False
+        self.jobs = {} # "room:<name>" / "sheet:<file>" -> {"inputs": {path: modification time}, "outputs": [paths]}
+
+    def load(self):
+        self.loaded = True
+        filename = os.path.join(self.build_dir, "manifest.json")
+        if not os.path.exists(filename):
+            return
+        with open(filename) as f:
+            data = json.load(f)
+        if data.get("version") == self.version:
+            self.jobs = data["jobs"]
+
+    def get(self, key):
+        # returns the paths of the job's outputs, None if the job wasn't built or one of its inputs changed since
+        if not self.loaded:
+            self.load()
+        job = self.jobs.get(key)
+        if job == None:
+            return None
+        for path, mtime in job["inputs"].items():
+            path = os.path.join(self.root, path)
+            if not os.path.exists(path) or os.path.getmtime(path) != mtime:
+                return None
+        outputs = [os.path.join(self.root, i) for i in job["outputs"]]
+        if not all(os.path.exists(i) for i in outputs):
+            return None
+        return outputs
+
+    def get_frame_index(self, sheet):
+        # animation name -> frame names in order, None if the sheet isn't built
+        outputs = self.get("sheet:" + sheet)
+        if outputs == None:
+            return None
+        with open(outputs[0]) as f:
+            return json.load(f)
+
+sprite_build = AssetBuild("build")
+
+class AssetWatcher():
+    # hot reload (--hot-reload): a background thread polls the modification times of the rooms, tilesets and spritesheets,
+    # the main thread then reloads only what changed: one room (its map, walls and enemies) or one spritesheet (the frames of the characters using it)
+    # the atlas and the world index aren't rebuilt, the game simply stops using the parts that changed
+    def __init__(self, game, interval=0.25):
+        self.game = game
+        self.interval = interval # seconds between two scans
+        room_dir = game.world.room_dir
+        self.tileset_dir = os.path.join(room_dir, "tilesets")
+        self.sprite_dir = "spritesheets"
+        self.dirs = [room_dir, self.tileset_dir, self.sprite_dir]
+        self.mtimes = self.scan()
+        self.changed = [] # paths found by the thread that haven't been reloaded yet
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="hot reload", daemon=True)
+        self.thread.start()
+
+    def scan(self):
+        # path -> modification time, the atlas is written by tools/build_atlas.py and isn't an asset of its own
+        mtimes = {}
+        for directory in self.dirs:
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if entry.is_file() and not entry.name.startswith("atlas"):
+                    mtimes[entry.path] = entry.stat().st_mtime
+        return mtimes
+
+    def run(self):
+        while self.running:
+            t.sleep(self.interval)
+            mtimes = self.scan()
+            changed = [path for path, mtime in mtimes.items() if self.mtimes.get(path) != mtime]
+            self.mtimes = mtimes
+            if changed:
+                with self.lock:
+                    self.changed += changed
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def apply(self):
+        # runs on the main thread, pygame surfaces can't be loaded while the frame is being simulated
+        if not self.changed:
+            return
+        with self.lock:
+            changed = self.changed
+            self.changed = []
+        rooms = set()
+        sheets = set()
+        later = []
+        for path in changed:
+            directory, name = os.path.split(path)
+            if directory == self.sprite_dir:
+                if name.endswith(".png") or name.endswith(".json"):
+                    sheets.add(name.replace(".json", ".png"))
+            elif not self.game.roaming:
+                later.append(path) # the enemy the player is fighting has to stay the same object, rooms are reloaded once the battle is over
+            elif directory == self.tileset_dir: # every room uses the tileset
+                rooms.update(room.name for room in self.game.world.loaded_rooms())
+            elif name.endswith(".tmx"):
+                rooms.add(name[:-4])
+        if later:
+            with self.lock:
+                self.changed += later
+        for name in sorted(rooms):
+            self.reload("room", name, self.game.reload_room)
+        for name in sorted(sheets):
+            self.reload("spritesheet", name, self.game.reload_spritesheet)
+
+    def reload(self, kind, name, function):
+        # an editor that is still saving the file can leave it broken, the old version stays until the file changes again
+        start = t.perf_counter()
+        try:
+            function(name)
+        except Exception as error:
+            print("couldn't reload %s %s: %s" % (kind, name, error))
+            return
+        print("reloaded %s %s in %.1f ms" % (kind, name, (t.perf_counter() - start)*1000))
+
+class WorldMap():
+    # sparse map of the world, (x, y) -> room name
+    # the layout comes from maplist.csv, but it's read through an index that is split into chunks of chunk_size x chunk_size rooms
+    # chunks are only read once the player gets close to them and rooms are only loaded once the player walks into them,
+    # so memory grows with the number of visited rooms instead of the size of the world
+    # visited rooms stay loaded, dead enemies have to stay dead
+    chunk_size = 16
+    index_version = 3 # changes whenever the format of the index changes
+
+    def __init__(self, world_dir):
+        self.world_dir = world_dir
+        self.room_dir = os.path.join(world_dir, "room_bgs")
+        self.index_dir = os.path.join(world_dir, "world_index")
+        self.room_names = {} # (x, y) -> room name, only contains rooms from chunks that have been read
+        self.room_enemies = {} # (x, y) -> enemy list, same format as Room.enemy_list, used by WorldSimulation
+        self.room_walls = {} # (x, y) -> list of [x, y, width, height], used by WorldSimulation
+        self.room_sizes = {} # (x, y) -> [width, height] in pixels
+        self.rooms = {} # (x, y) -> Room, only contains visited rooms
+        self.dead_enemies = {} # (x, y) -> ids of enemies that died before the game was resumed from a save file
+        self.loaded_chunks = set()
+        self.void = None # every empty space shares the same void room
+        self.build = AssetBuild(os.path.join(world_dir, "build")) # rooms built by tools/build_assets.py
+        self.load_index()
+
+    def load_index(self):
+        # the index is rebuilt whenever maplist.csv or one of the rooms is newer than the index
+        index_file = os.path.join(self.index_dir, "index.json")
+        source_time = self.get_source_time()
+        index = None
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+            if index.get("version") != self.index_version or index["source_time"] != source_time or index["chunk_size"] != self.chunk_size:
+                index = None
+        if index == None:
+            with tracer.span("WorldMap.build_index", "load"):
+                index = self.build_index(source_time)
+        self.enemy_count = index["enemy_count"]
+        self.chunks = set(tuple(i) for i in index["chunks"])
+
+    def get_source_time(self):
+        # newest modification time of maplist.csv and every room file
+        newest = os.path.getmtime(os.path.join(self.world_dir, "maplist.csv"))
+        for entry in os.scandir(self.room_dir):
+            if entry.name.endswith(".tmx"):
+                newest = max(newest, entry.stat().st_mtime)
+        return newest
+
+    def load_mapfile(self):
+        # loads the map file (.csv) that contains the layout of the map
+        with open(os.path.join(self.world_dir, "maplist.csv")) as r:
+            loaded = csv.reader(r)  # reads the file, returns map data
+            mapdata = list(loaded)  # takes this data and turns it into a list (that we can work with)
+        return mapdata
+
+    def read_objects(self, roomname):
+        # reads enemies, walls and the room size from a room file without loading its tiles, same data as TileMap.render_objects
+        tree = et.parse(os.path.join(self.room_dir, roomname + ".tmx"))
+        root = tree.getroot()
+        size = [int(root.get("width"))*int(root.get("tilewidth")), int(root.get("height"))*int(root.get("tileheight"))]
+        enemies = []
+        walls = []
+        for object in tree.iter("object"):
+            if object.get("type") == "wall":
+                walls.append([float(object.get(i)) for i in ("x", "y", "width", "height")])
+            if object.get("type") != "enemy":
+                continue
+            properties = {}
+            for property in object.iter("property"):
+                value = property.get("value")
+                if property.get("type") == "float":
+                    value = float(value)
+                properties[property.get("name")] = value
+            enemy_data = [float(object.get("x")), float(object.get("y")), properties["enemy_sprite"], properties["enemy_type"], properties["movement_range"], properties["movement_speed"], int(object.get("id"))]
+            enemies.append(enemy_data)
+        return enemies, walls, size
+
+    def build_index(self, source_time):
+        # reads maplist.csv once and writes every non-void room into its chunk file
+        chunks = {}
+        room_objects = {} # room files can be used more than once, every file is only parsed once
+        enemy_count = 0
+        for y, row in enumerate(self.load_mapfile()):
+            for x, roomname in enumerate(row):
+                if roomname == "void":
+                    continue
+                if roomname not in room_objects:
+                    room_objects[roomname] = self.read_objects(roomname)
+                enemies, walls, size = room_objects[roomname]
+                enemy_count += len(enemies)
+                chunk = (x//self.chunk_size, y//self.chunk_size)
+                chunks.setdefault(chunk, []).append([x, y, roomname, enemies, walls, size])
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        for name in os.listdir(self.index_dir): # chunks from the previous index, anything else in the directory is left alone
+            if name.startswith("chunk_") and name.endswith(".json"):
+                os.remove(os.path.join(self.index_dir, name))
+        for chunk, rooms in chunks.items():
+            with open(self.chunk_file(chunk), "w") as f:
+                json.dump(rooms, f)
+        index = {"version": self.index_version, "chunk_size": self.chunk_size, "source_time": source_time, "enemy_count": enemy_count, "chunks": list(chunks)}
+        with open(os.path.join(self.index_dir, "index.json"), "w") as f:
+            json.dump(index, f)
+        return index
+
+    def chunk_file(self, chunk):
+        return os.path.join(self.index_dir, "chunk_%d_%d.json" % chunk)
+
+    def read_chunk(self, chunk):
+        # returns the chunk's rooms as a list of [x, y, room name, enemies, walls, size] without loading the chunk
+        if chunk not in self.chunks: # chunk without any rooms
+            return []
+        with open(self.chunk_file(chunk)) as f:
+            return json.load(f)
+
+    def load_chunk(self, chunk):
+        self.loaded_chunks.add(chunk)
+        for x, y, roomname, enemies, walls, size in self.read_chunk(chunk):
+            self.room_names[(x, y)] = roomname
+            self.room_enemies[(x, y)] = enemies
+            self.room_walls[(x, y)] = walls
+            self.room_sizes[(x, y)] = size
+
+    def get_room_name(self, x, y):
+        chunk = (x//self.chunk_size, y//self.chunk_size)
+        if chunk not in self.loaded_chunks:
+            self.load_chunk(chunk)
+        return self.room_names.get((x, y), "void")
+
+    def get_enemy_list(self, x, y):
+        # enemies a room starts with, the room itself doesn't have to be loaded
+        self.get_room_name(x, y) # makes sure the chunk has been read
+        return self.room_enemies.get((x, y), [])
+
+    def get_room_size(self, x, y):
+        self.get_room_name(x, y)
+        return self.room_sizes.get((x, y), [1280, 960])
+
+    def get_wall_list(self, x, y):
+        self.get_room_name(x, y)
+        return self.room_walls.get((x, y), [])
+
+    def get_room(self, x, y):
+        # O(1) lookup, loads the room if the player hasn't been there yet
+        room = self.rooms.get((x, y))
+        if room != None:
+            return room
+        roomname = self.get_room_name(x, y)
+        if roomname == "void":
+            if self.void == None:
+                self.void = Room("void", self.room_dir, self.build)
+            return self.void
+        room = Room(roomname, self.room_dir, self.build)
+        dead = self.dead_enemies.get((x, y))
+        if dead:
+            room.enemy_list[:] = [i for i in room.enemy_list if i[6] not in dead]
+        self.rooms[(x, y)] = room
+        return room
+
+    def reload_room(self, roomname):
+        # the room file changed (--hot-reload), updates every place in the world that uses it
+        # returns [(x, y), enemy ids before the change] for every place and the change in the number of living enemies
+        # enemies that have already died stay dead, new enemies in the file are alive
+        if roomname == "void":
+            self.void = None
+            return [], 0
+        for chunk in self.chunks - self.loaded_chunks: # the room can be anywhere in the world
+            self.load_chunk(chunk)
+        enemies, walls, size = self.read_objects(roomname)
+        changed = []
+        count_change = 0
+        for key, name in self.room_names.items():
+            if name != roomname:
+                continue
+            old_ids = [i[6] for i in self.room_enemies[key]]
+            dead = set(self.dead_enemies.get(key, ()))
+            room = self.rooms.get(key)
+            if room != None:
+                alive = set(i[6] for i in room.enemy_list)
+                dead.update(i for i in old_ids if i not in alive)
+            self.room_enemies[key] = enemies
+            self.room_walls[key] = walls
+            self.room_sizes[key] = size
+            if room != None:
+                room.load(self.room_dir, self.build)
+                room.enemy_list[:] = [i for i in room.enemy_list if i[6] not in dead]
+            count_change += len([i for i in enemies if i[6] not in dead]) - len([i for i in old_ids if i not in dead])
+            changed.append([key, old_ids])
+        return changed, count_change
+
+    def loaded_rooms(self):
+        # every loaded room, used by MemoryReport
+        rooms = list(self.rooms.values())
+        if self.void != None:
+            rooms.append(self.void)
+        return rooms
+
+class WorldSimulation():
+    # level of detail for the world simulation:
+    # - the current room runs the full enemy AI and animations every frame (game_sprites)
+    # - neighbouring rooms run RoomSimulation neighbour_rate times per second,
+    #   at most budget enemies are updated per frame, rooms that don't fit into the budget simply wait for the next frame
+    #   (the first room of a frame is always updated, a room with more enemies than the budget would otherwise block the queue)
+    # - every other room is frozen, once it becomes a neighbour (or the current room) it's moved forward in one go,
+    #   unless a SimulationPool is running (--sim-workers), then every other room is simulated by the pool's worker processes
+    def __init__(self, game, budget=200, neighbour_rate=10, neighbour_radius=1):
+        self.game = game
+        self.budget = budget # enemies per frame
+        self.neighbour_rate = neighbour_rate # updates per second
+        self.neighbour_radius = neighbour_radius # rooms
+        self.workers = 0 # worker processes for distant rooms, 0 = no SimulationPool
+        self.pool = None
+        self.rooms = {} # (x, y) -> RoomSimulation, only rooms that have been close to the player
+        self.queue = [] # neighbouring rooms, in the order they're updated
+        self.queue_pos = None # room the queue was built for
+        self.enemies_updated = 0 # enemies updated last frame
+
+    def get_room(self, x, y):
+        room = self.rooms.get((x, y))
+        if room == None:
+            world = self.game.world
+            room = RoomSimulation(self.game.ai_random, world.get_room_size(x, y), world.get_enemy_list(x, y), world.get_wall_list(x, y), self.game.ticks)
+            if self.pool != None and (x, y) in self.pool.rooms:
+                self.pool.claim((x, y), room) # the room continues from where the pool left it
+            self.rooms[(x, y)] = room
+        return room
+
+    def start_pool(self):
+        # seeded by ai_random, so recorded sessions are replayed with the same results
+        self.pool = SimulationPool(self.game, self.workers, self.game.ai_random.randrange(2**32))
+        for key in self.rooms: # rooms the main process is already simulating
+            if key in self.pool.rooms:
+                self.pool.claim(key, None)
+
+    def close(self):
+        if self.pool != None:
+            self.pool.close()
+            self.pool = None
+
+    def reload_room(self, key, room_size, enemy_list, wall_list, old_ids):
+        # the room file changed (--hot-reload), whoever simulates the room swaps in the new walls and enemies
+        pool = self.pool
+        if pool != None and key in pool.rooms:
+            if len(enemy_list) > len(pool.rooms[key][2]):
+                # more enemies than the room has rows in the shared memory, the main process takes the room over for good
+                self.get_room(key[0], key[1])
+                pool.remove(key)
+            else:
+                pool.reload(key, room_size, enemy_list, wall_list, old_ids)
+        room = self.rooms.get(key)
+        if room != None:
+            room.reload(room_size, enemy_list, wall_list, old_ids)
+
+    def enter_room(self, x, y):
+        # moves the room forward to the current time, load_enemies then places the enemies with place_enemy
+        room = self.get_room(x, y)
+        room.advance(self.game.ticks)
+        return room
+
+    def leave_room(self, x, y, sprites):
+        enemies = [sprite for sprite in sprites if isinstance(sprite, Enemy)]
+        self.get_room(x, y).store_enemies(enemies, self.game.ticks)
+
+    def build_queue(self, x, y):
+        # every room around the current one that has at least one enemy
+        self.queue = []
+        radius = self.neighbour_radius
+        if self.pool != None:
+            # rooms that are too far away go back to the pool
+            # (rooms the pool doesn't have stay frozen in the main process, see reload_room)
+            for key in list(self.rooms):
+                if (abs(key[0]-x) > radius or abs(key[1]-y) > radius) and key in self.pool.rooms:
+                    self.pool.release(key, self.rooms.pop(key))
+        for ny in range(y-radius, y+radius+1):
+            for nx in range(x-radius, x+radius+1):
+                if (nx, ny) != (x, y) and self.game.world.get_enemy_list(nx, ny):
+                    self.queue.append(self.get_room(nx, ny))
+        self.queue_pos = (x, y)
+
+    def update(self):
+        # triggers once per frame during the roaming phase
+        if self.workers and self.pool == None:
+            self.start_pool() # the game starts it before any threads, this only happens if workers was set later
+        pos = (self.game.ow_posX, self.game.ow_posY)
+        if pos != self.queue_pos:
+            self.build_queue(pos[0], pos[1])
+        now = self.game.ticks
+        interval = 1000/self.neighbour_rate
+        updated = 0
+        for i in range(len(self.queue)):
+            room = self.queue[0]
+            if now - room.sim_time < interval or (updated and updated + len(room.enemies) > self.budget):
+                break
+            room.advance(now)
+            updated += len(room.enemies)
+            self.queue.append(self.queue.pop(0)) # round robin, the room goes to the back of the queue
+        self.enemies_updated = updated
+        if self.pool != None:
+            self.pool.update(now)
+
+class SimulationPool():
+    # simulates every room that isn't close to the player in worker processes
+    # every enemy is a row of RoomSimulation.row_size numbers in one shared memory array, rooms are split between the workers
+    # every tick_interval ms the workers move their rooms forward and write the results back into the array,
+    # the main process only reads the rows of a room once it gets close to the player (claim) and writes them back once it's far away again (release)
+    # workers are always spawned (a fresh interpreter, never a fork of the game with its SDL state and threads),
+    # they only need the simulation module, see simulation.py
+    tick_interval = 500 # ms
+
+    def __init__(self, game, workers, seed):
+        self.game = game
+        self.rooms = {} # (x, y) -> [worker, offset, enemy ids], every room with enemies (an id of None is an unused row, see reload)
+        self.release_times = {} # (x, y) -> ticks (ms) at which the main process gave the room back
+        self.claimed = set() # rooms the main process is simulating
+        self.tick_time = game.ticks # ticks (ms) the last finished tick moved the rooms to
+        self.pending_time = game.ticks # ticks (ms) of the last tick that was sent to the workers
+        self.busy = 0 # workers that haven't finished the current tick yet
+
+        # every enemy in the world has a row, the index already knows how many there are
+        world = game.world
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, world.enemy_count)*RoomSimulation.row_size*8)
+        self.array = self.memory.buf.cast("d")
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.processes = []
+        for i in range(workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=simulation_worker, args=(worker_connection, self.memory.name, seed+i), daemon=True)
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+        # the world index is read one chunk at a time and every room goes straight to its worker,
+        # the main process doesn't keep (or load) the chunks, only the players' surroundings are loaded, same as without the pool
+        offset = 0
+        pos = 0
+        for chunk in sorted(world.chunks):
+            for x, y, roomname, enemy_list, wall_list, room_size in world.read_chunk(chunk):
+                if not enemy_list:
+                    continue
+                worker = pos % workers
+                pos += 1
+                self.rooms[(x, y)] = [worker, offset, [enemy[6] for enemy in enemy_list]]
+                self.connections[worker].send(("add", (x, y), offset, enemy_list, wall_list, room_size, self.tick_time))
+                offset += len(enemy_list)
+        for connection in self.connections:
+            connection.send(("tick", self.tick_time)) # writes every room into the array
+        self.busy = workers # every worker sends "done" once it has written its rooms into the array
+
+    def update(self, now):
+        # ticks are sent at fixed points in game time, so the results don't depend on how fast the workers are
+        # a tick has a whole tick_interval to finish, the main process only waits for it if it hasn't
+        if now - self.pending_time >= self.tick_interval:
+            self.wait()
+            for connection in self.connections:
+                connection.send(("tick", now))
+            self.busy = len(self.connections)
+            self.pending_time = now
+        else:
+            self.collect(0)
+
+    def collect(self, timeout):
+        # receives "done" messages from the workers that have finished the current tick
+        for connection in self.connections:
+            if self.busy and connection.poll(timeout):
+                connection.recv()
+                self.busy -= 1
+        if self.busy == 0:
+            self.tick_time = self.pending_time
+
+    def wait(self):
+        # waits for the current tick to finish, rows can't be read while the workers are writing them
+        while self.busy:
+            self.collect(0.001)
+
+    def claim(self, key, room):
+        # the main process takes over the room, room = None keeps the main process's own state
+        self.wait()
+        worker, offset, ids = self.rooms[key]
+        self.connections[worker].send(("claim", key))
+        self.claimed.add(key)
+        if room != None:
+            room.read_rows(self.array, offset, len(ids))
+            room.sim_time = max(self.tick_time, self.release_times.get(key, 0))
+
+    def get_enemies(self, key):
+        # returns [{enemy id: enemy}, ticks (ms) the enemies were simulated up to] of a room the pool is simulating, used by SaveFile
+        # the caller has to wait() first
+        worker, offset, ids = self.rooms[key]
+        return unpack_rows(self.array, offset, len(ids)), max(self.tick_time, self.release_times.get(key, 0))
+
+    def release(self, key, room):
+        # the room goes back to the pool, the workers continue from the main process's state
+        self.wait()
+        worker, offset, ids = self.rooms[key]
+        room.write_rows(self.array, offset, ids)
+        self.connections[worker].send(("release", key, room.sim_time))
+        self.claimed.discard(key)
+        self.release_times[key] = room.sim_time
+
+    def reload(self, key, room_size, enemy_list, wall_list, old_ids):
+        # the room file changed (--hot-reload), the room keeps its rows, rows that aren't needed anymore are left empty (id None)
+        # the worker reloads its copy of the room and, unless the main process has claimed it, writes the new rows right away
+        self.wait()
+        entry = self.rooms[key]
+        ids = [enemy[6] for enemy in enemy_list]
+        ids += [None]*(len(entry[2]) - len(ids))
+        entry[2] = ids
+        self.connections[entry[0]].send(("reload", key, ids, room_size, enemy_list, wall_list, old_ids))
+        self.busy = 1 # wait() returns once the rows are written
+
+    def remove(self, key):
+        # the main process simulates the room from now on, used once a room has more enemies than rows
+        self.wait()
+        self.connections[self.rooms.pop(key)[0]].send(("remove", key))
+        self.claimed.discard(key)
+        self.release_times.pop(key, None)
+
+    def close(self):
+        self.wait()
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+        self.array.release()
+        self.memory.close()
+        self.memory.unlink()
+
 class Room():
     # Room object, stores info about walls/enemies/room properties (mainly for the purposes of readibility)
-    def __init__(self, roomname, room_dir):
-        room_data = os.path.join(room_dir, (roomname + ".tmx")) # finds the room data in the room_bgs directory
-        self.map = TileMap(room_data)
-        self.map.render_objects()
+    def __init__(self, roomname, room_dir, build):
+        self.name = roomname
+        self.load(room_dir, build)
+
+    def load(self, room_dir, build):
+        # also used to load the room again once its file changes (--hot-reload)
+        room_data = os.path.join(room_dir, (self.name + ".tmx")) # finds the room data in the room_bgs directory
+        memory_start = python_memory()
+        with tracer.span("Room", "load", {"room": self.name}):
+            outputs = build.get("room:" + self.name)
+            if outputs != None:
+                self.map = PrebuiltMap(outputs[0], outputs[1]) # background and objects from tools/build_assets.py, pytmx isn't needed
+            else:
+                self.map = TileMap(room_data)
+            self.map.render_objects()
+        self.python_bytes = python_memory() - memory_start # used by MemoryReport
         
         self.wall_list = self.map.wall_list
         self.enemy_list = self.map.enemy_list
@@ -461,10 +2786,22 @@ class TileMap():
     def __init__(self, mapfile):
         self.wall_list = []
         self.enemy_list = []
-        tm = pytmx.load_pygame(mapfile, pixelalpha = True)
+        with tracer.span("TileMap", "load", {"file": mapfile}):
+            tm = pytmx.load_pygame(mapfile, pixelalpha = True)
         self.width = tm.width * tm.tilewidth # total width of background surface = number of tiles * width of tile
         self.height = tm.height * tm.tileheight # total height of background surface = number of tiles * width of tile
         self.tmxdata = tm
+        self.create_chunks(tm.tilewidth, tm.tileheight)
+
+    def create_chunks(self, tilewidth, tileheight):
+        # the background is rendered in chunks of chunk_tiles x chunk_tiles tiles, only chunks that the camera can see are rendered
+        # chunks are kept until there's more than max_chunks of them, then the one that was drawn the longest time ago is thrown away
+        self.chunk_tiles = 16
+        self.chunk_width = self.chunk_tiles * tilewidth
+        self.chunk_height = self.chunk_tiles * tileheight
+        self.max_chunks = 48 # a 1280x960 screen needs at most 12 chunks
+        self.chunks = {} # (chunk x, chunk y) -> Surface, in the order they were last drawn
+        self.wall_grid = WallGrid(self.chunk_width, self.chunk_height) # walls sorted into chunks, used for collisions
     
     def render_objects(self):
         for object in self.tmxdata.objects:
@@ -473,10 +2810,23 @@ class TileMap():
             if object.type == "wall":
                 temp_rect = pygame.Rect(object.x, object.y, object.width, object.height)
                 self.wall_list.append(temp_rect)
+                self.wall_grid.add(temp_rect)
             if object.type == "enemy":
                 enemy_data = [object.x, object.y, object.properties["enemy_sprite"], object.properties["enemy_type"], object.properties["movement_range"], object.properties["movement_speed"], object.id]
                 self.enemy_list.append(enemy_data)
     
+    def walls_near(self, rect):
+        # only walls close to the rect, big rooms have thousands of walls
+        return self.wall_grid.near(rect)
+
+    def get_surfaces(self):
+        # returns every tile image loaded by pytmx, used by MemoryReport
+        return [i for i in self.tmxdata.images if i]
+
+    def get_chunk_surfaces(self):
+        # returns every rendered chunk, used by MemoryReport
+        return list(self.chunks.values())
+
     def load_map(self):
         # loads the background image on a surface and returns it
         temp_surface = pygame.Surface((self.width, self.height))
@@ -485,13 +2835,122 @@ class TileMap():
 
     def draw_map(self, surface):
         # draws the tilemap onto a surface using the tile layer data
-        tilecommand = self.tmxdata.get_tile_image_by_gid
-        for layer in self.tmxdata.visible_layers: # multiple tile layers for complex textures, multiple layers can overlap
+        self.draw_tiles(surface, 0, 0, self.tmxdata.width, self.tmxdata.height)
+
+    def draw_tiles(self, surface, first_x, first_y, last_x, last_y):
+        # draws the tiles between first_x/first_y and last_x/last_y (exclusive), the first tile ends up in the top left corner of the surface
+        # every layer is drawn with a single blits call, pygame then does the whole layer in C instead of one blit call per tile
+        tm = self.tmxdata
+        images = tm.images # gid -> tile image, the same thing get_tile_image_by_gid returns
+        tilewidth = tm.tilewidth
+        tileheight = tm.tileheight
+        for layer in tm.visible_layers: # multiple tile layers for complex textures, multiple layers can overlap
             if isinstance(layer, pytmx.TiledTileLayer):
-                for x, y, gid in layer:
-                    tile = tilecommand(gid)
-                    if tile:
-                        surface.blit(tile, (x*self.tmxdata.tilewidth, y*self.tmxdata.tileheight))
+                tiles = []
+                for y in range(first_y, last_y):
+                    row = layer.data[y]
+                    pos_y = (y-first_y)*tileheight
+                    tiles += [(images[row[x]], ((x-first_x)*tilewidth, pos_y)) for x in range(first_x, last_x) if images[row[x]]] # gid 0 (no tile) has no image
+                surface.blits(tiles, doreturn=False)
+
+    def render_chunk(self, chunk_x, chunk_y):
+        # draws the tiles of one chunk onto a new surface, chunks at the right/bottom edge of the room can be smaller
+        tm = self.tmxdata
+        first_x = chunk_x*self.chunk_tiles
+        first_y = chunk_y*self.chunk_tiles
+        last_x = min(first_x + self.chunk_tiles, tm.width)
+        last_y = min(first_y + self.chunk_tiles, tm.height)
+        surface = pygame.Surface(((last_x-first_x)*tm.tilewidth, (last_y-first_y)*tm.tileheight))
+        self.draw_tiles(surface, first_x, first_y, last_x, last_y)
+        return surface # Surface() already uses the screen's pixel format
+
+    def get_chunk(self, chunk_x, chunk_y):
+        chunk = self.chunks.pop((chunk_x, chunk_y), None) # moves the chunk to the end of the dict (most recently drawn)
+        if chunk == None:
+            with tracer.span("TileMap.render_chunk", "load", {"chunk": [chunk_x, chunk_y]}):
+                chunk = self.render_chunk(chunk_x, chunk_y)
+            if len(self.chunks) >= self.max_chunks:
+                del self.chunks[next(iter(self.chunks))] # the oldest chunk
+        self.chunks[(chunk_x, chunk_y)] = chunk
+        return chunk
+
+    def covers(self, camera):
+        # False if the room is smaller than the screen, the rest of the screen has to be cleared
+        return self.width >= camera.width and self.height >= camera.height
+
+    def view_blits(self, camera):
+        # returns the chunks the camera can see as (surface, screen position), the cost doesn't depend on the size of the room
+        # chunks are cached in self.chunks, so this is only called from the main thread (see MainGame.publish_frame)
+        first_x = camera.x//self.chunk_width
+        first_y = camera.y//self.chunk_height
+        last_x = min((camera.x + camera.width - 1)//self.chunk_width, (self.width - 1)//self.chunk_width)
+        last_y = min((camera.y + camera.height - 1)//self.chunk_height, (self.height - 1)//self.chunk_height)
+        blits = []
+        for chunk_y in range(first_y, last_y+1):
+            for chunk_x in range(first_x, last_x+1):
+                blits.append((self.get_chunk(chunk_x, chunk_y), (chunk_x*self.chunk_width - camera.x, chunk_y*self.chunk_height - camera.y)))
+        return blits
+
+    def draw_view(self, surface, camera):
+        # draws the part of the room the camera can see
+        if not self.covers(camera):
+            surface.fill((0,0,0)) # the room doesn't cover the whole screen
+        blits = self.view_blits(camera)
+        if surface_check.enabled:
+            for chunk, pos in blits:
+                surface_check.check(chunk, "a room chunk", surface)
+        surface.blits(blits, doreturn=False)
+
+class PrebuiltMap(TileMap):
+    # room built by tools/build_assets.py: the whole background is one image and the objects are already read from the .tmx
+    # chunks are subsurfaces of the background, they share its pixels instead of drawing the tiles again
+    def __init__(self, background_file, objects_file):
+        self.wall_list = []
+        self.enemy_list = []
+        with tracer.span("PrebuiltMap", "load", {"file": background_file}):
+            self.background = pygame.image.load(background_file).convert()
+            with open(objects_file) as f:
+                self.objects = json.load(f)
+        self.width, self.height = self.objects["size"]
+        self.tmxdata = None
+        self.create_chunks(self.objects["tile"][0], self.objects["tile"][1])
+
+    def render_objects(self):
+        for wall in self.objects["walls"]:
+            temp_rect = pygame.Rect(wall)
+            self.wall_list.append(temp_rect)
+            self.wall_grid.add(temp_rect)
+        self.enemy_list += self.objects["enemies"]
+
+    def get_surfaces(self):
+        return [self.background]
+
+    def draw_map(self, surface):
+        surface.blit(self.background, (0, 0))
+
+    def render_chunk(self, chunk_x, chunk_y):
+        x = chunk_x*self.chunk_width
+        y = chunk_y*self.chunk_height
+        return self.background.subsurface((x, y, min(self.chunk_width, self.width - x), min(self.chunk_height, self.height - y)))
+
+class Camera():
+    # part of the room that is visible on the screen, follows the player around rooms bigger than the screen
+    # rooms that are the same size as the screen (every hand-made room) keep the camera at (0, 0)
+    def __init__(self, width, height):
+        self.x = 0
+        self.y = 0
+        self.width = width
+        self.height = height
+
+    def update(self, room_map, target):
+        # centers the camera on the target rect without showing anything outside the room, returns True if the camera moved
+        x = max(0, min(target.centerx - self.width//2, room_map.width - self.width))
+        y = max(0, min(target.centery - self.height//2, room_map.height - self.height))
+        if x == self.x and y == self.y:
+            return False
+        self.x = x
+        self.y = y
+        return True
                         
 class NPC(pygame.sprite.Sprite):
     # Parent class for every overworld character in the game (player, enemies, etc.)
@@ -510,8 +2969,16 @@ class NPC(pygame.sprite.Sprite):
         self.position_y = anch_y
         self.animation_time = 0
         self.size_coef = 3 # default sprite size
-
+        self.drawn_x = None # position and frame from the last drawn frame, used to skip idle frames
+        self.drawn_y = None
+        self.drawn_sprite = None
+        self.scaled_frames = {} # base frame -> scaled frame, frames are only scaled once
+
+        memory_start = python_memory()
+        self.frame_name = sourcefile # frame names in the spritesheet start with this
+        self.frames_per_side = frames_per_side
         self.load_frames(sourcefile, frames_per_side)
+        self.python_bytes = python_memory() - memory_start # used by MemoryReport
         self.rect = self.image.get_rect(topleft = (anch_x, anch_y), width=(self.size[0]*self.size_coef), height =(self.size[1]*self.size_coef))
 
     def load_frames(self, sourcefile, frames_per_side):
@@ -524,6 +2991,7 @@ class NPC(pygame.sprite.Sprite):
         self.frames_left = []
         self.frames_right = []
         frames = [self.frames_down, self.frames_up, self.frames_left, self.frames_right]
+        self.frame_lists = frames
         sides = ["_front","_back","_left","_right"]
         side_list_pos = 0
         for framelist in frames:
@@ -536,6 +3004,25 @@ class NPC(pygame.sprite.Sprite):
         self.cur_sprlist = self.frames_down
         self.size = self.image.get_size()
 
+    def get_surfaces(self):
+        # returns every frame and the current scaled image, used by MemoryReport
+        surfaces = [self.image] + list(self.scaled_frames.values())
+        for framelist in self.frame_lists:
+            surfaces += framelist
+        return surfaces
+
+    def reload_frames(self):
+        # the spritesheet changed (--hot-reload)
+        cur_frame = self.cur_frame
+        cur_list = [i is self.cur_sprlist for i in self.frame_lists].index(True) # frames can be shared, the lists have to be compared by identity
+        self.load_frames(self.frame_name, self.frames_per_side)
+        self.scaled_frames.clear()
+        self.cur_sprlist = self.frame_lists[cur_list]
+        self.cur_frame = min(cur_frame, len(self.cur_sprlist)-1)
+        self.base_sprite = self.cur_sprlist[self.cur_frame]
+        self.size = self.base_sprite.get_size()
+        self.image = self.scale_frame(self.base_sprite)
+
     def update(self):
         # basic Sprite function, updates the sprite every frame
         self.check_for_death()
@@ -551,8 +3038,33 @@ class NPC(pygame.sprite.Sprite):
         # if they are, it begins to iterate through the list of frames
         self.set_state()
         self.animate()
-        bigger_sprite = pygame.transform.scale(self.base_sprite, (self.size[0]*self.size_coef, self.size[1]*self.size_coef)) # most sprites are 48*48px, worms are 64*64
-        self.image = bigger_sprite
+        self.image = self.scale_frame(self.base_sprite)
+
+    def scale_frame(self, frame):
+        # returns a bigger version of the frame, every frame is only scaled once and then stored in scaled_frames
+        bigger_sprite = self.scaled_frames.get(frame)
+        if bigger_sprite is None:
+            bigger_sprite = prepare_surface(pygame.transform.scale(frame, (self.size[0]*self.size_coef, self.size[1]*self.size_coef))) # most sprites are 48*48px, worms are 64*64
+            self.scaled_frames[frame] = bigger_sprite
+        return bigger_sprite
+
+    def check_for_changes(self):
+        # checks if the NPC moved or changed its animation frame since it was last drawn
+        changed = self.drawn_x != self.rect.x or self.drawn_y != self.rect.y or self.drawn_sprite is not self.base_sprite
+        self.drawn_x = self.rect.x
+        self.drawn_y = self.rect.y
+        self.drawn_sprite = self.base_sprite
+        return changed
+
+    def wake_time(self, now):
+        # returns the time at which the NPC needs to be updated again, None = the NPC is standing still
+        if self.state_idle:
+            return None
+        return now # the NPC is moving, it needs every frame
+
+    def wake_up(self, now):
+        # called by SpriteGroup.wake when the NPC stops sleeping
+        pass
 
     def set_state(self):
         # Detects whether the NPC is moving or not
@@ -567,7 +3079,7 @@ class NPC(pygame.sprite.Sprite):
             self.cur_frame = 0
         else:
             # Updates the current frame/cur_frame variable based on the amount of time that has passed
-            now = pygame.time.get_ticks()
+            now = self.game.ticks
             if now - self.animation_time > 200:
                 self.animation_time = now
                 self.cur_frame = (self.cur_frame + 1) % len(self.cur_sprlist)
@@ -588,7 +3100,7 @@ class NPC(pygame.sprite.Sprite):
 
     def check_wallsX(self):
         # check if the NPC has hit a wall on the X axis
-        for wall in self.cur_wall_list:
+        for wall in self.game.cur_map.walls_near(self.rect): # only walls close to the NPC, big rooms have thousands of walls
             if self.rect.colliderect(wall):
                 if self.direction_x > 0:
                     self.rect.right = wall.left
@@ -604,7 +3116,7 @@ class NPC(pygame.sprite.Sprite):
 
     def check_wallsY(self):
         # check if the NPC has hit a wall on the Y axis
-        for wall in self.cur_wall_list:
+        for wall in self.game.cur_map.walls_near(self.rect): # only walls close to the NPC, big rooms have thousands of walls
             if self.rect.colliderect(wall):
                 if self.direction_y > 0:
                     self.rect.bottom = wall.top
@@ -625,9 +3137,9 @@ class Player(NPC):
     # Source: CDcodes - Pygame Game States Tutorial
     # https://www.youtube.com/watch?v=b_DkQrJxpck
     def move(self):
-        self.cur_wall_list = self.game.cur_wall_list # updates every frame in case the player moves to a different room
-        self.direction_x = self.game.key_d - self.game.key_a
-        self.direction_y = self.game.key_s - self.game.key_w
+        key_w, key_a, key_s, key_d = self.read_keys()
+        self.direction_x = key_d - key_a
+        self.direction_y = key_s - key_w
         
         # separate calculations for X and Y axis, prevents wallclipping
         # position and rect coords act separately, position is a float while rect is an integer
@@ -638,28 +3150,60 @@ class Player(NPC):
         self.position_y += self.direction_y * 3 * self.game.dt * 60
         self.rect.y = int(self.position_y)
         self.check_wallsY()
-        
+
+        if self.direction_x or self.direction_y:
+            self.wake_enemies()
         self.check_edge()
 
+    def read_keys(self):
+        return self.game.key_w, self.game.key_a, self.game.key_s, self.game.key_d
+
+    def wake_enemies(self):
+        # sleeping enemies don't look for the player, so the player wakes up every enemy it walks into range of
+        group = self.game.game_sprites
+        for enemy in group.sleepers():
+            if isinstance(enemy, Enemy) and m.hypot(enemy.position_x - self.rect.x, enemy.position_y - self.rect.y) <= enemy.range:
+                group.wake(enemy, self.game.ticks)
+
     def check_edge(self):
-        # check if the player has come too close to the edge of the screen
+        # check if the player has come too close to the edge of the room
         # updates the ow_pos variables accordingly
+        # rooms can be bigger than the screen, the player is placed near the edge of the next room (1280x960 rooms: x 1180/80, y 880/48)
+        room = self.game.cur_map
+        world = self.game.world
         if self.position_x <= 16: #player approaches left side
             self.game.ow_posX -= 1
-            self.position_x = 1180
-            self.rect.x = 1180
-        elif self.position_x >= 1232: #player approaches right side
+            self.position_x = world.get_room(self.game.ow_posX, self.game.ow_posY).map.width - 100
+            self.rect.x = self.position_x
+        elif self.position_x >= room.width - 48: #player approaches right side
             self.game.ow_posX += 1
             self.position_x = 80
         elif self.position_y <= 8: #player approaches top side
             self.game.ow_posY -= 1
-            self.position_y = 880
-            self.rect.y = 880
-        elif self.position_y >= 920: #player approaches bottom side
+            self.position_y = world.get_room(self.game.ow_posX, self.game.ow_posY).map.height - 80
+            self.rect.y = self.position_y
+        elif self.position_y >= room.height - 40: #player approaches bottom side
             self.game.ow_posY += 1
             self.position_y = 48
             self.rect.y = 48
 
+class RemotePlayer(Player):
+    # the co-op partner on the host, moved by the keys the client sends (see CoopHost)
+    # the host decides which room everybody is in, the partner can't walk out of the room on its own
+    def __init__(self, game, sourcefile, anch_x, anch_y, range, frames_per_side):
+        super().__init__(game, sourcefile, anch_x, anch_y, range, frames_per_side)
+        self.keys = (False, False, False, False) # W, A, S, D
+
+    def read_keys(self):
+        return self.keys
+
+    def check_edge(self):
+        room = self.game.cur_map
+        self.position_x = min(max(self.position_x, 17), room.width - 49)
+        self.position_y = min(max(self.position_y, 9), room.height - 41)
+        self.rect.x = int(self.position_x)
+        self.rect.y = int(self.position_y)
+
 class Enemy(NPC):
     # anch_x and anch_y represent the enemy's anchor point;
     # range represents how far away the enemy can move from its anchor point
@@ -681,10 +3225,15 @@ class Enemy(NPC):
         self.wandering = False
         self.wander_delay = False
         self.wander_time = 0.0
+        self.sleep_start = 0 # ticks, the enemy sleeps while it waits at home (see wander)
+        self.ai_slot = 0 # frame (out of game.ai_period) in which the enemy makes its decisions
+        self.decision_dt = 0.0 # time since the last decision, used by the timers instead of game.dt
+        self.moving = False # the last decision was to move, the enemy keeps moving until the next one
 
         # special variables - charging, alive
         self.charge_delay = True
         self.alive = True
+        self.new_pos = [self.anch_x, self.anch_y] # target position, the list is reused instead of creating a new one every frame
 
     def check_for_death(self):
         # check if the enemy is still alive, if it isn't, delete it from memory
@@ -696,6 +3245,25 @@ class Enemy(NPC):
                     self.game.enemy_count -= 1
 
     def move(self):
+        # decisions only happen in the enemy's own slot, in every other frame the enemy keeps going where it decided to go
+        self.decision_dt += self.game.dt
+        if self.game.frame_count % self.game.ai_period == self.ai_slot:
+            self.decide()
+            self.decision_dt = 0.0
+        elif self.moving:
+            self.keep_moving()
+
+    def keep_moving(self):
+        # the direction is worked out again every frame, the same as move_to_new_pos does,
+        # a fast enemy (a charging Charger) would otherwise step over the target and keep going until the next decision
+        self.create_new_direction()
+        self.approximate_direction() # stops on the axis where the target has been reached
+        self.move_enemy()
+        if self.player_spotted == True:
+            self.check_for_collision() # battles can't wait for the next decision
+
+    def decide(self):
+        self.moving = False
         self.check_for_home() # check if enemy is within range of anchor point, update the at_home variable
         self.check_for_player() # check if player is within range of anchor point, update the player_spotted variable
         if self.player_spotted == True:
@@ -722,19 +3290,29 @@ class Enemy(NPC):
         else:
             self.player_spotted = False
 
+    def wake_time(self, now):
+        if self.wander_delay and not self.player_spotted: # enemy is waiting out the 1 second timer
+            return now + int((1 - self.wander_time)*1000)
+        return now # enemy is wandering, chasing or charging
+
     def reset_timers(self):
         self.wander_delay = False
         self.wander_time = 0
 
+    def wake_up(self, now):
+        # the time spent sleeping counts towards the wander timer
+        self.wander_time += (now - self.sleep_start)/1000
+
     def chase_player(self):
         pass
 
     def check_for_collision(self):
-        if self.rect.colliderect(self.game.player) and self.alive == True:
+        if self.game.touches_player(self.rect) and self.alive == True:
             self.game.trigger_battle_phase(self)
     
     def return_home(self):
-        self.new_pos = [self.anch_x, self.anch_y]
+        self.new_pos[0] = self.anch_x
+        self.new_pos[1] = self.anch_y
         self.move_to_new_pos()
     
     def move_to_new_pos(self):
@@ -753,10 +3331,11 @@ class Enemy(NPC):
             self.create_new_direction()
             self.approximate_direction()
             self.move_enemy()
+            self.moving = True
     
     def time_delay(self):
         time_delay = 1
-        dt = self.game.dt
+        dt = self.decision_dt
         self.wander_time += dt
         if self.wander_time > time_delay: # it has been more than 1 second
             self.reset_timers()
@@ -795,6 +3374,10 @@ class Enemy(NPC):
     def wander(self):
         if self.wander_delay == True: # enemy has reached their destination and is currently waiting out the 1 second timer
             self.time_delay()
+            if self.wander_delay:
+                # nothing happens until the timer runs out or the player comes close (see Player.wake_enemies), the enemy sleeps until then
+                self.sleep_start = self.game.ticks
+                self.game.game_sprites.sleep(self, self.sleep_start + (1 - self.wander_time)*1000)
         elif self.wandering == False: # enemy is searching for a new destination
             self.find_pos()
             self.move_to_new_pos()
@@ -806,41 +3389,46 @@ class Enemy(NPC):
         direction = self.find_direction() # picks a random direction - up, down, left or right
         self.find_distance(direction) # picks a random position within range that corresponds to the chosen direction
 
+    directions = ("up", "down", "left", "right")
+
     def find_direction(self):
-        directions = ["up", "down", "left", "right"]
-        new_direction = r.choice(directions)
+        new_direction = self.game.ai_random.choice(self.directions)
         return new_direction
 
     def find_distance(self, direction):
         ## creates self.new_pos variable that the enemy will move to
         # slightly different calculations for every direction
 
-        # the purpose of bottom_range/top_range is to ensure that the sprite doesn't walk off screen
-        # if they are Below Zero (check your oxygen) or above the game window's width/height, the program will forcefully put them back in place
+        # the purpose of bottom_range/top_range is to ensure that the sprite doesn't walk out of the room
+        # if they are Below Zero (check your oxygen) or above the room's width/height, the program will forcefully put them back in place
         if direction == "up":
             bottom_range = int(self.anch_y-self.range)
             if bottom_range < 0:
                 bottom_range = 0
-            random_pos = r.randint(bottom_range, self.rect.y)
-            self.new_pos = [self.rect.x, random_pos]
+            random_pos = self.game.ai_random.randint(bottom_range, self.rect.y)
+            self.new_pos[0] = self.rect.x
+            self.new_pos[1] = random_pos
         elif direction == "down":
             top_range = int(self.anch_y+self.range)
-            if top_range > (self.game.game_HEIGHT - (self.size[1]*self.size_coef)):
-                top_range = self.game.game_HEIGHT - (self.size[1]*self.size_coef)
-            random_pos = r.randint(self.rect.y, top_range)
-            self.new_pos = [self.rect.x, random_pos]
+            if top_range > (self.game.cur_map.height - (self.size[1]*self.size_coef)):
+                top_range = self.game.cur_map.height - (self.size[1]*self.size_coef)
+            random_pos = self.game.ai_random.randint(self.rect.y, top_range)
+            self.new_pos[0] = self.rect.x
+            self.new_pos[1] = random_pos
         elif direction == "left":
             bottom_range = int(self.anch_x-self.range)
             if bottom_range < 0:
                 bottom_range = 0
-            random_pos = r.randint(bottom_range, self.rect.x)
-            self.new_pos = [random_pos, self.rect.y]
+            random_pos = self.game.ai_random.randint(bottom_range, self.rect.x)
+            self.new_pos[0] = random_pos
+            self.new_pos[1] = self.rect.y
         elif direction == "right":
             top_range = int(self.anch_x+self.range)
-            if top_range > (self.game.game_WIDTH - (self.size[0]*self.size_coef)):
-                top_range = self.game.game_WIDTH - (self.size[0]*self.size_coef)
-            random_pos = r.randint(self.rect.x, top_range)
-            self.new_pos = [random_pos, self.rect.y]
+            if top_range > (self.game.cur_map.width - (self.size[0]*self.size_coef)):
+                top_range = self.game.cur_map.width - (self.size[0]*self.size_coef)
+            random_pos = self.game.ai_random.randint(self.rect.x, top_range)
+            self.new_pos[0] = random_pos
+            self.new_pos[1] = self.rect.y
 
 class Walker(Enemy):
     # Simple enemy; if the player is spotted, it will follow the player in a straight line
@@ -852,12 +3440,12 @@ class Walker(Enemy):
 
     def chase_player(self):
         # marks the player's position and moves towards it
-        self.new_pos = [self.game.player.rect.x, self.game.player.rect.y]
+        self.new_pos[0] = self.game.player.rect.x
+        self.new_pos[1] = self.game.player.rect.y
         self.move_to_new_pos()
 
     def move_enemy(self):
         # a general movement function, direction depends on whether the enemy is chasing or idle
-        self.cur_wall_list = self.game.cur_wall_list
 
         # X and Y axes are handled separately, similarly to the player class
         self.position_x += self.direction_x * self.mvms * self.game.dt * 60
@@ -884,6 +3472,7 @@ class Charger(Enemy):
         self.frames_left = []
         self.frames_right = []
         frames = [self.frames_left, self.frames_right]
+        self.frame_lists = frames
         sides = ["_left","_right"]
         side_list_pos = 0
         for framelist in frames:
@@ -901,7 +3490,7 @@ class Charger(Enemy):
         if self.state_idle:
             self.cur_frame = 0
         else:
-            now = pygame.time.get_ticks()
+            now = self.game.ticks
             if now - self.animation_time > 200:
                 self.animation_time = now
                 self.cur_frame = (self.cur_frame + 1) % len(self.cur_sprlist)
@@ -913,7 +3502,6 @@ class Charger(Enemy):
 
     def move_enemy(self):
         # a general movement function, direction depends on whether the enemy is chasing or idle
-        self.cur_wall_list = self.game.cur_wall_list
 
         if self.player_spotted == True:
             mvms = self.mvms*3
@@ -935,13 +3523,14 @@ class Charger(Enemy):
 
     def check_for_charge(self):
         self.set_sprite()
-        dt = self.game.dt
+        dt = self.decision_dt
         self.charge_time += dt
         if self.charge_time > 1.5:
             # reset charge variables
             self.charge_delay = False
             self.charge_time = 0
-            self.new_pos = [self.game.player.rect.x, self.game.player.rect.y]
+            self.new_pos[0] = self.game.player.rect.x
+            self.new_pos[1] = self.game.player.rect.y
         else:
             self.charge_delay = True
     
@@ -952,7 +3541,144 @@ class Charger(Enemy):
             self.cur_sprlist = self.frames_right
         self.base_sprite = self.cur_sprlist[3]
 
+class Timeline():
+    # declarative battle animation, a table of segments that play one after another
+    # every segment shows one animation and ends either once the character reaches a position (move_to)
+    # or once the animation reaches a frame (end_frame), the character can move during either kind of segment
+    # segment keys:
+    #   frames - list of frames, delay - ms per frame, either a number or {first frame: ms} for delays that change mid-animation
+    #   move_to - x position the segment ends at, end_frame - frame the segment ends at, speed - pixels per second (signed for end_frame segments)
+    #   at_frame - {frame: callback}, on_start/on_end - callbacks
+    # everything is worked out from the time since the segment started, so the timeline doesn't care how many frames it gets
+    # and can jump to any point (seek) or straight to its end (finish), callbacks still run once and in order
+    # seeking back plays the timeline again from its start, but callbacks that already ran are skipped (they deal damage, start defences etc.)
+    def __init__(self, owner, segments):
+        self.owner = owner # BattleNPC, the timeline moves owner.pos_x and sets its frames
+        self.segments = [self.compile(i) for i in segments]
+        self.done = True
+        self.start_time = 0
+        self.time = 0 # time of the last update
+
+    def compile(self, segment):
+        # works out when every frame of the segment starts, in ms since the start of the segment
+        segment = dict(segment)
+        delays = segment["delay"]
+        if not isinstance(delays, dict):
+            delays = {0: delays}
+        if "end_frame" in segment:
+            frame_times = [0]
+            delay = delays[0]
+            for frame in range(segment["end_frame"]):
+                delay = delays.get(frame, delay)
+                frame_times.append(frame_times[-1] + delay)
+            segment["frame_times"] = frame_times
+        else:
+            segment["loop_delay"] = delays[0] # moving segments loop their animation
+        segment.setdefault("speed", 0)
+        segment.setdefault("at_frame", {})
+        return segment
+
+    def start(self, now):
+        self.origin_x = self.owner.pos_x
+        self.fired = set() # callbacks that already ran, (segment index, frame or "start"/"end")
+        self.restart(now)
+
+    def restart(self, now):
+        self.done = False
+        self.start_time = now
+        self.time = now
+        self.start_segment(0, now)
+
+    def run_callback(self, key, callback):
+        if key not in self.fired:
+            self.fired.add(key)
+            callback()
+
+    def start_segment(self, index, now):
+        self.index = index
+        self.segment_start = now
+        self.start_x = self.owner.pos_x
+        segment = self.segments[index]
+        if "frame_times" in segment:
+            self.duration = segment["frame_times"][-1]
+            self.direction = 1
+        else:
+            distance = segment["move_to"] - self.start_x
+            self.duration = int(abs(distance)*1000/segment["speed"]) # ms, ticks are whole numbers
+            self.direction = 1 if distance >= 0 else -1
+        if "on_start" in segment:
+            self.run_callback((index, "start"), segment["on_start"])
+
+    def update(self, now):
+        # finishes every segment that ended before now, then shows the current one
+        while not self.done and now >= self.segment_start + self.duration:
+            self.finish_segment()
+        self.time = max(self.time, now)
+        if not self.done:
+            self.show(now - self.segment_start)
+
+    def finish_segment(self):
+        segment = self.segments[self.index]
+        end = self.segment_start + self.duration
+        self.show(self.duration, False)
+        for frame in sorted(segment["at_frame"]): # callbacks of frames that were skipped over
+            self.run_callback((self.index, frame), segment["at_frame"][frame])
+        if "move_to" in segment:
+            self.owner.pos_x = segment["move_to"]
+        if "on_end" in segment:
+            self.run_callback((self.index, "end"), segment["on_end"])
+        if self.index + 1 < len(self.segments):
+            self.start_segment(self.index + 1, end)
+        else:
+            self.done = True
+
+    def show(self, elapsed, callbacks=True):
+        # moves the owner and picks its frame elapsed ms into the current segment
+        segment = self.segments[self.index]
+        self.owner.pos_x = int(self.start_x + self.direction*abs(segment["speed"])*elapsed/1000) if segment["speed"] else self.start_x
+        if "frame_times" in segment:
+            frame = min(self.find_frame(segment["frame_times"], elapsed), len(segment["frames"]) - 1)
+        else:
+            frame = int(elapsed//segment["loop_delay"]) % len(segment["frames"])
+        self.owner.show_frame(segment["frames"], frame)
+        if callbacks:
+            for callback_frame in sorted(segment["at_frame"]):
+                if callback_frame <= frame:
+                    self.run_callback((self.index, callback_frame), segment["at_frame"][callback_frame])
+
+    def find_frame(self, frame_times, elapsed):
+        # last frame that started before elapsed
+        frame = 0
+        while frame + 1 < len(frame_times) and frame_times[frame + 1] <= elapsed:
+            frame += 1
+        return frame
+
+    def next_change(self, now):
+        # time at which the owner looks different again, used to skip idle frames
+        segment = self.segments[self.index]
+        if segment["speed"]:
+            return now # moving, every frame is different
+        elapsed = now - self.segment_start
+        for frame_time in segment["frame_times"]:
+            if frame_time > elapsed:
+                return self.segment_start + frame_time
+        return self.segment_start + self.duration
+
+    def seek(self, time):
+        # jumps to any point of the timeline, going back plays it again from the start without running any callback twice
+        if time < self.time:
+            self.owner.pos_x = self.origin_x
+            self.restart(self.start_time)
+        self.update(time)
+
+    def finish(self):
+        # jumps to the end of the timeline, every remaining callback runs in order
+        while not self.done:
+            self.finish_segment()
+
 class BattleNPC(pygame.sprite.Sprite):
+    frame_suffixes = ["_idle", "_move_left", "_move_right", "_attackA", "_attackB", "_attackC", "_hit", "_death", "_duck", "_roll"]
+
     def __init__(self, game, anch_x, anch_y):
         # this is the basic battleNPC class
         # contains basic functions that load frames, play idle animations, contain basic attack functions (that then blossom out based on enemy types)
@@ -969,18 +3695,25 @@ class BattleNPC(pygame.sprite.Sprite):
         self.direction_x = 0
         self.direction_y = 0
         self.animation_time = 0
-        self.animation_cur = 0
+        self.timeline = None # Timeline that is playing right now, None = idle/death animation
         self.delay_var = 0
         self.size_coef = 6
         self.frame_delay = 200
         self.state_death = False
+        self.drawn_x = None # position and frame from the last drawn frame, used to skip idle frames
+        self.drawn_y = None
+        self.drawn_sprite = None
+        self.scaled_frames = {} # base frame -> scaled frame, frames are only scaled once
+        self.python_bytes = 0 # python memory used by the frames, used by MemoryReport
            
 
     def load_frames(self): 
         # much more complicated and thought-out compared to the old load_frames function
         # works for animations with uneven lengths
+        memory_start = python_memory()
         spritesheet = Spritesheet(self.sourcefile+"_battle.png")
         spritelist = list(spritesheet.data["frames"])
+        frame_index = sprite_build.get_frame_index(self.sourcefile+"_battle.png") # animation -> frame names, from tools/build_assets.py
 
         self.frames_idle = []
         self.frames_move_left = []
@@ -993,11 +3726,16 @@ class BattleNPC(pygame.sprite.Sprite):
         self.frames_duck = []
         self.frames_roll = []
         frames = [self.frames_idle, self.frames_move_left, self.frames_move_right, self.frames_attackA, self.frames_attackB, self.frames_attackC, self.frames_hit, self.frames_death, self.frames_duck, self.frames_roll]
-        framesuffixes = ["_idle", "_move_left", "_move_right", "_attackA", "_attackB", "_attackC", "_hit", "_death", "_duck", "_roll"]
+        self.frame_lists = frames
+        framesuffixes = self.frame_suffixes
         suffvar = 0
         
         for framelist in frames:
             frame_prefix = self.sourcefile+framesuffixes[suffvar]
+            if frame_index != None:
+                framelist += [spritesheet.parse_sprite(i) for i in frame_index.get(frame_prefix, [])]
+                suffvar+=1
+                continue
             max_var = 0
             counting_var = 1
             for i in spritelist: # finds the last frame of an animation sequence, marks the number down as max_var
@@ -1015,8 +3753,35 @@ class BattleNPC(pygame.sprite.Sprite):
             suffvar+=1 # moves to the next animation type
         self.cur_frame = 0
         self.image = self.frames_idle[self.cur_frame]
+        self.base_sprite = self.image
         self.cur_sprlist = self.frames_idle
         self.size = self.image.get_size()
+        self.python_bytes = python_memory() - memory_start
+
+    def get_surfaces(self):
+        # returns every frame and the current scaled image, used by MemoryReport
+        surfaces = [self.image] + list(self.scaled_frames.values())
+        for framelist in self.frame_lists:
+            surfaces += framelist
+        return surfaces
+
+    def reload_frames(self):
+        # the spritesheet changed (--hot-reload)
+        # the new frames are copied into the old lists and the new lists are thrown away, timelines keep pointing at the old ones
+        old_lists = self.frame_lists
+        cur_frame = self.cur_frame
+        cur_sprlist = self.cur_sprlist
+        self.load_frames()
+        for old, new in zip(old_lists, self.frame_lists):
+            old[:] = new
+        for suffix, old in zip(self.frame_suffixes, old_lists): # same order as frame_lists
+            setattr(self, "frames" + suffix, old)
+        self.frame_lists = old_lists
+        self.scaled_frames.clear()
+        self.cur_sprlist = cur_sprlist
+        self.cur_frame = min(cur_frame, len(self.cur_sprlist)-1)
+        self.base_sprite = self.cur_sprlist[self.cur_frame]
+        self.size = self.base_sprite.get_size()
 
     def update(self):
         self.set_state()
@@ -1024,30 +3789,89 @@ class BattleNPC(pygame.sprite.Sprite):
     
     def draw_BattleNPC(self):
         self.set_state()
-        self.animate()
-        bigger_sprite = pygame.transform.scale(self.base_sprite, (self.size[0]*self.size_coef, self.size[1]*self.size_coef))
+        if self.timeline is None: # timelines pick their own frames
+            self.animate()
+        bigger_sprite = self.scaled_frames.get(self.base_sprite) # every frame is only scaled once
+        if bigger_sprite is None:
+            bigger_sprite = prepare_surface(pygame.transform.scale(self.base_sprite, (self.size[0]*self.size_coef, self.size[1]*self.size_coef)))
+            self.scaled_frames[self.base_sprite] = bigger_sprite
         self.calibrate_x()
         self.rect.y = self.anch_y - self.size[1]*self.size_coef # sets a stable ground level by changing the sprite's Y coordinate based on its height
         self.image = bigger_sprite
 
+    def check_for_changes(self):
+        # checks if the NPC moved or changed its animation frame since it was last drawn
+        changed = self.drawn_x != self.rect.x or self.drawn_y != self.rect.y or self.drawn_sprite is not self.base_sprite
+        self.drawn_x = self.rect.x
+        self.drawn_y = self.rect.y
+        self.drawn_sprite = self.base_sprite
+        return changed
+
+    def wake_time(self, now):
+        # returns the time of the next animation frame, None = the animation is over
+        if self.state_death and self.cur_frame == len(self.frames_death)-1:
+            return None
+        if self.timeline is not None:
+            if self.timeline.done:
+                return now # waiting for the battle loop to reset the animation state
+            return self.timeline.next_change(now)
+        return self.animation_time + self.frame_delay + 1
+
+    def wake_up(self, now):
+        # called by SpriteGroup.wake when the NPC stops sleeping
+        pass
+
     def set_state(self): # varies based on different subclasses
         pass
     
     def animate(self):
         if self.state_idle: # checks if the NPC is idle
             self.cur_sprlist = self.frames_idle
-        now = pygame.time.get_ticks()
+        now = self.game.ticks
         if now - self.animation_time > self.frame_delay and not (self.state_death and self.cur_frame == len(self.frames_death)-1):
             # The second part of the if statement is to make sure that the death animation only plays once
             self.animation_time = now
             self.cur_frame = (self.cur_frame + 1) % len(self.cur_sprlist)
-        self.base_sprite = self.cur_sprlist[self.cur_frame]
-        self.size = self.base_sprite.get_size()
+        base_sprite = self.cur_sprlist[self.cur_frame]
+        if base_sprite is not self.base_sprite: # get_size() creates a new tuple, so it only runs when the frame changes
+            self.base_sprite = base_sprite
+            self.size = base_sprite.get_size()
         
-    def calibrate_x(self): # only applies to enemy classes
+    def play(self, timeline):
+        # plays timeline, called every frame while the animation state is set
+        if self.timeline is not timeline:
+            self.timeline = timeline
+            timeline.start(self.game.ticks)
+        timeline.update(self.game.ticks)
+
+    def stop_timeline(self):
+        # back to the normal looping animations
+        if self.timeline is None:
+            return
+        self.timeline = None
+        self.cur_frame = 0
+        self.animation_time = self.game.ticks
+        self.frame_delay = 200
+
+    def fast_forward(self):
+        # jumps to the end of the current timeline, every callback (damage, player reactions) still runs
+        if self.timeline is not None:
+            self.timeline.finish()
+
+    def show_frame(self, frames, frame):
+        # called by Timeline
+        self.cur_sprlist = frames
+        self.cur_frame = frame
+        base_sprite = frames[frame]
+        if base_sprite is not self.base_sprite:
+            self.base_sprite = base_sprite
+            self.size = base_sprite.get_size()
+
+    def calibrate_x(self): # keeps the sprite at pos_x, handled by subclasses
         pass
     
     def death(self):
+        self.stop_timeline()
         self.cur_sprlist = self.frames_death
         self.frame_delay = 500
         
@@ -1059,17 +3883,41 @@ class BattlePlayer(BattleNPC):
         self.load_frames()
         self.rect = self.image.get_rect(bottomleft = (anch_x, anch_y), width = self.size[0], height = self.size[1])
 
+        self.pos_x = anch_x
+
         # basic animation variables
-        # each animation is made up of various sub_animations
+        # each animation is a timeline made up of various sub_animations (see Timeline)
+        # speeds are in pixels per second
         self.state_lightattack = False
-        self.lightattack_states = [self.frames_move_right, self.frames_attackA, self.frames_move_left]
+        self.lightattack_timeline = Timeline(self, [
+            {"frames": self.frames_move_right, "delay": 150, "move_to": 750, "speed": 480}, # player moves to the enemy
+            {"frames": self.frames_attackA, "delay": 200, "end_frame": 3}, # player swipes at the enemy
+            {"frames": self.frames_move_left, "delay": 150, "move_to": 100, "speed": 480, # player moves away from the enemy
+             "on_end": lambda: self.end_attack(-50)},
+        ])
         
         self.state_heavyattack = False
-        self.heavyattack_states = [self.frames_move_right, self.frames_roll, self.frames_move_right, self.frames_attackC, self.frames_move_left]
+        self.heavyattack_timeline = Timeline(self, [
+            {"frames": self.frames_move_right, "delay": 200, "move_to": 200, "speed": 480}, # player moves to enemy
+            {"frames": self.frames_roll, "delay": 65, "end_frame": 11, "speed": 480}, # player rolls towards the enemy
+            {"frames": self.frames_move_right, "delay": 200, "move_to": 750, "speed": 480}, # first swipe
+            {"frames": self.frames_attackC, "delay": 100, "end_frame": 9}, # second swipe
+            {"frames": self.frames_move_left, "delay": 200, "move_to": 100, "speed": 480, # player moves away from the enemy
+             "on_end": lambda: self.end_attack(-150)},
+        ])
 
         self.state_duck = False
+        self.duck_timeline = Timeline(self, [
+            {"frames": self.frames_duck, "delay": {0: 200, 1: 1500}, "end_frame": 2, "on_end": lambda: self.end_defence("state_duck")},
+        ])
         self.state_counterattack = False
+        self.counterattack_timeline = Timeline(self, [
+            {"frames": self.frames_attackA, "delay": {0: 1800, 1: 200}, "end_frame": 3, "on_end": lambda: self.end_defence("state_counterattack")},
+        ])
         self.state_roll = False
+        self.roll_timeline = Timeline(self, [
+            {"frames": self.frames_roll, "delay": 125, "end_frame": 11, "on_end": lambda: self.end_defence("state_roll")},
+        ])
 
     def set_state(self): # chooses the correct animation based on the variable
         if self.state_death:
@@ -1085,128 +3933,49 @@ class BattlePlayer(BattleNPC):
         elif self.state_counterattack:
             self.counterattack()
         else:
+            self.stop_timeline()
             self.cur_sprlist = self.frames_idle
 
+    def calibrate_x(self):
+        self.rect.x = self.pos_x
+
     def light_attack(self):
         # this is the light attack animation
         # player moves to the enemy, swipes and moves back
-        self.cur_sprlist = self.lightattack_states[self.animation_cur]
-        if self.animation_cur == 0:
-            # player moves to the enemy
-            if self.rect.x <= 750:
-                self.rect.x += 4
-                self.frame_delay = 150
-            else:
-                self.rect.x = 750
-                self.animation_cur+=1
-                self.cur_frame = 0
-                self.frame_delay = 200
-        elif self.animation_cur == 1:
-            # player swipes at the enemy
-            if self.cur_frame == 3:
-                self.animation_cur+=1
-                self.cur_frame = 0
-                self.frame_delay = 150
-        elif self.animation_cur == 2:
-            # player moves away from the enemy
-            if self.rect.x >= 100:
-                self.rect.x -=4
-            else:
-                self.frame_delay = 200
-                self.rect.x = 100
-                self.cur_frame = 0
-                self.animation_cur = 0
-                self.game.battleloop_var += 1
-                self.game.tally(0,-50,1)
+        self.play(self.lightattack_timeline)
 
     def heavy_attack(self):
         #this is the heavy attack animation
         #player rolls to the enemy, swipes twice, and runs back
-        self.cur_sprlist = self.heavyattack_states[self.animation_cur]
-        if self.animation_cur == 0:
-            # player moves to enemy
-            if self.rect.x <= 200:
-                self.rect.x += 4
-            else:
-                self.rect.x = 200
-                self.animation_cur+=1
-                self.cur_frame = 0
-                self.frame_delay = 65
-        elif self.animation_cur == 1:
-            # player rolls towards the enemy
-            self.rect.x += 4
-            if self.cur_frame == 11:
-                self.animation_cur+=1
-                self.cur_frame = 0
-                self.frame_delay = 200
-        elif self.animation_cur == 2:
-            # first swipe
-            if self.rect.x <= 750:
-                self.rect.x += 4
-            else:
-                self.rect.x = 750
-                self.animation_cur+=1
-                self.cur_frame = 0
-                self.frame_delay = 100
-        elif self.animation_cur == 3:
-            # second swipe
-            if self.cur_frame == 9:
-                self.animation_cur+=1
-                self.cur_frame = 0
-                self.frame_delay = 200
-        elif self.animation_cur == 4:
-            # player moves away from the enemy
-            if self.rect.x >= 100:
-                self.rect.x -= 4
-            else:
-                self.rect.x = 100
-                self.cur_frame = 0
-                self.animation_cur = 0
-                self.game.battleloop_var += 1
-                self.game.tally(0,-150,1)
+        self.play(self.heavyattack_timeline)
 
     def duck(self):
         # this is the duck animation
-        self.cur_sprlist = self.frames_duck
-        if self.cur_frame >= len(self.cur_sprlist): # this is here to prevent outofrange errors when called by other functions
-            self.cur_frame = 0
-
-        if self.cur_frame == 1:
-            self.frame_delay = 1500
-        elif self.cur_frame == 2:
-            self.frame_delay = 200
-            self.cur_frame = 0
-            self.state_duck = False
-            self.state_idle = True
+        self.play(self.duck_timeline)
         
     def counterattack(self):
         # this is the counterattack animation
-        self.cur_sprlist = self.frames_attackA
-        if self.cur_frame >= len(self.cur_sprlist): # this is here to prevent outofrange errors when called by other functions
-            self.cur_frame = 0
-
-        if self.cur_frame == 0:
-            self.frame_delay = 1800
-        elif self.cur_frame == 1:
-            self.frame_delay = 200
-        elif self.cur_frame == 3:
-            self.cur_frame = 0
-            self.state_counterattack = False
-            self.state_idle = True
+        self.play(self.counterattack_timeline)
 
     def roll(self):
         # this is the roll animation
-        self.cur_sprlist = self.frames_roll
-        if self.cur_frame >= len(self.cur_sprlist): # this is here to prevent outofrange errors when called by other functions
-            self.cur_frame = 0
-
-        if self.cur_frame == 0:
-            self.frame_delay = 125
-        elif self.cur_frame == 11:
-            self.cur_frame = 0
-            self.frame_delay = 200
-            self.state_roll = False
-            self.state_idle = True
+        self.play(self.roll_timeline)
+
+    def end_attack(self, maxdmg_player):
+        # the player is back where they started, the damage is dealt
+        self.game.battleloop_var += 1
+        self.game.tally(0,maxdmg_player,1)
+
+    def defend(self, state, prev_state=None):
+        # triggered by enemy timelines, switches to a duck/roll/counterattack animation
+        if prev_state:
+            setattr(self, prev_state, False)
+        setattr(self, state, True)
+
+    def end_defence(self, state):
+        # duck/roll/counterattack is over, back to the idle animation
+        setattr(self, state, False)
+        self.state_idle = True
 
 class BattleEnemy(BattleNPC):
     def __init__(self, game, anch_x, anch_y):
@@ -1232,13 +4001,19 @@ class BattleEnemy(BattleNPC):
         elif self.state_attackB:
             self.attackB()
         else:
+            self.stop_timeline()
             self.cur_sprlist = self.frames_idle
 
-    def attackA(self): # handled by specific enemy subclasses
-        pass
+    def attackA(self): # the timeline is set up by specific enemy subclasses
+        self.play(self.attackA_timeline)
     def attackB(self): # handled by specific enemy subclasses
         pass
 
+    def end_attack(self, maxdmg_enemy):
+        # the enemy is back where it started, the damage is dealt
+        self.game.battleloop_var += 1
+        self.game.tally(maxdmg_enemy,0,2)
+
 class BattleGoblin(BattleEnemy):
     def __init__(self, game, anch_x, anch_y):
         super().__init__(game, anch_x, anch_y)
@@ -1251,58 +4026,17 @@ class BattleGoblin(BattleEnemy):
         self.rect = self.image.get_rect(bottomleft = (anch_x, anch_y), width = self.size[0], height = self.size[1])
         
         # basic animation variables
-        self.attackA_states = [self.frames_move_left, self.frames_attackA, self.frames_attackB, self.frames_move_right]
-
-    def attackA(self):
-        # this is the attackA animation
         # goblin runs up to the player, swipes twice and runs away
-        self.cur_sprlist = self.attackA_states[self.animation_cur]
-        if self.animation_cur == 0:
-            # goblin runs to player
-            if self.pos_x >= 500:
-                self.pos_x -= 5
-            else:
-                self.pos_x = 500
-                self.animation_cur+=1
-                self.cur_frame = 0
-                self.frame_delay = 50
-                # player animation triggers
-                self.game.B_player.cur_frame = 0
-                self.game.B_player.state_duck = True
-        elif self.animation_cur == 1:
-            # first swipe
-            if self.cur_frame == 8:
-                self.pos_x = 500
-                self.animation_cur+=1
-                self.cur_frame = 0
-                self.frame_delay = 500
-                # player defend triggers
-                self.game.B_player.cur_frame = 0
-                self.game.B_player.state_duck = False
-                self.game.B_player.state_roll = True
-        elif self.animation_cur == 2:
-            # second swipe
-            if self.cur_frame == 1:
-                self.frame_delay = 100
-            elif self.cur_frame == 8:
-                self.frame_delay = 400
-            elif self.cur_frame == 9:
-                self.frame_delay = 200
-                self.animation_cur+=1
-                self.cur_frame = 0
-                # player animation reset
-                self.game.B_player.cur_frame = 0
-        elif self.animation_cur == 3:
-            # goblin runs away
-            if self.pos_x <= self.anch_x:
-                self.pos_x += 5
-            else:
-                self.pos_x = self.anch_x
-                self.cur_frame = 0
-                self.animation_cur = 0
-
-                self.game.battleloop_var += 1
-                self.game.tally(-40,0,2)
+        player = self.game.B_player
+        self.attackA_timeline = Timeline(self, [
+            {"frames": self.frames_move_left, "delay": 200, "move_to": 500, "speed": 600, # goblin runs to player
+             "on_end": lambda: player.defend("state_duck")}, # player animation triggers
+            {"frames": self.frames_attackA, "delay": 50, "end_frame": 8, # first swipe
+             "on_end": lambda: player.defend("state_roll", "state_duck")}, # player defend triggers
+            {"frames": self.frames_attackB, "delay": {0: 500, 1: 100, 8: 400}, "end_frame": 9}, # second swipe
+            {"frames": self.frames_move_right, "delay": 200, "move_to": self.anch_x, "speed": 600, # goblin runs away
+             "on_end": lambda: self.end_attack(-40)},
+        ])
         
 class BattleSkeleton(BattleEnemy):
     def __init__(self, game, anch_x, anch_y):
@@ -1315,59 +4049,18 @@ class BattleSkeleton(BattleEnemy):
         self.rect = self.image.get_rect(bottomleft = (anch_x, anch_y), width = self.size[0], height = self.size[1])
 
         # basic animation variables
-        self.attackA_states = [self.frames_move_left, self.frames_attackA, self.frames_attackB, self.frames_move_right]
-
-    def attackA(self):
-        # this is the attackA animation
         # skeleton moves to the player, swipes twice, and moves away
-        self.cur_sprlist = self.attackA_states[self.animation_cur]
-        if self.animation_cur == 0:
-            # skeleton moves to player
-            if self.pos_x >= 680:
-                self.pos_x -= 4
-            else:
-                self.pos_x = 680
-                self.animation_cur+=1
-                self.cur_frame = 0
-                # player animation triggers
-                self.game.B_player.cur_frame = 0
-                self.game.B_player.state_duck = True
-                self.frame_delay = 100
-        elif self.animation_cur == 1:
-            # first swipe
-            if self.cur_frame == 7:
-                self.animation_cur+=1
-                self.cur_frame = 0
-                self.frame_delay = 700
-                # player defend triggers
-                self.game.B_player.cur_frame = 0
-                self.game.B_player.state_duck = False
-                self.game.B_player.state_counterattack = True
-        elif self.animation_cur == 2:
-            # second swipe
-            if self.cur_frame == 1:
-                self.frame_delay = 100
-            elif self.cur_frame == 8:
-                self.frame_delay = 600
-            elif self.cur_frame == 9:
-                self.frame_delay = 200
-                self.animation_cur+=1
-                self.cur_frame = 0
-                # player animation reset
-                self.game.B_player.cur_frame = 0
-                self.game.B_player.state_counterattack = False
-                self.game.B_player.state_idle = True
-        elif self.animation_cur == 3:
-            # skeleton moves away
-            if self.pos_x <= self.anch_x:
-                self.pos_x += 4
-            else:
-                self.pos_x = self.anch_x
-                self.cur_frame = 0
-                self.animation_cur = 0
-                
-                self.game.battleloop_var += 1
-                self.game.tally(-40,0,2)
+        player = self.game.B_player
+        self.attackA_timeline = Timeline(self, [
+            {"frames": self.frames_move_left, "delay": 200, "move_to": 680, "speed": 480, # skeleton moves to player
+             "on_end": lambda: player.defend("state_duck")}, # player animation triggers
+            {"frames": self.frames_attackA, "delay": 100, "end_frame": 7, # first swipe
+             "on_end": lambda: player.defend("state_counterattack", "state_duck")}, # player defend triggers
+            {"frames": self.frames_attackB, "delay": {0: 700, 1: 100, 8: 600}, "end_frame": 9, # second swipe
+             "on_end": lambda: player.end_defence("state_counterattack")}, # player animation reset
+            {"frames": self.frames_move_right, "delay": 200, "move_to": self.anch_x, "speed": 480, # skeleton moves away
+             "on_end": lambda: self.end_attack(-40)},
+        ])
 
 class BattleWorm(BattleEnemy):
     def __init__(self, game, anch_x, anch_y):
@@ -1380,20 +4073,16 @@ class BattleWorm(BattleEnemy):
         self.rect = self.image.get_rect(bottomleft = (anch_x, anch_y), width = self.size[0], height = self.size[1])
 
         # basic animation variables
-        self.attackA_states = [self.frames_attackA]
-
-    def attackA(self):
         # simple animation, fireworm just shoots a fireball
-        self.cur_sprlist = self.attackA_states[self.animation_cur]
-        if self.cur_frame == 8:
-            self.game.B_player.state_duck = True
-        elif self.cur_frame == 10:
-            self.game.fireball.rect.x = 900
-        elif self.cur_frame == 15:
-            self.cur_frame = 0
-            self.animation_cur = 0
-            self.game.battleloop_var+=1
-            self.game.tally(-50,0,2)
+        self.attackA_timeline = Timeline(self, [
+            {"frames": self.frames_attackA, "delay": 200, "end_frame": 15,
+             "at_frame": {8: lambda: self.game.B_player.defend("state_duck"), 10: self.shoot_fireball},
+             "on_end": lambda: self.end_attack(-50)},
+        ])
+
+    def shoot_fireball(self):
+        self.game.fireball.rect.x = 900
+        self.game.game_battle_sprites.wake(self.game.fireball, self.game.ticks)
 
     def death(self):
         super().death()
@@ -1410,6 +4099,8 @@ class BattleFireball(BattleNPC):
 
     def set_state(self):
         if self.rect.x <= -200:
+            # off the screen until the worm shoots it again (BattleWorm.attackA wakes it up)
+            self.game.game_battle_sprites.sleep(self, visible=False)
             return
         else:
             if self.rect.x >= -200:
@@ -1419,9 +4110,12 @@ class BattleMenu(pygame.sprite.Sprite):
     def __init__(self, game, player_health):
         super().__init__()
         self.game = game
+        self.sourcefile = "key_assets"
         self.player_health = player_health
+        memory_start = python_memory()
         self.load_variables() # loads all the basic variables
         self.load_spritevariables() # loads all the sprite-related variables
+        self.python_bytes = python_memory() - memory_start # used by MemoryReport
     
     def load_variables(self):
         self.selection = 0
@@ -1448,11 +4142,17 @@ class BattleMenu(pygame.sprite.Sprite):
     def create_text(self):
         name_list = ["Attack", "Heavy Attack", "Potion"]
         self.text_list = []
+        self.button_pos = [] # button and text positions are calculated once instead of every frame
+        self.text_pos = []
+        var = 100
         for i in name_list:
             text = self.font.render(i, True, (0,0,0)) # bold text, black colour
             textwidth = text.get_size()
             self.text_list.append(text)
             self.text_list.append(textwidth)
+            self.button_pos.append((var,25))
+            self.text_pos.append((var+125-textwidth[0]/2, 50-textwidth[1]/2))
+            var += 365
 
     def load_qtbuttons(self):
         # works identically to the one found in BattleNPC
@@ -1481,7 +4181,7 @@ class BattleMenu(pygame.sprite.Sprite):
                     if i == frame_prefix + str(counting_var) + ".png":
                         parsed_frame = spritesheet.parse_sprite(i)
                         pf_size = parsed_frame.get_size()
-                        bigger_frame = pygame.transform.scale(parsed_frame, (pf_size[0]*2,pf_size[1]*2))
+                        bigger_frame = prepare_surface(pygame.transform.scale(parsed_frame, (pf_size[0]*2,pf_size[1]*2)))
                         framelist.append(bigger_frame)
                         counting_var+=1
             suffvar+=1 # moves to the next key type
@@ -1492,6 +4192,21 @@ class BattleMenu(pygame.sprite.Sprite):
         self.check_selection()
         self.paint_buttons()
 
+    def get_surfaces(self):
+        # returns the menu surface, buttons, text and QTE keys, used by MemoryReport
+        surfaces = [self.image] + self.button_list + self.keys_correct + self.keys_default + self.keys_failed
+        for i in self.text_list:
+            if isinstance(i, pygame.Surface): # text_list contains both text surfaces and their sizes
+                surfaces.append(i)
+        return surfaces
+
+    def check_for_changes(self):
+        # the menu only changes after a key press or a change in the battle loop, both are handled by MainGame
+        return False
+
+    def wake_time(self, now):
+        return None
+
     def check_selection(self):
         # ensures that the selection variable remains within self.menu_list
         if self.selection < 0:
@@ -1502,24 +4217,19 @@ class BattleMenu(pygame.sprite.Sprite):
     def paint_buttons(self):
         # if there is an active attack happening, paint the QTE buttons
         if self.active_attack:
-            var = 18
-            for key in self.key_sprites:
-                self.image.blit(key, (var,16)) # second variable sets a ground level for every key
-                var += self.gap
+            for pos in range(len(self.key_sprites)):
+                self.image.blit(self.key_sprites[pos], self.key_pos[pos])
         else:
-            var = 100
             text_var = 0
-            for i in self.button_list:
-                if i == self.button_list[self.selection]:
+            for pos in range(len(self.button_list)):
+                i = self.button_list[pos]
+                if pos == self.selection:
                     i.fill((100,100,100))
                 else:
                     i.fill((200,200,200))
                 pygame.draw.rect(i, (200,200,200), (5,5,240,40))
-                self.image.blit(i, (var,25))
-                text = self.text_list[text_var]
-                t_size = self.text_list[text_var+1]
-                self.image.blit(text, (var+125-t_size[0]/2, 50-t_size[1]/2))
-                var += 365
+                self.image.blit(i, self.button_pos[pos])
+                self.image.blit(self.text_list[text_var], self.text_pos[pos])
                 text_var+=2
 
     def attack(self):
@@ -1527,7 +4237,7 @@ class BattleMenu(pygame.sprite.Sprite):
         self.hits = 0
         self.combo = []
         # W=0, A=1, S=2, D=3, J=4, K=5
-        self.qt_event = r.choice([[3,0,3,4,5,1], [3,1,2,3,5,5], [1,3,1,3,4,5]])
+        self.qt_event = self.game.battle_random.choice([[3,0,3,4,5,1], [3,1,2,3,5,5], [1,3,1,3,4,5]])
         self.create_qtbuttons()
         self.game.B_player.state_lightattack = True # animation trigger
 
@@ -1536,7 +4246,7 @@ class BattleMenu(pygame.sprite.Sprite):
         self.hits = 0
         self.combo = []
         # W=0, A=1, S=2, D=3, J=4, K=5
-        self.qt_event = r.choice([[3,3,2,2,3,4,5,4,1], [3,0,1,3,2,3,4,5,5], [3,4,2,4,0,5,4,2,5]])
+        self.qt_event = self.game.battle_random.choice([[3,3,2,2,3,4,5,4,1], [3,0,1,3,2,3,4,5,5], [3,4,2,4,0,5,4,2,5]])
         self.create_qtbuttons()
         self.game.B_player.state_heavyattack = True # animation trigger
 
@@ -1545,7 +4255,7 @@ class BattleMenu(pygame.sprite.Sprite):
         self.hits = 0
         self.combo = []
         # W=0, A=1, S=2, D=3, J=4, K=5
-        self.qt_event = r.choice([[1,1,2,3,2,1], [1,2,1,4,4,2], [0,2,2,1,3,5]])
+        self.qt_event = self.game.battle_random.choice([[1,1,2,3,2,1], [1,2,1,4,4,2], [0,2,2,1,3,5]])
         self.create_qtbuttons()
         # defend animation are handled by BattleEnemy subclasses
 
@@ -1557,6 +4267,11 @@ class BattleMenu(pygame.sprite.Sprite):
             self.key_sprites.append(key)
         key_num = len(self.key_sprites)
         self.gap = 1080//(key_num-1) # gap is an integer
+        self.key_pos = []
+        var = 18
+        for i in range(key_num):
+            self.key_pos.append((var,16)) # second variable sets a ground level for every key
+            var += self.gap
 
     def items(self):
         self.game.drinking_potion = True
@@ -1573,6 +4288,79 @@ class BattleMenu(pygame.sprite.Sprite):
             self.hits+=1
         else:
             self.key_sprites[button_pos] = self.keys_failed[button_val] # replace the default key with a red key
-
-g = MainGame()
-g.game_loop()
\ No newline at end of file
+        self.game.input_latency.press() # the new key is on the screen once the frame is flipped
+
+def positive_int(text):
+    # argparse type for options that need at least 1
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("has to be at least 1, not %d" % value)
+    return value
+
+def parse_address(text):
+    # "ADDRESS:PORT" or just "PORT" (localhost) -> (address, port)
+    address, colon, port = text.rpartition(":")
+    return (address or "127.0.0.1", int(port))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kastles and Krakens")
+    parser.add_argument("--frame-stats", metavar="FILE", help="write frame timing statistics (.csv) into FILE on exit")
+    parser.add_argument("--trace", metavar="FILE", help="record a Chrome/Perfetto trace (.json) into FILE, same as KK_TRACE=FILE")
+    parser.add_argument("--memory-report", metavar="FILE", help="measure python memory with tracemalloc, write the memory report into FILE on exit")
+    parser.add_argument("--count-allocations", action="store_true", help="count Python allocations and garbage collections per frame (debug)")
+    parser.add_argument("--check-surfaces", action="store_true", help="report surfaces that are drawn every frame but aren't in the screen's pixel format (debug)")
+    parser.add_argument("--record", metavar="FILE", help="record every key press into FILE (the game runs with a fixed timestep)")
+    parser.add_argument("--replay", metavar="FILE", help="replay a recorded session headless and as fast as possible")
+    parser.add_argument("--seed", type=int, help="seed for the random number generators")
+    parser.add_argument("--world", metavar="DIR", default="", help="load the world (maplist.csv and room_bgs) from DIR, see tools/generate_world.py")
+    parser.add_argument("--sim-budget", type=int, default=200, metavar="N", help="enemies in neighbouring rooms that can be updated per frame")
+    parser.add_argument("--sim-workers", type=int, default=0, metavar="N", help="simulate distant rooms in N worker processes")
+    parser.add_argument("--ai-rate", type=float, default=10, metavar="HZ", help="how many times per second overworld enemies make decisions (60 = every frame)")
+    parser.add_argument("--save", metavar="FILE", help="resume the game from FILE (if it exists), save into it every few seconds and on exit")
+    parser.add_argument("--hot-reload", action="store_true", help="reload rooms and spritesheets as soon as their files change")
+    parser.add_argument("--render-thread", action="store_true", help="draw and flip frames on a separate thread, the simulation doesn't wait for the screen")
+    parser.add_argument("--host", metavar="ADDRESS:PORT", type=parse_address, help="host a co-op game, a second player can join with --join")
+    parser.add_argument("--join", metavar="ADDRESS:PORT", type=parse_address, help="join a co-op game hosted with --host")
+    parser.add_argument("--profile-frames", type=positive_int, default=300, metavar="N", help="number of frames F5 profiles with cProfile")
+    parser.add_argument("--headless", action="store_true", help="run without a window")
+    args = parser.parse_args()
+    if args.headless or args.replay:
+        os.environ["SDL_VIDEODRIVER"] = "dummy" # SDL renders into memory instead of a window
+        pygame.display.quit()
+        pygame.display.init()
+    if args.trace:
+        tracer.start(args.trace)
+    if args.memory_report:
+        tracemalloc.start() # has to start before anything gets loaded
+
+    g = MainGame(args.world)
+    g.frame_stats_file = args.frame_stats
+    g.frame_profiler.frames = args.profile_frames
+    g.memory_report_file = args.memory_report
+    g.simulation.budget = args.sim_budget
+    g.simulation.workers = args.sim_workers
+    g.set_ai_rate(args.ai_rate)
+    if args.count_allocations:
+        g.frame_timer.enable_allocation_counter()
+    surface_check.enabled = args.check_surfaces
+    if args.replay:
+        g.start_replay(args.replay)
+    elif args.record:
+        g.start_recording(args.record, args.seed)
+    elif args.seed != None:
+        g.set_seed(args.seed)
+    if args.sim_workers:
+        g.simulation.start_pool() # after the seeds (the pool is seeded by ai_random), before any threads
+    if args.render_thread:
+        g.start_render_thread()
+    if args.hot_reload:
+        g.asset_watcher = AssetWatcher(g)
+    if args.save:
+        g.start_saving(args.save)
+    if args.host:
+        g.start_hosting(args.host)
+    if args.join:
+        CoopClient(g, args.join).run() # the host runs the game, the client only sends keys and draws
+    else:
+        g.game_loop()
+    g.shutdown()
\ No newline at end of file
@@ -0,0 +1,275 @@
+import os, sys, json, time, glob, platform, argparse, statistics, importlib.util
+
+# benchmark suite for Kastles and Krakens
+# every scenario runs headless, the timings are written into a .json file and compared against a stored baseline
+# usage: python benchmarks/run_benchmarks.py [--quick] [--only NAME] [--update-baseline] [--threshold 0.10]
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+GAME_DIR = os.path.dirname(BENCH_DIR)
+
+os.environ["SDL_VIDEODRIVER"] = "dummy" # SDL renders into memory instead of a window
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+os.chdir(GAME_DIR) # the game loads every asset relative to its own directory
+
+def load_game():
+    # the game is a single script with spaces in its name, so it can't be imported normally
+    sys.path.insert(0, GAME_DIR) # the game imports simulation.py from its own directory
+    spec = importlib.util.spec_from_file_location("kastles_and_krakens", os.path.join(GAME_DIR, "Kastles and Krakens.py"))
+    game = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(game)
+    return game
+
+kk = load_game()
+pygame = kk.pygame
+
+class Benchmark():
+    # runs every scenario and stores its timings (in seconds)
+    def __init__(self, quick=False, only=None, world_dir=""):
+        self.quick = quick
+        self.world_dir = world_dir
+        self.only = only
+        self.repeats = 3 if quick else 7
+        self.results = {}
+
+    def wanted(self, name):
+        return self.only == None or any(i in name for i in self.only)
+
+    def measure(self, name, func, repeats=None):
+        # runs func several times and keeps the median, the median ignores one-off hitches
+        if not self.wanted(name):
+            return
+        samples = []
+        for i in range(repeats or self.repeats):
+            start = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - start)
+        self.results[name] = statistics.median(samples)
+        print("%-45s %10.3f ms" % (name, self.results[name]*1000))
+
+    def run(self):
+        self.create_game()
+        self.bench_load_rooms()
+        self.bench_tilemaps()
+        self.bench_spritesheets()
+        self.bench_overworld()
+        self.bench_battles()
+        return self.results
+
+    def create_game(self):
+        # same as MainGame(), but the first load_rooms call is timed separately (cold start)
+        game = kk.MainGame.__new__(kk.MainGame)
+        game.world_dir = self.world_dir
+        game.load_variables()
+        start = time.perf_counter()
+        game.load_rooms()
+        cold = time.perf_counter() - start
+        game.freeze_memory()
+        if self.wanted("load_rooms.cold"):
+            self.results["load_rooms.cold"] = cold
+            print("%-45s %10.3f ms" % ("load_rooms.cold", cold*1000))
+        self.game = game
+
+    def bench_load_rooms(self):
+        # load_rooms only reads the world index, rooms are loaded once the player walks into them
+        # every file is already cached by the OS at this point
+        self.measure("load_rooms.warm", self.game.load_rooms)
+        self.measure("load_rooms.every_room", self.load_every_room)
+        self.game.load_rooms() # fresh rooms for the scenarios below
+
+    def load_every_room(self):
+        # the same amount of work the game used to do on startup
+        self.game.load_rooms()
+        self.rooms()
+
+    def rooms(self):
+        # loads every room in the world, returns every unique room
+        world = self.game.world
+        for chunk in world.chunks:
+            world.load_chunk(chunk)
+        rooms = {}
+        for x, y in list(world.room_names):
+            room = world.get_room(x, y)
+            rooms[room.name] = room
+        return rooms
+
+    def bench_tilemaps(self):
+        # rooms built by tools/build_assets.py are loaded as a PrebuiltMap, drawing one is a single blit
+        # the TileMap timings always load the .tmx file, so they stay comparable with or without a build/ directory
+        room_dir = self.game.world.room_dir
+        for name, room in sorted(self.rooms().items()):
+            tilemap = kk.TileMap(os.path.join(room_dir, name + ".tmx"))
+            self.measure("TileMap.load_map." + name, tilemap.load_map)
+            surface = pygame.Surface((tilemap.width, tilemap.height))
+            self.measure("TileMap.draw_map." + name, lambda: tilemap.draw_map(surface))
+            if isinstance(room.map, kk.PrebuiltMap):
+                self.measure("PrebuiltMap.draw_map." + name, lambda: room.map.draw_map(surface))
+
+    def bench_spritesheets(self):
+        for path in sorted(glob.glob(os.path.join("spritesheets", "*.png"))):
+            filename = os.path.basename(path)
+            if filename.startswith("atlas"): # atlas pages from tools/build_atlas.py aren't spritesheets
+                continue
+            self.measure("Spritesheet." + filename, lambda: self.parse_spritesheet(filename))
+
+    def parse_spritesheet(self, filename):
+        # loads the sheet and cuts out every frame
+        spritesheet = kk.Spritesheet(filename)
+        for name in spritesheet.data["frames"]:
+            spritesheet.parse_sprite(name)
+
+    def reset_game(self, seed=0):
+        # puts the game back into the starting room with a fixed timestep and fixed seeds
+        game = self.game
+        game.fixed_timestep = True
+        game.set_seed(seed)
+        game.frame_count = 0
+        game.roaming = True
+        game.player_health = 100
+        game.enemy_health = 100
+        game.battleloop_var = 1
+        game.text_list.clear()
+        game.ow_posX = 2
+        game.ow_posY = 2
+        game.prev_ow_posX = None
+        game.prev_ow_posY = None
+        game.player.position_x = 624
+        game.player.position_y = 600
+        game.player.rect.topleft = (624, 600)
+        game.redraw = True
+        game.run_frame() # loads the room
+        game.game_sprites.empty()
+        game.game_sprites.add(game.player)
+
+    def create_enemies(self, count):
+        # spreads walkers and chargers around the room, far enough from the player that they never start a battle
+        enemy_list = []
+        sprites = ["goblin", "skeleton", "fireworm"]
+        for i in range(count):
+            x = 100 + (i*197) % 1000
+            y = 100 + (i*89) % 250
+            if i % 2:
+                y += 550 # bottom half of the room, the player stands in the middle
+            enemy_type = "charger" if sprites[i % 3] == "fireworm" else "walker" # only fireworms have charging frames
+            enemy_list.append([x, y, sprites[i % 3], enemy_type, 60, 1.5, 10000+i])
+        self.game.load_enemies(enemy_list)
+
+    def bench_overworld(self):
+        frames = 1000 if self.quick else 10000
+        for count in (0, 4, 16):
+            name = "overworld.%dframes.%denemies" % (frames, count)
+            if not self.wanted(name):
+                continue
+            self.reset_game()
+            self.create_enemies(count)
+            self.measure(name, lambda: self.run_frames(frames), repeats=1)
+        # same as above, but the frames are drawn on the render thread (--render-thread)
+        name = "overworld.%dframes.16enemies.render_thread" % frames
+        if self.wanted(name):
+            self.reset_game()
+            self.create_enemies(16)
+            self.measure(name, lambda: self.run_frames_threaded(frames), repeats=1)
+            print("%-45s %d frames drawn, %d dropped" % ("", self.frames_drawn, self.frames_dropped))
+
+    def run_frames_threaded(self, frames):
+        # the render thread doesn't drop any frames and the time only stops once the last one is drawn,
+        # otherwise this would only measure how fast the simulation runs
+        game = self.game
+        game.start_render_thread()
+        render_thread = game.render_thread
+        render_thread.drop_frames = False
+        self.run_frames(frames)
+        game.stop_render_thread()
+        self.frames_drawn = render_thread.frames_drawn
+        self.frames_dropped = render_thread.frames_dropped
+
+    def run_frames(self, frames):
+        game = self.game
+        for i in range(frames):
+            game.run_frame()
+        if not game.roaming:
+            raise RuntimeError("an enemy started a battle during the overworld benchmark")
+
+    def bench_battles(self):
+        for sprite in ("goblin", "skeleton", "fireworm"):
+            name = "battle." + sprite
+            if self.wanted(name):
+                self.measure(name, lambda: self.run_battle(sprite))
+            # the same battle, but every animation jumps straight to its end
+            self.measure(name + ".fast_forward", lambda: self.run_battle(sprite, True))
+
+    def run_battle(self, sprite, fast_forward=False, max_frames=20000):
+        # plays a full battle: the player always picks a light attack and hits every QTE key
+        self.reset_game()
+        game = self.game
+        if sprite == "fireworm":
+            enemy = kk.Charger(game, sprite, 0, 0, 60, 8, 1.5, -1)
+        else:
+            enemy = kk.Walker(game, sprite, 0, 0, 60, 4, 1.5, -1)
+        game.trigger_battle_phase(enemy)
+        frames = 0
+        while not game.roaming:
+            if game.battleloop_var == 1 and not game.B_player.state_death:
+                game.menu.selection = 0
+                game.select_action_from_menu()
+            elif game.menu.active_attack and len(game.menu.combo) < len(game.menu.qt_event):
+                game.attack(game.menu.qt_event[len(game.menu.combo)])
+            elif fast_forward:
+                game.fast_forward_battle() # the QTE is over, nothing left to wait for
+            game.run_frame()
+            frames += 1
+            if frames > max_frames or game.B_player.state_death:
+                raise RuntimeError("the battle against %s didn't end" % sprite)
+
+def compare(results, baseline, threshold):
+    # returns a list of scenarios that got slower than the baseline by more than threshold
+    regressions = []
+    print()
+    print("%-45s %10s %10s %8s" % ("scenario", "baseline", "current", "change"))
+    for name in sorted(results):
+        if name not in baseline:
+            print("%-45s %10s %8.3f ms %8s" % (name, "-", results[name]*1000, "new"))
+            continue
+        change = results[name]/baseline[name] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-45s %7.3f ms %7.3f ms %+7.1f%%%s" % (name, baseline[name]*1000, results[name]*1000, change*100, flag))
+    return regressions
+
+def write_results(filename, results):
+    data = {
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": results,
+    }
+    with open(filename, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kastles and Krakens benchmarks")
+    parser.add_argument("--output", metavar="FILE", default=os.path.join(BENCH_DIR, "results.json"), help="write the timings (.json) into FILE")
+    parser.add_argument("--baseline", metavar="FILE", default=os.path.join(BENCH_DIR, "baseline.json"), help="compare the timings against FILE")
+    parser.add_argument("--update-baseline", action="store_true", help="store the timings as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown before a scenario counts as a regression (0.10 = 10%%)")
+    parser.add_argument("--only", metavar="NAME", action="append", help="only run scenarios whose name contains NAME")
+    parser.add_argument("--world", metavar="DIR", default="", help="run the benchmarks in a generated world (tools/generate_world.py)")
+    parser.add_argument("--quick", action="store_true", help="fewer frames and repeats")
+    args = parser.parse_args()
+
+    results = Benchmark(args.quick, args.only, args.world).run()
+    write_results(args.output, results)
+    if args.update_baseline:
+        write_results(args.baseline, results)
+        print("baseline written into", args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("%d scenario(s) slower than the baseline by more than %d%%" % (len(regressions), args.threshold*100))
+            sys.exit(1)
+    else:
+        print("no baseline found, run with --update-baseline to create one")
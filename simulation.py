@@ -0,0 +1,277 @@
+import pygame
+import random as r
+from multiprocessing import shared_memory
+
+# the parts of the world simulation that also run in SimulationPool's worker processes
+# kept out of the game script on purpose: importing this module doesn't initialise pygame or open a window,
+# only pygame.Rect is used
+# see WorldSimulation and SimulationPool in "Kastles and Krakens.py"
+
+class WallGrid():
+    # splits walls into a grid of cells, collision checks only look at walls in the cells the rect touches
+    def __init__(self, cell_width, cell_height, wall_list=()):
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.cells = {} # (cell x, cell y) -> walls that touch the cell
+        for wall in wall_list:
+            self.add(wall)
+
+    def add(self, wall):
+        for cell_y in range(wall.top//self.cell_height, (wall.bottom-1)//self.cell_height + 1):
+            for cell_x in range(wall.left//self.cell_width, (wall.right-1)//self.cell_width + 1):
+                self.cells.setdefault((cell_x, cell_y), []).append(wall)
+
+    def near(self, rect):
+        # returns walls from the cells the rect touches, most of the time that's a single cell and its list is returned as it is
+        # walls that touch more than one cell can show up more than once
+        first_x = rect.left//self.cell_width
+        first_y = rect.top//self.cell_height
+        last_x = (rect.right-1)//self.cell_width
+        last_y = (rect.bottom-1)//self.cell_height
+        if first_x == last_x and first_y == last_y:
+            return self.cells.get((first_x, first_y), ())
+        walls = []
+        for cell_y in range(first_y, last_y+1):
+            for cell_x in range(first_x, last_x+1):
+                walls += self.cells.get((cell_x, cell_y), ())
+        return walls
+
+class RoomSimulation():
+    # cheap, position-only version of the enemy AI for rooms the player isn't in
+    # enemies wander around their anchor point the same way Enemy.wander does, the player is ignored
+    # instead of sliding along walls, walks that would go through a wall are skipped
+    # every walk is calculated in one go, so a room can be moved forward by a single frame or by several minutes
+    sprite_sizes = {"walker": 48, "charger": 64} # size of the scaled sprite, keeps enemies inside the room
+    rect_size = 48 # size of the enemy's rect, used for wall collisions
+    long_wait = 60 # seconds, after this long every enemy can be anywhere within its range
+    row_size = 12 # numbers per enemy in SimulationPool's shared memory: the enemy list below + enemy id + alive
+    directions = ("up", "down", "left", "right") # same order as Enemy.directions, the same seed picks the same walks
+
+    def __init__(self, random, room_size, enemy_list, wall_list, now):
+        self.random = random # MainGame.ai_random, or the worker's own generator in SimulationPool
+        self.room_width, self.room_height = room_size # keeps the enemies inside the room
+        self.wall_grid = WallGrid(512, 512, [pygame.Rect(i) for i in wall_list])
+        self.sim_time = now # ticks (ms) up to which the room has been simulated
+        # enemy id -> [x, y, target x, target y, waiting time, anchor x, anchor y, range, speed, sprite size]
+        # every enemy starts at its anchor point, the same as in load_enemies
+        self.enemies = {}
+        for enemy in enemy_list:
+            x = int(enemy[0])
+            y = int(enemy[1])
+            self.enemies[enemy[6]] = [x, y, x, y, 0.0, x, y, int(enemy[4]), enemy[5], self.sprite_sizes.get(enemy[3], 48)]
+
+    def reload(self, room_size, enemy_list, wall_list, old_ids):
+        # the room file changed (--hot-reload), enemies keep their positions and timers, new enemies start at their anchor point
+        # enemies from old_ids that aren't in the simulation anymore are dead and stay dead
+        self.room_width, self.room_height = room_size
+        self.wall_grid = WallGrid(512, 512, [pygame.Rect(i) for i in wall_list])
+        enemies = {}
+        for enemy in enemy_list:
+            x = int(enemy[0])
+            y = int(enemy[1])
+            new = [x, y, x, y, 0.0, x, y, int(enemy[4]), enemy[5], self.sprite_sizes.get(enemy[3], 48)]
+            old = self.enemies.get(enemy[6])
+            if old != None:
+                new[:5] = old[:5]
+            elif enemy[6] in old_ids:
+                continue
+            enemies[enemy[6]] = new
+        self.enemies = enemies
+
+    def read_rows(self, array, offset, count):
+        # loads the enemies from a shared memory array
+        self.enemies = unpack_rows(array, offset, count)
+
+    def write_rows(self, array, offset, ids):
+        # writes the enemies into a shared memory array, ids is the order in which the room's enemies are stored
+        for i, id in enumerate(ids):
+            start = (offset+i)*self.row_size
+            enemy = self.enemies.get(id)
+            if enemy == None:
+                array[start+11] = 0 # the enemy died
+            else:
+                for j in range(10):
+                    array[start+j] = enemy[j]
+                array[start+10] = id
+                array[start+11] = 1
+
+    def advance(self, now):
+        # moves every enemy forward to the current time
+        seconds = (now - self.sim_time)/1000
+        self.sim_time = now
+        if seconds <= 0:
+            return
+        for enemy in self.enemies.values():
+            if seconds > self.long_wait:
+                self.scatter(enemy)
+            else:
+                self.advance_enemy(enemy, seconds)
+
+    def advance_enemy(self, enemy, seconds):
+        while seconds > 0:
+            if enemy[4] > 0: # waiting out the 1 second timer
+                wait = min(enemy[4], seconds)
+                enemy[4] -= wait
+                seconds -= wait
+                continue
+            distance_x = enemy[2] - enemy[0]
+            distance_y = enemy[3] - enemy[1]
+            if abs(distance_x) <= 2 and abs(distance_y) <= 2: # target reached, find a new one
+                self.find_pos(enemy)
+                continue
+            # both axes move at full speed, the same as move_enemy, so the walk takes as long as the longer axis
+            speed = enemy[8]*60 # pixels per second
+            walk_time = max(abs(distance_x), abs(distance_y))/speed
+            if walk_time <= seconds:
+                enemy[0] = enemy[2]
+                enemy[1] = enemy[3]
+                enemy[4] = 1.0 # waits for 1 second, the same as time_delay
+                seconds -= walk_time
+            else:
+                step = speed*seconds
+                enemy[0] += max(-step, min(step, distance_x))
+                enemy[1] += max(-step, min(step, distance_y))
+                seconds = 0
+
+    def find_pos(self, enemy):
+        # picks a new target within range of the anchor point, same rules as Enemy.find_distance
+        random = self.random
+        x, y, anch_x, anch_y, move_range, size = int(enemy[0]), int(enemy[1]), enemy[5], enemy[6], enemy[7], enemy[9]
+        direction = random.choice(self.directions)
+        if direction == "up":
+            enemy[2] = x
+            enemy[3] = random.randint(min(y, max(0, anch_y-move_range)), y)
+        elif direction == "down":
+            enemy[2] = x
+            enemy[3] = random.randint(y, max(y, min(self.room_height-size, anch_y+move_range)))
+        elif direction == "left":
+            enemy[2] = random.randint(min(x, max(0, anch_x-move_range)), x)
+            enemy[3] = y
+        else:
+            enemy[2] = random.randint(x, max(x, min(self.room_width-size, anch_x+move_range)))
+            enemy[3] = y
+        if self.hits_wall(x, y, enemy[2], enemy[3]):
+            # the enemy stays where it is and tries again after the 1 second timer
+            enemy[2] = x
+            enemy[3] = y
+            enemy[4] = 1.0
+
+    def hits_wall(self, x, y, target_x, target_y):
+        # checks the whole area the enemy walks through, walls the enemy is already touching are ignored
+        size = self.rect_size
+        start = pygame.Rect(x, y, size, size)
+        path = pygame.Rect(min(x, target_x), min(y, target_y), abs(target_x-x)+size, abs(target_y-y)+size)
+        for wall in self.wall_grid.near(path):
+            if path.colliderect(wall) and not start.colliderect(wall):
+                return True
+        return False
+
+    def scatter(self, enemy):
+        # the room hasn't been simulated for a long time, the enemy ends up somewhere in its range
+        random = self.random
+        anch_x, anch_y, move_range, size = enemy[5], enemy[6], enemy[7], enemy[9]
+        for i in range(10): # a few tries to find a spot that isn't inside a wall, otherwise the enemy stays put
+            x = random.randint(max(0, anch_x-move_range), max(0, min(self.room_width-size, anch_x+move_range)))
+            y = random.randint(max(0, anch_y-move_range), max(0, min(self.room_height-size, anch_y+move_range)))
+            spot = pygame.Rect(x, y, self.rect_size, self.rect_size)
+            if spot.collidelist(self.wall_grid.near(spot)) == -1:
+                enemy[0] = enemy[2] = x
+                enemy[1] = enemy[3] = y
+                break
+        enemy[4] = random.random() # part of the 1 second timer
+
+    def place_enemy(self, sprite):
+        # moves a freshly loaded Enemy sprite to its simulated position
+        enemy = self.enemies.get(sprite.id)
+        if enemy == None:
+            return
+        sprite.position_x = enemy[0]
+        sprite.position_y = enemy[1]
+        sprite.rect.x = int(enemy[0])
+        sprite.rect.y = int(enemy[1])
+        sprite.new_pos[0] = enemy[2]
+        sprite.new_pos[1] = enemy[3]
+        if enemy[4] > 0:
+            sprite.wander_delay = True
+            sprite.wander_time = 1 - enemy[4]
+        elif enemy[2] != sprite.rect.x or enemy[3] != sprite.rect.y:
+            sprite.wandering = True
+
+    def store_enemies(self, sprites, now):
+        # the player left the room, the simulation continues from where the Enemy sprites stopped
+        # sprites are the room's Enemy sprites, dead enemies are dropped from the simulation
+        enemies = {}
+        for sprite in sprites:
+            if not sprite.alive or sprite.id not in self.enemies:
+                continue
+            enemies[sprite.id] = self.sprite_row(sprite, sprite.wander_time)
+        self.enemies = enemies
+        self.sim_time = now
+
+    def sprite_row(self, sprite, wander_time):
+        # returns the simulation's version of an Enemy sprite, also used by SaveFile for the room the player is in
+        enemy = list(self.enemies[sprite.id])
+        enemy[0] = sprite.position_x
+        enemy[1] = sprite.position_y
+        if sprite.wandering and not sprite.player_spotted:
+            enemy[2] = sprite.new_pos[0]
+            enemy[3] = sprite.new_pos[1]
+        else:
+            enemy[2] = sprite.position_x
+            enemy[3] = sprite.position_y
+        enemy[4] = max(0.0, 1 - wander_time) if sprite.wander_delay else 0.0
+        return enemy
+
+def unpack_rows(array, offset, count):
+    # returns {enemy id: enemy} from count rows of a shared memory array, dead enemies are skipped
+    enemies = {}
+    row_size = RoomSimulation.row_size
+    for i in range(count):
+        start = (offset+i)*row_size
+        row = array[start:start+row_size]
+        if row[11]:
+            enemies[int(row[10])] = list(row[:10])
+    return enemies
+
+def simulation_worker(connection, memory_name, seed):
+    # runs in a SimulationPool worker process
+    # the pool sends the worker's rooms one by one ("add"), the worker writes the rows of these rooms only
+    memory = shared_memory.SharedMemory(name=memory_name)
+    array = memory.buf.cast("d")
+    random = r.Random(seed)
+    rooms = {}
+    claimed = set()
+    while True:
+        message = connection.recv()
+        if message == None:
+            break
+        if message[0] == "add":
+            key, offset, enemy_list, wall_list, room_size, now = message[1:]
+            rooms[key] = [RoomSimulation(random, room_size, enemy_list, wall_list, now), offset, [enemy[6] for enemy in enemy_list]]
+        elif message[0] == "tick":
+            for key, (room, offset, ids) in rooms.items():
+                if key not in claimed:
+                    room.advance(message[1])
+                    room.write_rows(array, offset, ids)
+            connection.send("done")
+        elif message[0] == "claim":
+            claimed.add(message[1])
+        elif message[0] == "release":
+            room, offset, ids = rooms[message[1]]
+            room.read_rows(array, offset, len(ids))
+            room.sim_time = message[2]
+            claimed.discard(message[1])
+        elif message[0] == "reload":
+            # the room file changed, ids has the same length as before (unused rows have the id None)
+            key, ids, room_size, enemy_list, wall_list, old_ids = message[1:]
+            room, offset = rooms[key][:2]
+            room.reload(room_size, enemy_list, wall_list, old_ids)
+            rooms[key][2] = ids
+            if key not in claimed:
+                room.write_rows(array, offset, ids)
+            connection.send("done")
+        elif message[0] == "remove":
+            del rooms[message[1]]
+            claimed.discard(message[1])
+    array.release()
+    memory.close()
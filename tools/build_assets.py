@@ -0,0 +1,294 @@
+import os, re, sys, json, time, hashlib, argparse
+import xml.etree.ElementTree as et
+from concurrent.futures import ProcessPoolExecutor
+
+# builds the runtime versions of the rooms and spritesheets ahead of time
+# every room gets a pre-rendered background (.png) and its walls/enemies (.json), the game loads those instead of parsing the .tmx with pytmx
+# every spritesheet gets an index of its animations (frame names in order), battle characters use it instead of searching every frame name
+# the enemy properties the game needs (see TileMap.render_objects) are validated on the way
+# every input is hashed into build/manifest.json, jobs whose inputs didn't change are skipped, so a rebuild only redoes what changed
+# the jobs run in a process pool, a cold build of a big world uses every core
+# usage: python tools/build_assets.py [--world DIR] [--jobs N] [--force]
+
+GAME_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPRITE_DIR = os.path.join(GAME_DIR, "spritesheets")
+BUILD_VERSION = 1 # changes whenever the format of the outputs changes, every job is then built again
+
+ENEMY_TYPES = ["walker", "charger"] # see MainGame.load_enemies
+
+os.environ["SDL_VIDEODRIVER"] = "dummy" # convert() needs a display, but nothing is ever shown
+
+def init_worker():
+    # runs once in every worker process
+    import pygame
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+
+def read_enemies(tree, sprite_dir):
+    # returns [enemies, walls, errors], enemies and walls are in the same format as WorldMap.read_objects
+    enemies = []
+    walls = []
+    errors = []
+    for object in tree.iter("object"):
+        name = "object %s" % object.get("id")
+        if object.get("type") == "wall":
+            wall = [float(object.get(i, 0)) for i in ("x", "y", "width", "height")]
+            if wall[2] <= 0 or wall[3] <= 0:
+                errors.append("%s: the wall has no size" % name)
+            walls.append(wall)
+        if object.get("type") != "enemy":
+            continue
+        properties = {}
+        types = {}
+        for property in object.iter("property"):
+            properties[property.get("name")] = property.get("value")
+            types[property.get("name")] = property.get("type")
+        missing = [i for i in ("enemy_sprite", "enemy_type", "movement_range", "movement_speed") if i not in properties]
+        if missing:
+            errors.append("%s: missing %s" % (name, ", ".join(missing)))
+            continue
+        if properties["enemy_type"] not in ENEMY_TYPES:
+            errors.append("%s: unknown enemy_type %s" % (name, properties["enemy_type"]))
+        for i in ("movement_range", "movement_speed"):
+            if types[i] != "float":
+                errors.append("%s: %s has to be a float property" % (name, i))
+            try:
+                properties[i] = float(properties[i])
+            except ValueError:
+                errors.append("%s: %s isn't a number" % (name, i))
+                properties[i] = 0
+        if not os.path.exists(os.path.join(sprite_dir, properties["enemy_sprite"] + "_sprites.png")):
+            errors.append("%s: there's no spritesheet for enemy_sprite %s" % (name, properties["enemy_sprite"]))
+        enemies.append([float(object.get("x")), float(object.get("y")), properties["enemy_sprite"], properties["enemy_type"],
+                        properties["movement_range"], properties["movement_speed"], int(object.get("id"))])
+    return enemies, walls, errors
+
+def build_room(tmx_path, output, sprite_dir):
+    # worker: validates the room, writes output.png (the background) and output.json (size, walls, enemies)
+    # returns a list of errors, a room with errors isn't written
+    import pygame, pytmx
+    try:
+        tree = et.parse(tmx_path)
+    except et.ParseError as error:
+        return [str(error)]
+    enemies, walls, errors = read_enemies(tree, sprite_dir)
+    if errors:
+        return errors
+    try:
+        tm = pytmx.load_pygame(tmx_path, pixelalpha = True)
+    except Exception as error:
+        return [str(error)]
+    # the same thing TileMap.draw_tiles does, layer by layer
+    background = pygame.Surface((tm.width*tm.tilewidth, tm.height*tm.tileheight))
+    for layer in tm.visible_layers:
+        if isinstance(layer, pytmx.TiledTileLayer):
+            tiles = []
+            for y, row in enumerate(layer.data):
+                tiles += [(tm.images[gid], (x*tm.tilewidth, y*tm.tileheight)) for x, gid in enumerate(row) if tm.images[gid]]
+            background.blits(tiles, doreturn=False)
+    pygame.image.save(background, output + ".png")
+    data = {"size": [background.get_width(), background.get_height()], "tile": [tm.tilewidth, tm.tileheight], "walls": walls, "enemies": enemies}
+    with open(output + ".json", "w") as f:
+        json.dump(data, f)
+    return []
+
+def build_sheet(json_path, png_path, output):
+    # worker: checks that every frame is inside the image, writes output.json with {animation: frame names in order}
+    # frame names are the animation followed by the frame number (goblin_attackA1.png, goblin_attackA2.png, ...), numbers can't have gaps
+    import pygame
+    with open(json_path) as f:
+        data = json.load(f)
+    width, height = pygame.image.load(png_path).get_size()
+    errors = []
+    animations = {}
+    for name, frame in data["frames"].items():
+        rect = frame["frame"]
+        if rect["x"] < 0 or rect["y"] < 0 or rect["x"] + rect["w"] > width or rect["y"] + rect["h"] > height:
+            errors.append("%s is outside of the image" % name)
+        match = re.fullmatch(r"(.*?)(\d+)\.png", name)
+        if match:
+            animations.setdefault(match.group(1), []).append([int(match.group(2)), name])
+    index = {}
+    for animation, frames in animations.items():
+        frames.sort()
+        first = frames[0][0] # animations start at 1, the QTE keys at 0
+        if [i[0] for i in frames] != list(range(first, first+len(frames))):
+            errors.append("%s: frames aren't numbered %d to %d" % (animation, first, first+len(frames)-1))
+        index[animation] = [i[1] for i in frames]
+    if errors:
+        return errors
+    with open(output + ".json", "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    return []
+
+class Manifest():
+    # build/manifest.json: hashes of every input and the inputs and outputs of every job
+    def __init__(self, build_dir):
+        self.filename = os.path.join(build_dir, "manifest.json")
+        self.data = {"version": BUILD_VERSION, "files": {}, "jobs": {}}
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                data = json.load(f)
+            if data.get("version") == BUILD_VERSION:
+                self.data = data
+
+    def unchanged(self, path):
+        # True if the file has the same modification time and size as the last time it was hashed
+        cached = self.data["files"].get(path)
+        if cached == None or not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        return cached[0] == stat.st_mtime and cached[1] == stat.st_size
+
+    def hash_file(self, path):
+        # files are only hashed again once their modification time or size changes
+        if not os.path.exists(path):
+            return "missing"
+        if self.unchanged(path):
+            return self.data["files"][path][2]
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self.data["files"][path] = [stat.st_mtime, stat.st_size, digest]
+        return digest
+
+    def write(self):
+        with open(self.filename, "w") as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+
+class AssetBuilder():
+    def __init__(self, world_dir, sprite_dir, jobs, force=False):
+        self.world_dir = os.path.abspath(world_dir)
+        self.room_dir = os.path.join(self.world_dir, "room_bgs")
+        self.sprite_dir = os.path.abspath(sprite_dir)
+        self.jobs = jobs
+        self.force = force
+        self.errors = [] # [job, error]
+        self.built = 0
+        self.skipped = 0
+
+    def build(self):
+        # rooms are built into the world's build directory, spritesheets into the game's, for the shipped world that's the same directory
+        room_build = os.path.join(self.world_dir, "build")
+        sheet_build = os.path.join(os.path.dirname(self.sprite_dir), "build")
+        manifests = {}
+        for build_dir in (room_build, sheet_build):
+            os.makedirs(os.path.join(build_dir, "rooms"), exist_ok=True)
+            os.makedirs(os.path.join(build_dir, "spritesheets"), exist_ok=True)
+            if build_dir not in manifests:
+                manifests[build_dir] = Manifest(build_dir)
+        pending = self.find_room_jobs(manifests[room_build], room_build) + self.find_sheet_jobs(manifests[sheet_build], sheet_build)
+
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=init_worker) as pool:
+            futures = [[job, pool.submit(*job["work"])] for job in pending]
+            for job, future in futures:
+                try:
+                    errors = future.result()
+                except Exception as error: # broken file (.json that isn't json, image pygame can't read, ...)
+                    errors = [str(error)]
+                if errors:
+                    self.errors += [[job["key"], i] for i in errors]
+                    job["manifest"].data["jobs"].pop(job["key"], None) # built again next time
+                else:
+                    job["manifest"].data["jobs"][job["key"]] = {"hash": job["hash"], "inputs": job["inputs"], "outputs": job["outputs"]}
+                    self.built += 1
+        for manifest in manifests.values():
+            manifest.write()
+
+    def add_job(self, manifest, key, inputs, outputs, work, pending):
+        # inputs are stored relative to the root of the job (the world or the game directory), together with their modification time
+        # the game only uses an output while the modification times still match
+        root = os.path.dirname(os.path.dirname(manifest.filename))
+        digest = hashlib.sha256(str(BUILD_VERSION).encode())
+        input_times = {}
+        for path in sorted(set(inputs)):
+            digest.update(manifest.hash_file(path).encode())
+            input_times[os.path.relpath(path, root)] = os.path.getmtime(path) if os.path.exists(path) else None
+        digest = digest.hexdigest()
+        old = manifest.data["jobs"].get(key)
+        outputs = [os.path.relpath(i, root) for i in outputs]
+        if not self.force and old != None and old["hash"] == digest and all(os.path.exists(os.path.join(root, i)) for i in outputs):
+            old["inputs"] = input_times # same content, but the file might have been touched
+            self.skipped += 1
+            return
+        pending.append({"key": key, "hash": digest, "inputs": input_times, "outputs": outputs, "work": work, "manifest": manifest})
+
+    def find_room_jobs(self, manifest, build_dir):
+        pending = []
+        names = []
+        for filename in sorted(os.listdir(self.room_dir)):
+            if not filename.endswith(".tmx"):
+                continue
+            name = filename[:-4]
+            names.append(name)
+            tmx_path = os.path.join(self.room_dir, filename)
+            output = os.path.join(build_dir, "rooms", name)
+            old = manifest.data["jobs"].get("room:" + name)
+            if old != None and manifest.unchanged(tmx_path):
+                # same room file, so it still uses the same tilesets, the file doesn't have to be parsed again
+                inputs = [os.path.normpath(os.path.join(self.world_dir, i)) for i in old["inputs"]]
+            else:
+                inputs = [tmx_path] + self.find_tilesets(tmx_path)
+            self.add_job(manifest, "room:" + name, inputs, [output + ".png", output + ".json"], [build_room, tmx_path, output, self.sprite_dir], pending)
+        self.remove_old_jobs(manifest, "room:", names)
+        return pending
+
+    def find_tilesets(self, tmx_path):
+        # the tilesets (.tsx) a room uses and their images, a room has to be built again when any of them changes
+        paths = []
+        try:
+            root = et.parse(tmx_path).getroot()
+        except et.ParseError:
+            return paths # build_room reports the error
+        for image in root.iter("image"): # tilesets embedded in the room
+            paths.append(os.path.normpath(os.path.join(os.path.dirname(tmx_path), image.get("source"))))
+        for tileset in root.iter("tileset"):
+            if tileset.get("source") == None:
+                continue
+            tsx_path = os.path.normpath(os.path.join(os.path.dirname(tmx_path), tileset.get("source")))
+            paths.append(tsx_path)
+            if not os.path.exists(tsx_path):
+                continue
+            for image in et.parse(tsx_path).getroot().iter("image"):
+                paths.append(os.path.normpath(os.path.join(os.path.dirname(tsx_path), image.get("source"))))
+        return paths
+
+    def find_sheet_jobs(self, manifest, build_dir):
+        pending = []
+        names = []
+        for filename in sorted(os.listdir(self.sprite_dir)):
+            if not filename.endswith(".json") or filename.startswith("atlas"):
+                continue
+            sheet = filename.replace(".json", ".png")
+            names.append(sheet)
+            json_path = os.path.join(self.sprite_dir, filename)
+            png_path = os.path.join(self.sprite_dir, sheet)
+            output = os.path.join(build_dir, "spritesheets", filename[:-5])
+            self.add_job(manifest, "sheet:" + sheet, [json_path, png_path], [output + ".json"], [build_sheet, json_path, png_path, output], pending)
+        self.remove_old_jobs(manifest, "sheet:", names)
+        return pending
+
+    def remove_old_jobs(self, manifest, prefix, names):
+        # inputs that were deleted, their outputs are deleted too
+        root = os.path.dirname(os.path.dirname(manifest.filename))
+        for key in list(manifest.data["jobs"]):
+            if key.startswith(prefix) and key[len(prefix):] not in names:
+                for output in manifest.data["jobs"].pop(key)["outputs"]:
+                    if os.path.exists(os.path.join(root, output)):
+                        os.remove(os.path.join(root, output))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build the runtime versions of every Kastles and Krakens room and spritesheet")
+    parser.add_argument("--world", metavar="DIR", default=GAME_DIR, help="world (maplist.csv and room_bgs) to build, see tools/generate_world.py")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), metavar="N", help="number of worker processes")
+    parser.add_argument("--force", action="store_true", help="build everything, even inputs that didn't change")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    builder = AssetBuilder(args.world, SPRITE_DIR, args.jobs, args.force)
+    builder.build()
+    for key, error in builder.errors:
+        print("%s: %s" % (key, error))
+    print("built %d, skipped %d unchanged, %d error(s) in %.2f s" % (builder.built, builder.skipped, len(builder.errors), time.perf_counter() - start))
+    if builder.errors:
+        sys.exit(1)
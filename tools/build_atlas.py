@@ -0,0 +1,107 @@
+import os, sys, json, argparse
+
+# packs every spritesheet into one or a few atlas pages
+# writes spritesheets/atlas.json and spritesheets/atlas_N.png, the game cuts its frames out of the atlas
+# instead of opening every sheet on its own (sheets that changed after the atlas was built are still loaded from their own files)
+# usage: python tools/build_atlas.py [--page-size 1024]
+
+GAME_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPRITE_DIR = os.path.join(GAME_DIR, "spritesheets")
+
+os.environ["SDL_VIDEODRIVER"] = "dummy" # convert() needs a display, but nothing is ever shown
+import pygame
+
+class AtlasBuilder():
+    def __init__(self, sprite_dir, page_size):
+        self.sprite_dir = sprite_dir
+        self.page_size = page_size
+        self.pages = [] # one list of [x, y, width, height, sheet, frame rect] per page
+        self.shelves = [] # one list of shelves per page, every shelf is [y, height, next free x]
+        self.sheets = {} # sheet filename -> same data as the sheet's .json, but with atlas coordinates
+
+    def build(self):
+        frames = self.read_frames()
+        # tall frames first, the shelves then waste less space
+        frames.sort(key=lambda frame: (frame[3], frame[2]), reverse=True)
+        for frame in frames:
+            self.place(frame)
+        self.write()
+
+    def read_frames(self):
+        # returns one [sheet, name, width, height, frame rect] per frame, frames that share a rect in the same sheet are only packed once
+        frames = []
+        self.frame_names = {} # (sheet, frame rect) -> names of every frame using it
+        for filename in sorted(os.listdir(self.sprite_dir)):
+            if not filename.endswith(".json") or filename.startswith("atlas"):
+                continue
+            sheet = filename.replace(".json", ".png")
+            with open(os.path.join(self.sprite_dir, filename)) as f:
+                data = json.load(f)
+            self.sheets[sheet] = {"frames": {}, "source_time": self.get_source_time(sheet)}
+            for name, frame in data["frames"].items():
+                rect = (frame["frame"]["x"], frame["frame"]["y"], frame["frame"]["w"], frame["frame"]["h"])
+                if (sheet, rect) not in self.frame_names:
+                    self.frame_names[(sheet, rect)] = []
+                    frames.append([sheet, name, rect[2], rect[3], rect])
+                self.frame_names[(sheet, rect)].append(name)
+        return frames
+
+    def get_source_time(self, sheet):
+        # the game only uses a sheet from the atlas if neither the image nor the .json changed since the atlas was built
+        return max(os.path.getmtime(os.path.join(self.sprite_dir, sheet)), os.path.getmtime(os.path.join(self.sprite_dir, sheet.replace(".png", ".json"))))
+
+    def place(self, frame):
+        # simple shelf packing: the frame goes onto the first shelf it fits on, a new shelf is opened below the last one if there isn't any
+        sheet, name, width, height, rect = frame
+        if width > self.page_size or height > self.page_size:
+            sys.exit("%s in %s is bigger than the atlas page (%d px)" % (name, sheet, self.page_size))
+        for page, shelves in enumerate(self.shelves):
+            for shelf in shelves:
+                if height <= shelf[1] and shelf[2] + width <= self.page_size:
+                    self.add(page, shelf[2], shelf[0], frame)
+                    shelf[2] += width
+                    return
+            bottom = shelves[-1][0] + shelves[-1][1]
+            if bottom + height <= self.page_size:
+                shelves.append([bottom, height, width])
+                self.add(page, 0, bottom, frame)
+                return
+        self.pages.append([])
+        self.shelves.append([[0, height, width]])
+        self.add(len(self.pages)-1, 0, 0, frame)
+
+    def add(self, page, x, y, frame):
+        sheet, name, width, height, rect = frame
+        self.pages[page].append([x, y, width, height, sheet, rect])
+        for name in self.frame_names[(sheet, rect)]:
+            self.sheets[sheet]["frames"][name] = {"frame": {"x": x, "y": y, "w": width, "h": height}, "page": page}
+
+    def write(self):
+        pygame.display.set_mode((1, 1))
+        sources = {}
+        page_names = []
+        for page, placed in enumerate(self.pages):
+            # the page only gets as big as it needs to be
+            width = max(x + w for x, y, w, h, sheet, rect in placed)
+            height = max(y + h for x, y, w, h, sheet, rect in placed)
+            surface = pygame.Surface((width, height))
+            for x, y, w, h, sheet, rect in placed:
+                if sheet not in sources:
+                    # convert() is what the game does with every sheet, pixels that are transparent in the .png end up black (the colorkey)
+                    sources[sheet] = pygame.image.load(os.path.join(self.sprite_dir, sheet)).convert()
+                surface.blit(sources[sheet], (x, y), rect)
+            page_names.append("atlas_%d.png" % page)
+            pygame.image.save(surface, os.path.join(self.sprite_dir, page_names[-1]))
+        with open(os.path.join(self.sprite_dir, "atlas.json"), "w") as f:
+            json.dump({"pages": page_names, "sheets": self.sheets}, f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pack every Kastles and Krakens spritesheet into an atlas")
+    parser.add_argument("--page-size", type=int, default=1024, help="maximum width and height of an atlas page in pixels")
+    parser.add_argument("--dir", default=SPRITE_DIR, help="directory with the spritesheets (.png + .json)")
+    args = parser.parse_args()
+
+    builder = AtlasBuilder(args.dir, args.page_size)
+    builder.build()
+    frame_count = sum(len(i["frames"]) for i in builder.sheets.values())
+    print("packed %d frames from %d sheets into %d page(s) in %s" % (frame_count, len(builder.sheets), len(builder.pages), args.dir))
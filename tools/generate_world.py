@@ -0,0 +1,223 @@
+import os, sys, random, shutil, argparse
+
+# generates synthetic worlds for scale testing
+# the output directory contains a maplist.csv and a room_bgs directory, just like the shipped world,
+# so the game can load it through the normal load_rooms path: python "Kastles and Krakens.py" --world DIR
+# usage: python tools/generate_world.py DIR --width 50 --height 50 --walls 0.15 --enemies 2 4
+
+GAME_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TILE_SIZE = 32 # pixels
+
+# the room is split into 2x2 tile cells, every wall is one bush that takes up a whole cell
+CELL = 2
+
+# tile gids from !CL_DEMO_32x32.tsx
+GRASS = 42
+PATH = 129
+BUSH = [461, 462, 581, 582] # top left, top right, bottom left, bottom right
+
+PLAYER_CELL = (624//(CELL*TILE_SIZE), 600//(CELL*TILE_SIZE)) # the player starts the game here
+
+# enemy sprite -> [enemy_type, frame size]
+ENEMY_TYPES = {
+    "goblin": ["walker", 48],
+    "skeleton": ["walker", 48],
+    "fireworm": ["charger", 64],
+}
+MOVEMENT_RANGES = [150, 200, 250, 300]
+MOVEMENT_SPEEDS = [1.5, 2]
+
+class WorldGenerator():
+    def __init__(self, output_dir, width, height, wall_density, enemies, variants, seed, room_size=(40, 30)):
+        self.output_dir = output_dir
+        self.room_dir = os.path.join(output_dir, "room_bgs")
+        self.width = width # rooms
+        self.height = height # rooms
+        self.wall_density = wall_density # chance that a free cell gets a bush
+        self.enemies = enemies # [min, max] enemies per room
+        self.variants = variants # number of different room files, 0 = every room has its own file
+        self.random = random.Random(seed)
+
+        # room size in tiles, 40x30 is the same as every hand-made room (and the screen), bigger rooms scroll
+        self.room_width, self.room_height = room_size
+        self.cells_x = self.room_width//CELL
+        self.cells_y = self.room_height//CELL
+        # exits are in the middle of every side, for 40x30 rooms that's roughly where the hand-made rooms have them
+        # (x 512-768 on the top/bottom, y 384-704 on the sides), the side exits are a bit taller so that the player can walk straight through
+        middle_x = self.cells_x//2
+        middle_y = self.cells_y//2
+        self.exit_cells_x = range(middle_x-2, middle_x+2)
+        self.exit_cells_y = range(middle_y-1, middle_y+4)
+        self.path_cells_x = range(middle_x-1, middle_x+1)
+        self.path_cells_y = range(middle_y+1, middle_y+3)
+
+    def generate(self):
+        os.makedirs(os.path.join(self.room_dir, "tilesets"), exist_ok=True)
+        self.copy_assets()
+        room_names = self.write_rooms()
+        self.write_maplist(room_names)
+
+    def copy_assets(self):
+        # the void room and the tileset are shared with the shipped world
+        source_dir = os.path.join(GAME_DIR, "room_bgs")
+        shutil.copy(os.path.join(source_dir, "void.tmx"), self.room_dir)
+        for filename in ["!CL_DEMO_32x32.tsx", "!CL_DEMO_32x32.png"]:
+            shutil.copy(os.path.join(source_dir, "tilesets", filename), os.path.join(self.room_dir, "tilesets"))
+
+    def write_rooms(self):
+        # returns the layout of the world, a list of rows with room names
+        room_names = []
+        count = 0
+        for y in range(self.height):
+            row = []
+            for x in range(self.width):
+                if self.variants:
+                    name = "room_gen_%d" % (count % self.variants)
+                else:
+                    name = "room_gen_%d_%d" % (x, y)
+                if not self.variants or count < self.variants:
+                    # exits are only opened towards neighbouring rooms, variants can end up anywhere so they keep every exit
+                    exits = [y > 0, y < self.height-1, x > 0, x < self.width-1] # top, bottom, left, right
+                    if self.variants:
+                        exits = [True, True, True, True]
+                    self.write_room(name, exits)
+                row.append(name)
+                count += 1
+            room_names.append(row)
+        return room_names
+
+    def write_maplist(self, room_names):
+        # the world is surrounded by void rooms, the same way maplist.csv is
+        void_row = ["void"]*(self.width+2)
+        with open(os.path.join(self.output_dir, "maplist.csv"), "w") as f:
+            f.write(",".join(void_row) + "\n")
+            for row in room_names:
+                f.write(",".join(["void"] + row + ["void"]) + "\n")
+            f.write(",".join(void_row) + "\n")
+
+    def create_cells(self, exits):
+        # True = the cell has a bush
+        top, bottom, left, right = exits
+        cells = [[False]*self.cells_x for i in range(self.cells_y)]
+        for cy in range(self.cells_y):
+            for cx in range(self.cells_x):
+                if cx in self.exit_cells_x or cy in self.exit_cells_y:
+                    # paths between the exits always stay free, every exit can be reached from every other exit
+                    wall = False
+                elif cx == 0 or cy == 0 or cx == self.cells_x-1 or cy == self.cells_y-1:
+                    wall = True # walls around the edges of the room
+                elif cx == PLAYER_CELL[0] and cy == PLAYER_CELL[1]:
+                    wall = False # the player's starting position
+                else:
+                    wall = self.random.random() < self.wall_density
+                cells[cy][cx] = wall
+        # closed exits get a bush instead of a gap
+        for cx in self.exit_cells_x:
+            cells[0][cx] = not top
+            cells[self.cells_y-1][cx] = not bottom
+        for cy in self.exit_cells_y:
+            cells[cy][0] = not left
+            cells[cy][self.cells_x-1] = not right
+        return cells
+
+    def find_enemy_cells(self, cells):
+        # free cells that aren't too close to the player's starting position or the exits
+        free = []
+        for cy in range(2, self.cells_y-2):
+            for cx in range(2, self.cells_x-2):
+                if cells[cy][cx]:
+                    continue
+                if abs(cx - PLAYER_CELL[0]) <= 3 and abs(cy - PLAYER_CELL[1]) <= 3:
+                    continue
+                if cx in self.exit_cells_x or cy in self.exit_cells_y:
+                    continue # enemies standing in the exits would start a battle the moment the player walks in
+                free.append((cx, cy))
+        return free
+
+    def write_room(self, name, exits):
+        cells = self.create_cells(exits)
+        ground = [[GRASS]*self.room_width for i in range(self.room_height)]
+        bushes = [[0]*self.room_width for i in range(self.room_height)]
+        objects = []
+        object_id = 1
+
+        for cy in range(self.cells_y):
+            for cx in range(self.cells_x):
+                tx = cx*CELL
+                ty = cy*CELL
+                if cells[cy][cx]:
+                    bushes[ty][tx], bushes[ty][tx+1], bushes[ty+1][tx], bushes[ty+1][tx+1] = BUSH
+                    objects.append('  <object id="%d" type="wall" x="%d" y="%d" width="%d" height="%d"/>' % (object_id, tx*TILE_SIZE, ty*TILE_SIZE, CELL*TILE_SIZE, CELL*TILE_SIZE))
+                    object_id += 1
+                elif cx in self.path_cells_x or cy in self.path_cells_y:
+                    for dy in range(CELL):
+                        for dx in range(CELL):
+                            ground[ty+dy][tx+dx] = PATH # dirt path between the exits
+
+        enemies = []
+        free = self.find_enemy_cells(cells)
+        count = min(self.random.randint(self.enemies[0], self.enemies[1]), len(free))
+        for cx, cy in self.random.sample(free, count):
+            sprite = self.random.choice(list(ENEMY_TYPES))
+            enemy_type, size = ENEMY_TYPES[sprite]
+            enemies.append('  <object id="%d" name="%s" type="enemy" x="%d" y="%d" width="%d" height="%d">' % (object_id, sprite, cx*CELL*TILE_SIZE, cy*CELL*TILE_SIZE, size, size))
+            enemies.append('   <properties>')
+            enemies.append('    <property name="enemy_sprite" value="%s"/>' % sprite)
+            enemies.append('    <property name="enemy_type" value="%s"/>' % enemy_type)
+            enemies.append('    <property name="movement_range" type="float" value="%d"/>' % self.random.choice(MOVEMENT_RANGES))
+            enemies.append('    <property name="movement_speed" type="float" value="%s"/>' % self.random.choice(MOVEMENT_SPEEDS))
+            enemies.append('   </properties>')
+            enemies.append('  </object>')
+            object_id += 1
+
+        lines = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<map version="1.5" tiledversion="1.7.2" orientation="orthogonal" renderorder="right-down" width="%d" height="%d" tilewidth="%d" tileheight="%d" infinite="0" nextlayerid="5" nextobjectid="%d">' % (self.room_width, self.room_height, TILE_SIZE, TILE_SIZE, object_id),
+            ' <tileset firstgid="1" source="tilesets/!CL_DEMO_32x32.tsx"/>',
+        ]
+        lines += self.create_layer(1, "Tile Layer 1", ground)
+        lines += self.create_layer(2, "Tile Layer 2", bushes)
+        lines.append(' <objectgroup id="3" name="Walls">')
+        lines += objects
+        lines.append(' </objectgroup>')
+        if enemies:
+            lines.append(' <objectgroup id="4" name="Enemies">')
+            lines += enemies
+            lines.append(' </objectgroup>')
+        else:
+            lines.append(' <objectgroup id="4" name="Enemies"/>')
+        lines.append('</map>')
+        with open(os.path.join(self.room_dir, name + ".tmx"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def create_layer(self, layer_id, name, tiles):
+        # csv encoded tile layer, the same format Tiled saves
+        rows = [",".join(str(i) for i in row) for row in tiles]
+        return [
+            ' <layer id="%d" name="%s" width="%d" height="%d">' % (layer_id, name, self.room_width, self.room_height),
+            '  <data encoding="csv">',
+            ",\n".join(rows),
+            '</data>',
+            ' </layer>',
+        ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="generate a synthetic Kastles and Krakens world")
+    parser.add_argument("output", metavar="DIR", help="directory for maplist.csv and room_bgs")
+    parser.add_argument("--width", type=int, default=30, help="width of the world in rooms (at least 2, the player starts in the second room)")
+    parser.add_argument("--height", type=int, default=30, help="height of the world in rooms")
+    parser.add_argument("--walls", type=float, default=0.1, help="chance that a free cell in a room gets a bush (0-1)")
+    parser.add_argument("--enemies", type=int, nargs=2, default=[1, 3], metavar=("MIN", "MAX"), help="number of enemies in every room")
+    parser.add_argument("--variants", type=int, default=0, help="number of different room files, 0 = every room gets its own file")
+    parser.add_argument("--room-size", type=int, nargs=2, default=[40, 30], metavar=("WIDTH", "HEIGHT"), help="size of every room in tiles, rooms bigger than 40x30 scroll")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the random number generator")
+    args = parser.parse_args()
+    if args.width < 2 or args.height < 1:
+        sys.exit("the world has to be at least 2 rooms wide and 1 room high")
+    if args.room_size[0] < 40 or args.room_size[1] < 30:
+        sys.exit("rooms have to be at least 40x30 tiles")
+
+    generator = WorldGenerator(args.output, args.width, args.height, args.walls, args.enemies, args.variants, args.seed, args.room_size)
+    generator.generate()
+    print("generated %d rooms in %s" % (args.width*args.height, args.output))